@@ -0,0 +1,243 @@
+import argparse
+import glob
+import hashlib
+import json
+import logging
+import os
+import sys
+import threading
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from configuration.configuration import Configuration
+from main import ingest, run_download, run_training, run_visualization, train_requested
+from utils import load_environment, set_logging
+from utils.downloader import Downloader
+from utils.instrumentation import recorder
+from utils.parallel import budget_task, set_budget
+from utils.task_graph import Task, TaskGraph, TaskStatusConstants
+
+load_environment()
+set_logging()
+logger = logging.getLogger(__name__)
+
+PROPERTIES_PATH = os.path.join(os.path.dirname(__file__), "..", "resources", "properties")
+
+# Download settings that change how, not what, is downloaded
+DOWNLOAD_EXECUTION_KEYS = [
+    "enabled",
+    "remove_previous_download",
+    "workers",
+    "max_retries",
+    "backoff_factor",
+    "verify_checksums",
+    "rate_limit",
+    "client_id_env",
+    "client_secret_env",
+]
+# Train settings the KPI dataframe depends on
+INGEST_KEYS = [
+    "start_date",
+    "end_date",
+    "gaps",
+    "index",
+    "kpi",
+    "kpis",
+    "screening",
+    "zones",
+    "incremental",
+    "datacube",
+    "streaming",
+    "read_by_blocks",
+]
+
+# pyplot keeps global state, plots are drawn one at a time
+_plot_lock = threading.Lock()
+
+
+def resolve_config_files(patterns: List[str]) -> List[str]:
+    """Expand file names and glob patterns, relative ones are looked up in resources/properties"""
+    files = []
+    for pattern in patterns:
+        if not os.path.isabs(pattern) and not os.path.exists(pattern):
+            pattern = os.path.join(PROPERTIES_PATH, pattern)
+        matches = sorted(glob.glob(pattern))
+        if not matches:
+            raise FileNotFoundError(f"No configuration file matches {pattern}")
+        files += [os.path.normpath(match) for match in matches if os.path.normpath(match) not in files]
+    return files
+
+
+def settings_key(settings: Dict[str, Any]) -> str:
+    return hashlib.sha256(json.dumps(settings, sort_keys=True, default=str).encode()).hexdigest()[:16]
+
+
+def download_key(config: dict) -> str:
+    download_config = config.get("download") or {}
+    settings = {key: value for key, value in download_config.items() if key not in DOWNLOAD_EXECUTION_KEYS}
+    settings["interval_type"] = config.get("interval_type", "weeks")
+    settings["date_interval"] = config.get("date_interval", 1)
+    return settings_key(settings)
+
+
+def ingest_key(config: dict, raster_id: str) -> str:
+    train_config = config.get("train") or {}
+    settings = {key: train_config.get(key) for key in INGEST_KEYS}
+    settings.update(
+        raster_id=raster_id,
+        interval_type=config.get("interval_type", "weeks"),
+        date_interval=config.get("date_interval", 1),
+    )
+    if train_config.get("incremental"):
+        # The series cache also counts the model updates of its name_id, it cannot be shared
+        settings["name_id"] = config.get("name_id")
+    return settings_key(settings)
+
+
+class BatchRunner:
+    """Run the download, ingest, train and visualise stages of many configurations as one task graph.
+
+    Configurations downloading the same bbox, dates and evalscript share one download, written under
+    the name_id of the first of them, and configurations reducing the same rasters with the same
+    settings share the KPI dataframe. Ingests of the same rasters run one at a time. Downloads with the
+    same credentials share one OAuth session and token. Every task runs on one pool of `workers` threads
+    and `workers` also caps the download, decoding, training and backtest pools the tasks start."""
+
+    def __init__(self, config_files: List[str], workers: int = 4):
+        self.config_files: List[str] = config_files
+        self.workers: int = max(1, workers)
+        self.configs: Dict[str, dict] = {}
+        for config_file in config_files:
+            with open(config_file, "r") as f:
+                self.configs[config_file] = json.load(f)
+        self.graph: TaskGraph = TaskGraph()
+        self._session_owners: Dict[Tuple[str, str, str], Downloader] = {}
+        self._session_lock = threading.Lock()
+        # Ingests of one raster_id append to the same datacube, screening sidecars and raster index
+        self._ingest_locks: Dict[str, threading.Lock] = {}
+        self._build()
+
+    def session_owner(self, download_config: dict) -> Optional[Downloader]:
+        client_id_env = download_config.get("client_id_env")
+        client_secret_env = download_config.get("client_secret_env")
+        if not client_id_env or not client_secret_env:
+            return None
+        missing = [env for env in (client_id_env, client_secret_env) if not os.getenv(env)]
+        if missing:
+            raise ValueError(f"Environment variables {', '.join(missing)} with the download credentials are not set")
+        credentials = (client_id_env, client_secret_env, download_config.get("token_url"))
+        with self._session_lock:
+            if credentials not in self._session_owners:
+                self._session_owners[credentials] = Downloader(
+                    os.getenv(client_id_env),
+                    os.getenv(client_secret_env),
+                    download_config.get("token_url"),
+                    # Only sizes the connection pool, the downloads share the batch budget
+                    workers=self.workers,
+                )
+            return self._session_owners[credentials]
+
+    def _build(self) -> None:
+        raster_ids: Dict[str, str] = {}
+        for config_file, config in self.configs.items():
+            name_id = config.get("name_id")
+            dependencies = []
+            raster_id = name_id
+            if (config.get("download") or {}).get("enabled"):
+                key = download_key(config)
+                raster_id = raster_ids.setdefault(key, name_id)
+                # Credentials are checked when the download runs, a missing one only fails this download
+                task = self.add(
+                    f"download:{raster_id}:{key}",
+                    lambda c=config: run_download(c, self.session_owner(c.get("download"))),
+                )
+                dependencies = [task.key]
+                if raster_id != name_id:
+                    logger.info(f"{name_id} downloads the same rasters as {raster_id}, sharing them")
+            if not train_requested(config.get("train") or {}):
+                continue
+            self._ingest_locks.setdefault(raster_id, threading.Lock())
+            task = self.add(
+                f"ingest:{raster_id}:{ingest_key(config, raster_id)}",
+                lambda *_, c=config, r=raster_id: self.ingest(c, r),
+                dependencies,
+            )
+            task = self.add(f"train:{config_file}", lambda data, c=config: run_training(c, data), [task.key])
+            self.add(f"visualize:{config_file}", lambda models, c=config: self.visualize(c, models), [task.key])
+
+    def add(self, key: str, function: Callable[..., Any], dependencies: Optional[List[str]] = None) -> Task:
+        """Add a task holding one worker of the batch budget while it runs, its pools borrow the idle ones"""
+
+        def run(*results: Any) -> Any:
+            with budget_task():
+                return function(*results)
+
+        return self.graph.add(key, run, dependencies)
+
+    def ingest(self, config: dict, raster_id: str) -> Any:
+        # A lock rather than a dependency, a failed ingest must not skip the other ones of the raster
+        with self._ingest_locks[raster_id]:
+            return ingest(config, raster_id)
+
+    def visualize(self, config: dict, models: List[Any]) -> None:
+        with _plot_lock:
+            run_visualization(config, models)
+
+    def run(self) -> Dict[str, Any]:
+        shared = sum(task.requests - 1 for task in self.graph.tasks.values())
+        logger.info(
+            f"{len(self.configs)} configurations, {len(self.graph.tasks)} tasks "
+            f"({shared} shared), {self.workers} workers"
+        )
+        set_budget(self.workers)
+        try:
+            tasks = self.graph.run(self.workers)
+        finally:
+            set_budget(None)
+        summary = {
+            "tasks": [
+                {
+                    "key": task.key,
+                    "status": task.status.value,
+                    "seconds": round(task.seconds, 3),
+                    "requests": task.requests,
+                    "error": task.error,
+                }
+                for task in tasks.values()
+            ]
+        }
+        for status in TaskStatusConstants:
+            summary[status.value] = sum(task.status == status for task in tasks.values())
+        logger.info(
+            "Batch finished: {done} done, {failed} failed, {skipped} skipped".format(**summary)
+        )
+        return summary
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Download and train models for many configurations at once")
+    parser.add_argument(
+        "config_files", nargs="+", help="JSON configuration files or glob patterns, e.g. 'isla_mayor*.json'"
+    )
+    parser.add_argument(
+        "--workers",
+        "-w",
+        type=int,
+        default=4,
+        help="Workers of the whole batch, shared by the running tasks and the pools they start",
+    )
+    parser.add_argument("--summary", type=str, help="Write the status and duration of every task to this JSON file")
+    parser.add_argument(
+        "--report", action="store_true", help="Write the stage timing and memory report of the whole batch"
+    )
+    args = parser.parse_args()
+    runner = BatchRunner(resolve_config_files(args.config_files), workers=args.workers)
+    if args.report:
+        recorder.reset("batch")
+    summary = runner.run()
+    if args.report:
+        recorder.write(str(Configuration()["reports_path"]))
+    if args.summary:
+        with open(args.summary + ".tmp", "w") as f:
+            json.dump(summary, f, indent=2)
+        os.replace(args.summary + ".tmp", args.summary)
+    sys.exit(1 if summary["failed"] or summary["skipped"] else 0)
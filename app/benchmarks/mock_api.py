@@ -0,0 +1,151 @@
+import json
+import logging
+import os
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Tuple
+
+import numpy as np
+from benchmarks.synthetic import raster_bytes, synthetic_image
+from utils import set_logging
+
+set_logging()
+logger = logging.getLogger(__name__)
+
+TOKEN_PATH = "/oauth/token"
+PROCESS_PATH = "/api/v1/process"
+
+
+class MockProcessApi:
+    """Local stand-in for the OAuth token endpoint and the Process API, for offline benchmarks.
+
+    Every process request waits `latency` seconds (plus up to `jitter`), then fails with a 429 and a
+    Retry-After of `retry_after` seconds with probability `throttle_rate`, with a 500 with probability
+    `error_rate`, or returns a synthetic GeoTIFF of the requested size and of the bands and sample
+    type the evalscript declares. Responses are encoded once per shape, so serving them costs little
+    next to the client being measured."""
+
+    def __init__(
+        self,
+        latency: float = 0.0,
+        jitter: float = 0.0,
+        error_rate: float = 0.0,
+        throttle_rate: float = 0.0,
+        retry_after: float = 1.0,
+        token_expires_in: int = 3600,
+        seed: int = 0,
+    ):
+        self.latency: float = latency
+        self.jitter: float = jitter
+        self.error_rate: float = error_rate
+        self.throttle_rate: float = throttle_rate
+        self.retry_after: float = retry_after
+        self.token_expires_in: int = token_expires_in
+        self.counters: Dict[str, int] = {"tokens": 0, "requests": 0, "throttled": 0, "errors": 0, "bytes": 0}
+        self._random = random.Random(seed)
+        self._responses: Dict[Tuple[int, int, int, str], bytes] = {}
+        self._lock = threading.Lock()
+        self._server = None
+        self._thread = None
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self._server.server_port}{PROCESS_PATH}"
+
+    @property
+    def token_url(self) -> str:
+        return f"http://127.0.0.1:{self._server.server_port}{TOKEN_PATH}"
+
+    def start(self) -> "MockProcessApi":
+        # oauthlib refuses to fetch tokens over plain HTTP otherwise
+        os.environ["OAUTHLIB_INSECURE_TRANSPORT"] = "1"
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                if self.path == TOKEN_PATH:
+                    api.count("tokens")
+                    self.respond(200, json.dumps(api.token()).encode(), "application/json")
+                elif self.path == PROCESS_PATH:
+                    self.respond(*api.process(json.loads(body)))
+                else:
+                    self.respond(404, b"Not found", "text/plain")
+
+            def respond(self, status: int, content: bytes, content_type: str, headers: Dict[str, str] = {}):
+                self.send_response(status)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(content)))
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(content)
+
+            def log_message(self, format, *args):
+                pass
+
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        logger.info(f"Mock Process API listening on {self.url}")
+        return self
+
+    def stop(self) -> None:
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+    def __enter__(self) -> "MockProcessApi":
+        return self.start()
+
+    def __exit__(self, *args) -> None:
+        self.stop()
+
+    def count(self, counter: str, amount: int = 1) -> None:
+        with self._lock:
+            self.counters[counter] += amount
+
+    def token(self) -> Dict[str, object]:
+        return {
+            "access_token": f"mock-{time.time_ns()}",
+            "token_type": "Bearer",
+            "expires_in": self.token_expires_in,
+        }
+
+    def process(self, payload: Dict) -> Tuple[int, bytes, str, Dict[str, str]]:
+        self.count("requests")
+        time.sleep(self.latency + self._random.uniform(0, self.jitter))
+        with self._lock:
+            draw = self._random.random()
+        if draw < self.throttle_rate:
+            self.count("throttled")
+            return 429, b"Too many requests", "text/plain", {"Retry-After": str(self.retry_after)}
+        if draw < self.throttle_rate + self.error_rate:
+            self.count("errors")
+            return 500, b"Internal server error", "text/plain", {}
+        output = payload.get("output", {})
+        evalscript = payload.get("evalscript", "")
+        bands = re.search(r"bands\s*:\s*(\d+)", evalscript)
+        sample_type = re.search(r"sampleType\s*:\s*\"?(\w+)", evalscript)
+        shape = (
+            output.get("width", 512),
+            output.get("height", 512),
+            int(bands.group(1)) if bands else 1,
+            sample_type.group(1).upper() if sample_type else "AUTO",
+        )
+        content = self.response(shape)
+        self.count("bytes", len(content))
+        return 200, content, "image/tiff", {}
+
+    def response(self, shape: Tuple[int, int, int, str]) -> bytes:
+        with self._lock:
+            if shape not in self._responses:
+                width, height, bands, _ = shape
+                data, dtype = synthetic_image(1, width, height, bands, np.random.default_rng(0))
+                self._responses[shape] = raster_bytes(data, dtype)
+            return self._responses[shape]
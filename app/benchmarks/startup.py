@@ -0,0 +1,90 @@
+import argparse
+import json
+import logging
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Dict, List, Tuple
+
+from utils import set_logging
+
+set_logging()
+logger = logging.getLogger(__name__)
+
+APP_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# Modules a short run imports before doing any work
+MODULES = ["main", "batch", "scripts.download"]
+# Libraries that must not be imported by a run that only downloads
+HEAVY_LIBRARIES = ["pandas", "rasterio", "sklearn", "statsmodels", "pmdarima", "matplotlib", "scipy"]
+NOOP_CONFIG = {"name_id": "startup_benchmark", "download": {"enabled": False}, "train": {"enabled": False}}
+
+
+def run(command: List[str]) -> Tuple[float, str]:
+    start = time.perf_counter()
+    result = subprocess.run(command, cwd=APP_PATH, capture_output=True, text=True)
+    seconds = time.perf_counter() - start
+    if result.returncode != 0:
+        raise RuntimeError(f"{' '.join(command)} failed:\n{result.stderr}")
+    return seconds, result.stdout
+
+
+def slowest_imports(module: str, count: int = 10) -> List[Tuple[str, float]]:
+    """Cumulative import time of the slowest top-level imports of a module, from python -X importtime"""
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"], cwd=APP_PATH, capture_output=True, text=True
+    )
+    imports = []
+    for line in result.stderr.splitlines():
+        parts = line.split("|")
+        if len(parts) != 3 or not parts[1].strip().isdigit():
+            continue
+        # The module is indented by one space and what it imports directly by three
+        if len(parts[2]) - len(parts[2].lstrip()) <= 3:
+            imports.append((parts[2].strip(), int(parts[1]) / 1e6))
+    return sorted(imports, key=lambda i: i[1], reverse=True)[:count]
+
+
+def benchmark(repeat: int = 5) -> Dict[str, Dict[str, float]]:
+    """Median wall time of importing every module and of a main run with nothing enabled, each in a new
+    interpreter, together with the heavy libraries a download-only run imported"""
+    results = {}
+    for module in MODULES:
+        times = [run([sys.executable, "-c", f"import {module}"])[0] for _ in range(repeat)]
+        results[f"import {module}"] = {"median": statistics.median(times), "min": min(times)}
+    with tempfile.NamedTemporaryFile("w", suffix=".json", delete=False) as f:
+        json.dump(NOOP_CONFIG, f)
+    try:
+        times = [run([sys.executable, "main.py", "-c", f.name])[0] for _ in range(repeat)]
+        results["main noop"] = {"median": statistics.median(times), "min": min(times)}
+    finally:
+        os.remove(f.name)
+    check = f"import sys, main, scripts.download; print(','.join(m for m in {HEAVY_LIBRARIES} if m in sys.modules))"
+    _, imported = run([sys.executable, "-c", check])
+    results["heavy libraries"] = {"imported": imported.strip()}
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measure the startup time of the command line entry points")
+    parser.add_argument("--repeat", type=int, default=5, help="Runs of every measurement, the median is kept")
+    parser.add_argument("--budget", type=float, default=1.0, help="Seconds a short run may take to start")
+    parser.add_argument("--output", type=str, help="Write the results to this JSON file")
+    args = parser.parse_args()
+    results = benchmark(args.repeat)
+    for name, result in results.items():
+        logger.info(f"{name}: {result}")
+    if args.output:
+        with open(args.output + ".tmp", "w") as f:
+            json.dump(results, f, indent=2)
+        os.replace(args.output + ".tmp", args.output)
+    failures = [name for name, result in results.items() if result.get("median", 0) > args.budget]
+    if results["heavy libraries"]["imported"]:
+        failures.append("heavy libraries")
+    if failures:
+        for name, seconds in slowest_imports("main"):
+            logger.info(f"{seconds:8.3f}s  {name}")
+        logger.error(f"Startup over budget or importing heavy libraries: {failures}")
+        sys.exit(1)
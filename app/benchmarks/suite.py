@@ -0,0 +1,358 @@
+import argparse
+import glob
+import json
+import logging
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from configuration.configuration import Configuration
+from utils import set_logging
+
+set_logging()
+logger = logging.getLogger(__name__)
+
+APP_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BENCHMARKS = ["download", "ingest", "kpis", "models", "visualization"]
+# Every output the pipeline writes is redirected to the work directory of the run
+PATH_VARIABLES = {
+    "GEOTIFFS_PATH": "geotiffs",
+    "TILES_PATH": "tiles",
+    "PNGS_PATH": "pngs",
+    "MANIFESTS_PATH": "manifests",
+    "CACHE_PATH": "cache",
+    "MODELS_PATH": "models",
+    "VISUALIZATIONS_PATH": "visualizations",
+    "MODEL_STORE_PATH": "model_store",
+    "REPORTS_PATH": "reports",
+}
+CLIENT_ID_ENV = "BENCHMARK_CLIENT_ID"
+CLIENT_SECRET_ENV = "BENCHMARK_CLIENT_SECRET"
+ARCHIVE_ID = "benchmark_archive"
+DOWNLOAD_ID = "benchmark_download"
+KPI = "mean"
+KPIS = ["mean", "std", "min", "max", "p10", "p90", "valid_fraction"]
+START_DATE = datetime(2018, 1, 1)
+DEFAULT_MODEL_PARAMS = {"sarima": {"m": 12, "search": "stepwise"}, "random_forest": {"n_estimators": 50}}
+
+# Models fitted by the models benchmark, plotted by the visualization benchmark instead of fitting them again
+_trained: List[Tuple[str, Any]] = []
+
+
+def measure(function: Callable[[], Any], repeat: int, setup: Optional[Callable[[], None]] = None) -> Dict[str, Any]:
+    """Median and minimum wall time of `repeat` calls, each after an untimed setup, and the last result"""
+    runs = []
+    result = None
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        result = function()
+        runs.append(time.perf_counter() - start)
+    return {"median": statistics.median(runs), "min": min(runs), "runs": runs, "result": result}
+
+
+def git_revision() -> Tuple[Optional[str], Optional[bool]]:
+    """Short commit hash of the tree being measured and whether it has uncommitted changes"""
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=APP_PATH, capture_output=True, text=True, check=True
+        ).stdout.strip()
+        status = subprocess.run(
+            ["git", "status", "--porcelain", "--untracked-files=no"], cwd=APP_PATH, capture_output=True, text=True
+        ).stdout
+        return commit, bool(status.strip())
+    except (OSError, subprocess.CalledProcessError):
+        return None, None
+
+
+def prepare_workdir(workdir: str) -> None:
+    for variable, folder in PATH_VARIABLES.items():
+        os.environ[variable] = os.path.join(workdir, folder, "")
+    os.environ.setdefault(CLIENT_ID_ENV, "benchmark")
+    os.environ.setdefault(CLIENT_SECRET_ENV, "benchmark")
+    # The paths were resolved with the environment of the first parse
+    Configuration.clear()
+
+
+def benchmark_download(args: argparse.Namespace) -> Dict[str, Any]:
+    """Download `windows` weekly rasters from the mock Process API with the production downloader"""
+    from benchmarks.mock_api import MockProcessApi
+    from benchmarks.synthetic import BBOX
+    from dateutil.relativedelta import relativedelta
+    from scripts.download import download, remove_previous_download
+
+    with MockProcessApi(
+        latency=args.latency,
+        jitter=args.jitter,
+        error_rate=args.error_rate,
+        throttle_rate=args.throttle_rate,
+        retry_after=args.retry_after,
+    ) as api:
+        measured = measure(
+            lambda: download(
+                bbox=BBOX,
+                evalscript="ndvi" if args.bands == 1 else "raw_bands",
+                start_date=START_DATE,
+                end_date=START_DATE + relativedelta(weeks=args.windows),
+                date_interval=relativedelta(weeks=1),
+                name_id=DOWNLOAD_ID,
+                url=api.url,
+                token_url=api.token_url,
+                client_id_env=CLIENT_ID_ENV,
+                client_secret_env=CLIENT_SECRET_ENV,
+                workers=args.workers,
+                max_retries=args.max_retries,
+                backoff_factor=0.01,
+            ),
+            args.repeat,
+            setup=lambda: remove_previous_download(DOWNLOAD_ID),
+        )
+        summary = measured.pop("result")
+        measured.update(
+            {
+                "images_per_second": args.windows / measured["median"],
+                "megabytes_per_second": summary["bytes"] / measured["median"] / 1e6,
+                "errors": summary["errors"],
+                "retries": summary["retries"],
+                "server": dict(api.counters),
+            }
+        )
+    return {"download": measured}
+
+
+def prepare_archive(args: argparse.Namespace) -> Any:
+    """Write the synthetic archive, if missing, and return the index computed from its raw bands, if any"""
+    from benchmarks.synthetic import generate_archive
+    from scripts.indices import parse_to_spectral_index
+
+    generate_archive(ARCHIVE_ID, args.weeks, args.size, args.bands, start_date=START_DATE)
+    return parse_to_spectral_index("ndvi") if args.bands > 1 else None
+
+
+def benchmark_ingest(args: argparse.Namespace) -> Dict[str, Any]:
+    """Look the archive up with tifs_to_array and reduce it to the KPI dataframe with the streaming path"""
+    from dateutil.relativedelta import relativedelta
+    from main import build_dataframe
+    from utils.process_data import tifs_to_array
+
+    spectral_index = prepare_archive(args)
+    train_config = {"kpi": KPI, "kpis": KPIS, "streaming": True, "decode_workers": args.workers}
+    lookup = measure(lambda: tifs_to_array(ARCHIVE_ID, START_DATE, relativedelta(weeks=1), "weeks"), args.repeat)
+    tiffs, time_values = lookup.pop("result")
+    ingest = measure(
+        lambda: build_dataframe(ARCHIVE_ID, tiffs, time_values, train_config, spectral_index), args.repeat
+    )
+    ingest.pop("result")
+    ingest["rasters_per_second"] = len(tiffs) / ingest["median"]
+    return {"tifs_to_array": lookup, "ingest": ingest}
+
+
+def benchmark_kpis(args: argparse.Namespace) -> Dict[str, Any]:
+    """Compute every KPI of an in-memory (weeks, size, size) cube, without any decoding"""
+    import numpy as np
+    from benchmarks.synthetic import synthetic_ndvi
+    from utils.process_data import create_dataframe
+
+    rng = np.random.default_rng(0)
+    cube = np.stack([synthetic_ndvi(week % 52, args.size, args.size, rng) for week in range(args.weeks)])
+    time_values = np.arange(args.weeks) % 52 + 1
+    measured = measure(lambda: create_dataframe(cube, time_values, KPI, KPIS), args.repeat)
+    measured.pop("result")
+    measured["pixels_per_second"] = cube.size / measured["median"]
+    return {"kpis": measured}
+
+
+def train_models(args: argparse.Namespace, df: Any, timed: bool) -> Tuple[List[Any], Dict[str, Any]]:
+    from models.registry import MODELS, get_model_class
+
+    model_params = {**DEFAULT_MODEL_PARAMS, **json.loads(args.model_params)}
+    models, results = [], {}
+    for name in args.models or list(MODELS):
+        model_class = get_model_class(name)
+        model = model_class(df, KPI, model_params.get(name) or {})
+        model.name_id = ARCHIVE_ID
+        if timed:
+            train = measure(model.train_model, args.repeat)
+            train.pop("result")
+            predict = measure(lambda: model.predict(None), args.repeat)
+            predict.pop("result")
+            results[f"train {name}"] = train
+            results[f"predict {name}"] = predict
+        else:
+            model.train_model()
+        models.append((name, model))
+    return models, results
+
+
+def archive_dataframe(args: argparse.Namespace) -> Any:
+    from dateutil.relativedelta import relativedelta
+    from main import build_dataframe
+    from utils.process_data import tifs_to_array
+
+    spectral_index = prepare_archive(args)
+    tiffs, time_values = tifs_to_array(ARCHIVE_ID, START_DATE, relativedelta(weeks=1), "weeks")
+    return build_dataframe(ARCHIVE_ID, tiffs, time_values, {"kpi": KPI, "kpis": KPIS}, spectral_index)
+
+
+def benchmark_models(args: argparse.Namespace) -> Dict[str, Any]:
+    """Train and predict with every registered model on the KPI series of the archive"""
+    models, results = train_models(args, archive_dataframe(args), timed=True)
+    _trained[:] = models
+    return results
+
+
+def benchmark_visualization(args: argparse.Namespace) -> Dict[str, Any]:
+    """Plot every trained model as run_visualization does"""
+    models = list(_trained) or train_models(args, archive_dataframe(args), timed=False)[0]
+    visualizations_path = str(Configuration()["visualizations_path"])
+    os.makedirs(visualizations_path, exist_ok=True)
+    results = {}
+    for name, model in models:
+        path = os.path.join(visualizations_path, f"{ARCHIVE_ID}_{model.__class__.__name__}.png")
+        measured = measure(lambda: model.save_visualization(path, ARCHIVE_ID, "weeks"), args.repeat)
+        measured.pop("result")
+        results[f"visualize {name}"] = measured
+    return results
+
+
+def run(args: argparse.Namespace) -> Dict[str, Any]:
+    from utils.model_store import library_versions
+
+    functions = {
+        "download": benchmark_download,
+        "ingest": benchmark_ingest,
+        "kpis": benchmark_kpis,
+        "models": benchmark_models,
+        "visualization": benchmark_visualization,
+    }
+    commit, dirty = git_revision()
+    parameters = {
+        key: value for key, value in vars(args).items() if key not in ("command", "output", "keep", "workdir")
+    }
+    results = {
+        "commit": commit,
+        "dirty": dirty,
+        "created_at": datetime.now().isoformat(),
+        "machine": {
+            "platform": platform.platform(),
+            "processor": platform.processor() or platform.machine(),
+            "cpus": os.cpu_count(),
+        },
+        "libraries": library_versions(),
+        "parameters": parameters,
+        "benchmarks": {},
+    }
+    workdir = args.workdir or tempfile.mkdtemp(prefix="benchmark_")
+    prepare_workdir(workdir)
+    try:
+        for name in args.only or BENCHMARKS:
+            logger.info(f"Running the {name} benchmark")
+            for benchmark, result in functions[name](args).items():
+                logger.info(f"{benchmark}: median {result['median']:.4f}s, min {result['min']:.4f}s")
+                results["benchmarks"][benchmark] = result
+    finally:
+        if not args.keep and not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+    return results
+
+
+def write_results(results: Dict[str, Any], output: Optional[str] = None) -> str:
+    """Write the results where `compare` finds them, named after the time and commit of the run"""
+    if output is None:
+        benchmarks_path = str(Configuration()["benchmarks_path"])
+        os.makedirs(benchmarks_path, exist_ok=True)
+        name = datetime.now().strftime("%Y%m%dT%H%M%S") + "_" + (results["commit"] or "unknown")
+        if results["dirty"]:
+            name += "_dirty"
+        output = os.path.join(benchmarks_path, name + ".json")
+    with open(output + ".tmp", "w") as f:
+        json.dump(results, f, indent=2)
+    os.replace(output + ".tmp", output)
+    logger.info(f"Benchmark results written to {output}")
+    return output
+
+
+def compare(base_path: str, head_path: str, threshold: float) -> List[str]:
+    """Log the change of every benchmark measured in both files and return those slower by more than
+    `threshold` percent"""
+    with open(base_path, "r") as f:
+        base = json.load(f)
+    with open(head_path, "r") as f:
+        head = json.load(f)
+    logger.info(f"Comparing {base['commit']} ({base_path}) with {head['commit']} ({head_path})")
+    if base["parameters"] != head["parameters"]:
+        logger.warning("The runs were made with different parameters, their times are not comparable")
+    if base["machine"] != head["machine"]:
+        logger.warning("The runs were made on different machines")
+    regressions = []
+    for name, result in head["benchmarks"].items():
+        if name not in base["benchmarks"]:
+            continue
+        before, after = base["benchmarks"][name]["median"], result["median"]
+        change = (after - before) / before * 100 if before else 0.0
+        logger.info(f"{name:<28} {before:10.4f}s {after:10.4f}s {change:+8.1f}%")
+        if change > threshold:
+            regressions.append(name)
+    return regressions
+
+
+def latest_results(count: int) -> List[str]:
+    benchmarks_path = str(Configuration()["benchmarks_path"])
+    return sorted(glob.glob(os.path.join(benchmarks_path, "*.json")), key=os.path.getmtime)[-count:]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Offline benchmarks of the pipeline on synthetic rasters")
+    commands = parser.add_subparsers(dest="command", required=True)
+    run_parser = commands.add_parser("run", help="Run the benchmarks and store their results")
+    run_parser.add_argument("--only", nargs="+", choices=BENCHMARKS, help="Benchmarks to run, all by default")
+    run_parser.add_argument("--weeks", type=int, default=156, help="Weekly rasters in the synthetic archive")
+    run_parser.add_argument("--size", type=int, default=256, help="Width and height of the rasters, in pixels")
+    run_parser.add_argument("--bands", type=int, default=1, choices=[1, 5], help="1 (NDVI) or 5 (raw bands)")
+    run_parser.add_argument("--windows", type=int, default=52, help="Date windows downloaded from the mock API")
+    run_parser.add_argument("--workers", type=int, default=4, help="Download and decode workers")
+    run_parser.add_argument("--latency", type=float, default=0.05, help="Seconds the mock API takes per request")
+    run_parser.add_argument("--jitter", type=float, default=0.0, help="Random extra latency, in seconds")
+    run_parser.add_argument("--error_rate", type=float, default=0.0, help="Fraction of requests failing with 500")
+    run_parser.add_argument("--throttle_rate", type=float, default=0.0, help="Fraction of requests answered 429")
+    run_parser.add_argument("--retry_after", type=float, default=0.1, help="Retry-After of the 429 answers")
+    run_parser.add_argument("--max_retries", type=int, default=3, help="Retries of the downloader")
+    run_parser.add_argument("--models", nargs="+", help="Registered models to benchmark, all by default")
+    run_parser.add_argument("--model_params", type=str, default="{}", help="JSON model_params merged over defaults")
+    run_parser.add_argument("--repeat", type=int, default=3, help="Runs of every measurement, the median is kept")
+    run_parser.add_argument("--workdir", type=str, help="Keep the rasters and outputs in this directory")
+    run_parser.add_argument("--keep", action="store_true", help="Do not remove the temporary work directory")
+    run_parser.add_argument("--output", type=str, help="Write the results to this file instead")
+    compare_parser = commands.add_parser("compare", help="Compare two stored results, the latest two by default")
+    compare_parser.add_argument("base", nargs="?", help="Results of the reference commit")
+    compare_parser.add_argument("head", nargs="?", help="Results of the commit being checked")
+    compare_parser.add_argument("--threshold", type=float, default=10.0, help="Slowdown in percent to report")
+    compare_parser.add_argument("--fail_on_regression", action="store_true", help="Exit with 1 on regressions")
+    args = parser.parse_args()
+
+    if args.command == "run":
+        write_results(run(args), args.output)
+    else:
+        # A single file given is compared with the latest results
+        paths = [args.base or "", args.head or ""]
+        latest = latest_results(2)
+        if not args.base:
+            paths = latest
+        elif not args.head:
+            paths[1] = latest[-1] if latest else ""
+        if len(paths) < 2 or not all(paths):
+            logger.error("Two benchmark results are needed to compare")
+            sys.exit(1)
+        regressions = compare(paths[0], paths[1], args.threshold)
+        if regressions:
+            logger.warning(f"Slower by more than {args.threshold}%: {regressions}")
+            if args.fail_on_regression:
+                sys.exit(1)
@@ -0,0 +1,96 @@
+import logging
+import os
+from datetime import datetime
+from typing import List, Optional, Tuple
+
+import numpy as np
+from configuration.configuration import Configuration
+from dateutil.relativedelta import relativedelta
+from rasterio.io import MemoryFile
+from rasterio.transform import from_bounds
+from scripts.indices import RAW_BANDS
+from utils import set_logging
+from utils.tiling import normalize_bbox
+
+set_logging()
+logger = logging.getLogger(__name__)
+
+# Same area as the isla_mayor configurations
+BBOX = [-6.158491, 37.131489, -6.133836, 37.114921]
+# Fraction of pixels flagged as nodata in every raw band raster
+CLOUD_FRACTION = 0.1
+
+
+def synthetic_ndvi(week: float, width: int, height: int, rng: np.random.Generator) -> np.ndarray:
+    """Seasonal NDVI with a phase shifted across the scene and some noise, in [-1, 1]"""
+    y, x = np.mgrid[0:height, 0:width]
+    phase = 2 * np.pi * (x / max(width, 1) + y / max(height, 1)) / 4
+    ndvi = 0.45 + 0.3 * np.sin(2 * np.pi * week / 52 + phase) + rng.normal(0, 0.05, (height, width))
+    return np.clip(ndvi, -1, 1).astype(np.float32)
+
+
+def synthetic_image(
+    week: float, width: int, height: int, bands: int, rng: np.random.Generator
+) -> Tuple[np.ndarray, str]:
+    """A raster as the evalscripts return it: one uint8 NDVI band (ndvi.js) or the raw reflectances and
+    data mask of raw_bands.js as float32"""
+    ndvi = synthetic_ndvi(week, width, height, rng)
+    if bands == 1:
+        return np.round((ndvi + 1) / 2 * 255).astype(np.uint8)[None], "uint8"
+    if bands != len(RAW_BANDS):
+        raise ValueError(f"Synthetic rasters have 1 band (an index) or {len(RAW_BANDS)} ({', '.join(RAW_BANDS)})")
+    red = rng.uniform(0.03, 0.08, (height, width)).astype(np.float32)
+    nir = red * (1 + ndvi) / np.maximum(1 - ndvi, 1e-3)
+    green = red * 1.2
+    swir = red * 2.5
+    mask = (rng.random((height, width)) >= CLOUD_FRACTION).astype(np.float32)
+    return np.stack([green, red, nir, swir, mask]).astype(np.float32), "float32"
+
+
+def raster_bytes(data: np.ndarray, dtype: str, bbox: List[float] = BBOX) -> bytes:
+    """Encode a (band, height, width) array as an in-memory GeoTIFF"""
+    bands, height, width = data.shape
+    profile = {
+        "driver": "GTiff",
+        "dtype": dtype,
+        "count": bands,
+        "width": width,
+        "height": height,
+        "crs": "EPSG:4326",
+        "transform": from_bounds(*normalize_bbox(bbox), width, height),
+    }
+    with MemoryFile() as memory_file:
+        with memory_file.open(**profile) as dst:
+            dst.write(data)
+        return memory_file.read()
+
+
+def generate_archive(
+    name_id: str,
+    weeks: int,
+    size: int,
+    bands: int = 1,
+    start_date: datetime = datetime(2018, 1, 1),
+    geotiffs_path: Optional[str] = None,
+    seed: int = 0,
+) -> List[str]:
+    """Write `weeks` weekly size x size rasters where Downloader.get_image_path puts the downloads of
+    name_id, named after their date windows, and return their paths. Existing files are kept"""
+    geotiffs_path = geotiffs_path or str(Configuration()["geotiffs_path"])
+    folder = os.path.join(geotiffs_path, name_id)
+    os.makedirs(folder, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    paths = []
+    for week in range(weeks):
+        date_start = start_date + relativedelta(weeks=week)
+        date_end = date_start + relativedelta(weeks=1)
+        path = os.path.join(folder, date_start.strftime("%Y-%m-%d") + "_" + date_end.strftime("%Y-%m-%d") + ".tif")
+        paths.append(path)
+        if os.path.exists(path):
+            continue
+        data, dtype = synthetic_image(date_start.isocalendar()[1], size, size, bands, rng)
+        # Written as the Process API response body is, like Downloader.download does
+        with open(path, "wb") as f:
+            f.write(raster_bytes(data, dtype))
+    logger.info(f"{weeks} synthetic {size}x{size} rasters of {bands} bands in {folder}")
+    return paths
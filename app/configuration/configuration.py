@@ -1,6 +1,8 @@
 import logging
 import os
-from typing import Union, Any
+import threading
+from typing import Any, Dict, Union
+
 from pyhocon import ConfigFactory, ConfigTree
 from utils import set_logging
 
@@ -12,10 +14,22 @@ logger = logging.getLogger(__name__)
 class Configuration:
     data: Union[ConfigTree, Any]
     CONFIG_ENV_VAR = "CONFIG_PATH"
+    # Parsed files shared by every instance, each file is parsed once per process
+    _cache: Dict[str, ConfigTree] = {}
+    _lock = threading.Lock()
 
     def __init__(self, config_filename=None):
         self.config_filename = config_filename or os.getenv(self.CONFIG_ENV_VAR, "./resources/config/application.conf")
-        self.data = ConfigFactory.parse_file(self.config_filename)
+        with self._lock:
+            if self.config_filename not in self._cache:
+                self._cache[self.config_filename] = ConfigFactory.parse_file(self.config_filename)
+            self.data = self._cache[self.config_filename]
+
+    @classmethod
+    def clear(cls) -> None:
+        """Forget the parsed files, the next instances parse them again"""
+        with cls._lock:
+            cls._cache.clear()
 
     def __getitem__(self, item):
         value = self.data[item]
@@ -2,19 +2,25 @@ import argparse
 import json
 import logging
 import os
-import shutil
 from datetime import datetime
-from importlib import import_module
+from typing import TYPE_CHECKING, Any, Dict, List, Optional
 
-import numpy as np
 from configuration.configuration import Configuration
 from dateutil.relativedelta import relativedelta
-from numpy.core.multiarray import ndarray
-from pandas import DataFrame
-from rasterio import rasterio
-from scripts.download import download
+from models.registry import get_model_class
 from utils import set_logging
-from utils.process_data import create_dataframe, tifs_to_array
+from utils.instrumentation import instrumented, recorder, stage
+
+if TYPE_CHECKING:
+    from models.ml_model import Model
+    from numpy import ndarray
+    from pandas import DataFrame
+    from scripts.indices import SpectralIndex
+    from utils.downloader import Downloader
+    from utils.series_cache import SeriesCache
+
+# The stages import their dependencies when they run, so a download-only run never imports the
+# raster, dataframe and model libraries
 
 set_logging()
 logger = logging.getLogger(__name__)
@@ -28,123 +34,380 @@ def parse_date_interval(interval_type, date_interval) -> relativedelta:
     return date_interval
 
 
-def init_models(model_names: str, df: DataFrame, kpi: slice, model_params: dict):
+def init_models(
+    model_names: str,
+    df: "DataFrame",
+    kpi: slice,
+    model_params: dict,
+    name_id: str = None,
+    interval_type: str = "weeks",
+):
     models = []
     for model_name in model_names:
         try:
-            module_name = "".join([word.capitalize() for word in model_name.split("_")])
-            module = import_module(f"models.{model_name}")
-            model = getattr(module, f"{module_name}Model")
-            models.append(model(df, kpi, model_params.get(model_name)))
+            model_class = get_model_class(model_name)
+            model = model_class(df, kpi, model_params.get(model_name) or {})
+            model.name_id = name_id
+            model.interval_type = interval_type
+            models.append(model)
         except (AttributeError, ImportError):
             logger.error(f"Model {model_name} not found")
     return models
 
 
-def main(config_file):
-    configuration = Configuration()
-    GEOTIFFS_PATH: str = str(configuration["geotiffs_path"])
-    with open(config_file, "r") as f:
-        config = json.load(f)
+def build_dataframe(
+    name_id: str,
+    tiffs: "ndarray",
+    time_values: "ndarray",
+    train_config: dict,
+    spectral_index: Optional["SpectralIndex"] = None,
+) -> "DataFrame":
+    """Compute the KPI dataframe of the rasters with the ingestion path chosen in the train config"""
+    import numpy as np
+    import rasterio
+    from utils.process_data import (
+        create_dataframe,
+        datacube_dataframe,
+        stream_dataframe,
+        tifs_to_datacube,
+        tifs_to_index_cube,
+    )
 
-    interval_type = config.get("interval_type", "weeks")
-    date_interval = config.get("date_interval", 1)
-    parsed_date_interval = parse_date_interval(interval_type, date_interval)
-    name_id = config.get("name_id")
-    download_config = config.get("download")
-    if download_config.get("enabled"):
-        if download_config.get("remove_previous_download"):
-            shutil.rmtree(GEOTIFFS_PATH + config.get("name_id"))
-            logger.info("Previous download removed")
-        logger.info("Downloading images...")
-        start_date = datetime.strptime(download_config.get("start_date"), "%Y-%m-%d")
-        end_date = datetime.strptime(download_config.get("end_date"), "%Y-%m-%d")
-        logger.info("Dates: {} - {}".format(start_date, end_date))
-        download(
-            bbox=download_config.get("bbox"),
-            evalscript=download_config.get("evalscript"),
-            start_date=start_date,
-            end_date=end_date,
-            date_interval=parsed_date_interval,
-            name_id=name_id,
-            format=download_config.get("format"),
-            url=download_config.get("url"),
-            satellite_type=download_config.get("satellite_type"),
-            data_filter=download_config.get("data_filter"),
-            token_url=download_config.get("token_url"),
-            client_id_env=download_config.get("client_id_env"),
-            client_secret_env=download_config.get("client_secret_env"),
+    kpi = train_config.get("kpi")
+    kpis = train_config.get("kpis")
+    if train_config.get("datacube"):
+        cube, mask = tifs_to_datacube(name_id, list(tiffs), spectral_index)
+        return datacube_dataframe(cube, mask, time_values, kpi, kpis, spectral_index)
+    elif train_config.get("streaming", True):
+        return stream_dataframe(
+            tiffs,
+            time_values,
+            kpi,
+            kpis,
+            spectral_index,
+            read_by_blocks=train_config.get("read_by_blocks", False),
+            workers=train_config.get("decode_workers", 1),
+            executor=train_config.get("decode_executor", "process"),
         )
+    else:
+        if spectral_index is not None:
+            normalized_data = tifs_to_index_cube(tiffs, spectral_index)
+        else:
+            data = []
+            for tif in tiffs:
+                with rasterio.open(tif) as src:
+                    data.append(src.read())
 
-    train_config = config.get("train")
-    if (
+            data = np.array(data)  # (image, bands, height, width)
+            data = data.reshape(
+                data.shape[0], data.shape[2], data.shape[3]
+            )  # (image, height, width)
+            normalized_data = data / 255
+        logger.info("Data shape: {}".format(normalized_data.shape))
+        return create_dataframe(normalized_data, time_values, kpi, kpis)
+
+
+def train_requested(train_config: Optional[dict]) -> bool:
+    train_config = train_config or {}
+    return bool(
         train_config.get("enabled")
         or train_config.get("save_model")
         or train_config.get("save_visualization")
         or train_config.get("predict")
+    )
+
+
+class IngestedData:
+    """Rasters of a configuration and the KPI dataframe computed from them, shared by the later stages"""
+
+    def __init__(
+        self,
+        tiffs: "ndarray",
+        time_values: "ndarray",
+        spectral_index: Optional["SpectralIndex"],
+        df: "DataFrame",
+        previous_df: Optional["DataFrame"] = None,
+        new_df: Optional["DataFrame"] = None,
+        series_cache: Optional["SeriesCache"] = None,
+        zonal_df: Optional["DataFrame"] = None,
     ):
-        logger.info("Training models...")
-        start_date = datetime.strptime(train_config.get("start_date"), "%Y-%m-%d")
-        tiffs, time_values = tifs_to_array(
-            name_id, start_date, parsed_date_interval, interval_type
+        self.tiffs: "ndarray" = tiffs
+        self.time_values: "ndarray" = time_values
+        self.spectral_index: Optional["SpectralIndex"] = spectral_index
+        self.df: "DataFrame" = df
+        self.previous_df: Optional["DataFrame"] = previous_df
+        self.new_df: Optional["DataFrame"] = new_df
+        self.series_cache: Optional["SeriesCache"] = series_cache
+        self.zonal_df: Optional["DataFrame"] = zonal_df
+
+
+def run_download(config: dict, session_owner: Optional["Downloader"] = None) -> Optional[Dict[str, Any]]:
+    name_id = config.get("name_id")
+    download_config = config.get("download") or {}
+    if not download_config.get("enabled"):
+        return None
+    from scripts.download import download, remove_previous_download
+
+    if download_config.get("remove_previous_download"):
+        remove_previous_download(name_id)
+    logger.info("Downloading images...")
+    start_date = datetime.strptime(download_config.get("start_date"), "%Y-%m-%d")
+    end_date = datetime.strptime(download_config.get("end_date"), "%Y-%m-%d")
+    logger.info("Dates: {} - {}".format(start_date, end_date))
+    return download(
+        bbox=download_config.get("bbox"),
+        evalscript=download_config.get("evalscript"),
+        start_date=start_date,
+        end_date=end_date,
+        date_interval=parse_date_interval(config.get("interval_type", "weeks"), config.get("date_interval", 1)),
+        name_id=name_id,
+        format=download_config.get("format"),
+        url=download_config.get("url"),
+        satellite_type=download_config.get("satellite_type"),
+        data_filter=download_config.get("data_filter"),
+        token_url=download_config.get("token_url"),
+        client_id_env=download_config.get("client_id_env"),
+        client_secret_env=download_config.get("client_secret_env"),
+        workers=download_config.get("workers", 1),
+        max_retries=download_config.get("max_retries", 3),
+        backoff_factor=download_config.get("backoff_factor", 1.0),
+        verify_checksums=download_config.get("verify_checksums", False),
+        rate_limit=download_config.get("rate_limit"),
+        tiling=download_config.get("tiling"),
+        timestamps_per_request=download_config.get("timestamps_per_request", 1),
+        catalog=download_config.get("catalog"),
+        session_owner=session_owner,
+    )
+
+
+@instrumented()
+def ingest(config: dict, raster_id: Optional[str] = None) -> IngestedData:
+    """Find, screen and reduce the rasters of a configuration to its KPI dataframe.
+    `raster_id` reads the rasters downloaded under another name_id with identical download settings"""
+    import numpy as np
+    from pandas import concat
+    from scripts.indices import MASK_BAND, parse_to_spectral_index
+    from utils.process_data import tifs_to_array
+    from utils.screening import SceneScreener
+    from utils.series_cache import SeriesCache
+    from utils.zonal import ZoneMap, zonal_dataframe
+
+    configuration = Configuration()
+    interval_type = config.get("interval_type", "weeks")
+    parsed_date_interval = parse_date_interval(interval_type, config.get("date_interval", 1))
+    raster_id = raster_id or config.get("name_id")
+    train_config = config.get("train")
+    start_date = datetime.strptime(train_config.get("start_date"), "%Y-%m-%d")
+    end_date = None
+    if train_config.get("end_date"):
+        end_date = datetime.strptime(train_config.get("end_date"), "%Y-%m-%d")
+    tiffs, time_values = tifs_to_array(
+        raster_id,
+        start_date,
+        parsed_date_interval,
+        interval_type,
+        end_date=end_date,
+        gaps=train_config.get("gaps", "drop"),
+    )
+    spectral_index = None
+    if train_config.get("index"):
+        # Raw band rasters, the index is computed locally and is already in its natural range
+        spectral_index = parse_to_spectral_index(train_config.get("index"))
+        logger.info(f"Computing index {spectral_index.expression}")
+    screening_config = train_config.get("screening")
+    if screening_config:
+        mask_band = None
+        if spectral_index is not None and MASK_BAND in spectral_index.bands:
+            mask_band = spectral_index.bands.index(MASK_BAND)
+        screener = SceneScreener(
+            raster_id,
+            min_valid_fraction=screening_config.get("min_valid_fraction", 0.5),
+            min_file_size=screening_config.get("min_file_size", 0),
+            decimation=screening_config.get("decimation", 8),
+            mask_band=mask_band,
+            nodata=screening_config.get("nodata"),
         )
-        data = []
-        for tif in tiffs:
-            with rasterio.open(tif) as src:
-                data.append(src.read())
-
-        data = np.array(data)  # (image, bands, height, width)
-        data = data.reshape(
-            data.shape[0], data.shape[2], data.shape[3]
-        )  # (image, height, width)
-        logger.info("Data shape: {}".format(data[:, 0, 0]))
-        normalized_data: ndarray = np.nan_to_num(data, nan=0, posinf=0, neginf=0) / 255
-        df = create_dataframe(normalized_data, time_values, train_config.get("kpi"))
-        logger.info("Dataframe: \n{}".format(df))
-        model_params = train_config.get("model_params")
-        models = init_models(
-            train_config.get("models"), df, train_config.get("kpi"), model_params
+        accepted, _ = screener.screen(list(tiffs))
+        tiffs, time_values = tiffs[accepted], time_values[accepted]
+    kpi = train_config.get("kpi")
+    kpis = train_config.get("kpis")
+    series_cache = None
+    previous_df = None
+    new_df = None
+    if train_config.get("incremental"):
+        # Settings the cached series depends on, any change rebuilds it
+        settings = {key: train_config.get(key) for key in ["start_date", "kpi", "kpis", "index", "screening"]}
+        series_cache = SeriesCache(config.get("name_id"), settings)
+        new = series_cache.new_rasters([tif.name for tif in tiffs])
+        if new is not None:
+            new = np.array(new, dtype=bool)
+            previous_df = series_cache.df
+            new_df = previous_df.iloc[0:0]
+            if new.any():
+                new_df = build_dataframe(raster_id, tiffs[new], time_values[new], train_config, spectral_index)
+            df = concat([previous_df, new_df], ignore_index=True)
+            logger.info(f"{len(new_df)} new observations appended to the {len(previous_df)} cached")
+    if new_df is None:
+        df = build_dataframe(raster_id, tiffs, time_values, train_config, spectral_index)
+    logger.info("Dataframe: \n{}".format(df))
+    zonal_df = None
+    zones_config = train_config.get("zones")
+    if zones_config:
+        zone_map = ZoneMap(
+            os.path.join(str(configuration["zones_path"]), zones_config.get("file")),
+            id_property=zones_config.get("id_property"),
+            all_touched=zones_config.get("all_touched", False),
         )
-        if train_config.get("enabled"):
-            for model in models:
-                model.train_model()
-                model.evaluate()
-                if train_config.get("save_model"):
-                    models_path = str(configuration["models_path"])
-                    if not os.path.exists(models_path):
-                        os.makedirs(models_path)
-                        logger.info(f"Directory {models_path} created")
-                    model_path = os.path.join(
-                        models_path, f"{name_id}_{model.__class__.__name__}.sav"
-                    )
-                    model.save_model(model_path)
-        if train_config.get("load_model"):
+        zonal_df = zonal_dataframe(tiffs, time_values, zone_map, kpi, kpis, spectral_index)
+        logger.info("Zonal dataframe: \n{}".format(zonal_df))
+    return IngestedData(tiffs, time_values, spectral_index, df, previous_df, new_df, series_cache, zonal_df)
+
+
+@instrumented("train")
+def run_training(config: dict, data: IngestedData) -> List["Model"]:
+    """Save the zonal statistics, train, backtest and forecast the pixels of a configuration"""
+    from scripts.backtest import backtest_models
+    from scripts.pixel_forecast import forecast_pixels
+    from scripts.train import train_models, update_models
+    from utils.model_store import ModelStore
+
+    configuration = Configuration()
+    name_id = config.get("name_id")
+    train_config = config.get("train")
+    kpi = train_config.get("kpi")
+    if data.zonal_df is not None:
+        zonal_stats_path = str(configuration["zonal_stats_path"])
+        if not os.path.exists(zonal_stats_path):
+            os.makedirs(zonal_stats_path)
+            logger.info(f"Directory {zonal_stats_path} created")
+        data.zonal_df.to_csv(os.path.join(zonal_stats_path, f"{name_id}_zonal.csv"), index=False)
+    model_params = train_config.get("model_params") or {}
+    series_cache = data.series_cache
+    incremental = series_cache is not None and data.new_df is not None and train_config.get("enabled")
+    models = init_models(
+        train_config.get("models"),
+        data.previous_df if incremental else data.df,
+        kpi,
+        model_params,
+        name_id,
+        config.get("interval_type", "weeks"),
+    )
+    if train_config.get("enabled"):
+        model_paths = [None] * len(models)
+        if train_config.get("save_model"):
             models_path = str(configuration["models_path"])
             if not os.path.exists(models_path):
-                raise FileNotFoundError(f"Directory {models_path} not found")
-            for model in models:
-                model_path = os.path.join(
-                    models_path, f"{name_id}_{model.__class__.__name__}.sav"
-                )
-                model.model_fit = model.load_model(model_path)
-        if train_config.get("predict"):
-            for model in models:
-                model.predict(train_config.get("model_name"))
-        if train_config.get("save_visualization"):
-            visualizations_path = str(configuration["visualizations_path"])
-            if not os.path.exists(visualizations_path):
-                os.makedirs(visualizations_path)
-                logger.info(f"Directory {visualizations_path} created")
-            for model in models:
-                visualization_path = os.path.join(
-                    visualizations_path, f"{name_id}_{model.__class__.__name__}.png"
-                )
-                if os.path.exists(visualization_path):
-                    os.remove(visualization_path)
-                    logger.info(f"File {visualization_path} removed")
-                model.save_visualization(
-                    visualization_path, name_id, config.get("interval_type")
-                )
+                os.makedirs(models_path)
+                logger.info(f"Directory {models_path} created")
+            model_paths = [
+                os.path.join(models_path, f"{name_id}_{model.__class__.__name__}.sav") for model in models
+            ]
+        refits = list(range(len(models)))
+        if incremental:
+            refits = update_models(
+                models, data.new_df, model_paths, series_cache, refit_every=train_config.get("refit_every", 12)
+            )
+        store = None
+        store_config = train_config.get("model_store")
+        if store_config and store_config.get("enabled", True):
+            store = ModelStore(
+                max_size_mb=store_config.get("max_size_mb"),
+                max_age_days=store_config.get("max_age_days"),
+            )
+        train_models(
+            [models[i] for i in refits],
+            [model_paths[i] for i in refits],
+            workers=train_config.get("training_workers", 1),
+            store=store,
+        )
+        if series_cache is not None:
+            for i in refits:
+                series_cache.record_update(models[i].__class__.__name__, refit=True, rows=len(models[i].df))
+            # Only now every fit has seen the new rows, a run failing before reads them again
+            series_cache.save(data.df, [tif.name for tif in data.tiffs])
+    backtest_config = train_config.get("backtest")
+    if backtest_config:
+        # Fresh models, the backtest must not touch the fits trained above
+        candidates = init_models(
+            train_config.get("models"), data.df, kpi, model_params, name_id, config.get("interval_type", "weeks")
+        )
+        metrics = backtest_models(candidates, backtest_config)
+        backtests_path = str(configuration["backtests_path"])
+        if not os.path.exists(backtests_path):
+            os.makedirs(backtests_path)
+            logger.info(f"Directory {backtests_path} created")
+        metrics.to_csv(os.path.join(backtests_path, f"{name_id}_backtest.csv"), index=False)
+        logger.info("Backtest: \n{}".format(metrics.to_string(index=False)))
+    pixel_config = train_config.get("pixel_forecast")
+    if pixel_config:
+        forecast_pixels(
+            name_id,
+            data.tiffs,
+            data.time_values,
+            pixel_config,
+            data.spectral_index,
+            config.get("interval_type", "weeks"),
+        )
+    return models
+
+
+@instrumented("visualize")
+def run_visualization(config: dict, models: List["Model"]) -> None:
+    """Load, predict with and plot the models of a configuration"""
+    configuration = Configuration()
+    name_id = config.get("name_id")
+    train_config = config.get("train")
+    if train_config.get("load_model"):
+        models_path = str(configuration["models_path"])
+        if not os.path.exists(models_path):
+            raise FileNotFoundError(f"Directory {models_path} not found")
+        for model in models:
+            model_path = os.path.join(
+                models_path, f"{name_id}_{model.__class__.__name__}.sav"
+            )
+            model.model_fit = model.load_model(model_path)
+    if train_config.get("predict"):
+        for model in models:
+            model.predict(train_config.get("model_name"))
+    if train_config.get("save_visualization"):
+        visualizations_path = str(configuration["visualizations_path"])
+        if not os.path.exists(visualizations_path):
+            os.makedirs(visualizations_path)
+            logger.info(f"Directory {visualizations_path} created")
+        for model in models:
+            visualization_path = os.path.join(
+                visualizations_path, f"{name_id}_{model.__class__.__name__}.png"
+            )
+            if os.path.exists(visualization_path):
+                os.remove(visualization_path)
+                logger.info(f"File {visualization_path} removed")
+            model.save_visualization(
+                visualization_path, name_id, config.get("interval_type")
+            )
+
+
+def main(config_file):
+    with open(config_file, "r") as f:
+        config = json.load(f)
+
+    instrumentation_config = config.get("instrumentation")
+    if instrumentation_config:
+        recorder.reset(
+            config.get("name_id"),
+            profile=instrumentation_config.get("profile"),
+            trace_memory=instrumentation_config.get("trace_memory"),
+        )
+    try:
+        with stage("main"):
+            run_download(config)
+            if train_requested(config.get("train") or {}):
+                logger.info("Training models...")
+                data = ingest(config)
+                models = run_training(config, data)
+                run_visualization(config, models)
+    finally:
+        if instrumentation_config:
+            recorder.write(str(Configuration()["reports_path"]))
 
 
 if __name__ == "__main__":
@@ -1,15 +1,14 @@
 import logging
-from typing import Dict, List
+from typing import Dict
 
-from dotenv import load_dotenv
+import numpy as np
 from matplotlib import pyplot as plt
-from pandas import DataFrame
+from pandas import DataFrame, concat
 from models.ml_model import Model
-from sklearn.model_selection import train_test_split
 from statsmodels.tsa.arima.model import ARIMA, ARIMAResults
-from utils import set_logging
+from utils import load_environment, set_logging
 
-load_dotenv()
+load_environment()
 set_logging()
 logger = logging.getLogger(__name__)
 
@@ -23,16 +22,41 @@ class ArimaModel(Model):
     def train_model(self) -> None:
         logger.info("Training {}...".format(self.__class__.__name__))
 
-        self.train, self.test = train_test_split(self.df, test_size=0.2, shuffle=False)
-        self.train: List = self.train
-        self.test: List = self.test
+        self.split()
+        self.fit(self.train)
+
+        logger.info("Training complete.")
+
+    def fit(self, train: DataFrame) -> None:
         p = self.model_params.get("p", 5)
         d = self.model_params.get("d", 1)
         q = self.model_params.get("q", 0)
-        model: ARIMA = ARIMA(self.train[self.kpi], order=(p, d, q))
+        model: ARIMA = ARIMA(train[self.kpi].to_numpy(), order=(p, d, q))
         self.model_fit: ARIMAResults = model.fit()
+        self.sample = self.sample_of(train)
 
-        logger.info("Training complete.")
+    def filter(self, train: DataFrame) -> None:
+        new = self.extension(train)
+        if new is None:
+            # Another sample: filtered from its start with the same parameters
+            self.model_fit = self.model_fit.apply(train[self.kpi].to_numpy())
+        elif len(new):
+            # The sample grew: the state carries on through the added rows only
+            self.model_fit = self.model_fit.extend(new[self.kpi].to_numpy())
+
+    def forecast(self, steps: int) -> np.ndarray:
+        return np.asarray(self.model_fit.forecast(steps=steps))
+
+    def update(self, new_df: DataFrame) -> None:
+        self.split()
+        fitted = len(self.train)
+        self.df = concat([self.df, new_df], ignore_index=True)
+        self.split()
+        appended = self.train[self.kpi].iloc[fitted:]
+        if len(appended):
+            # Parameters are kept, only the state is filtered through the new observations
+            self.model_fit = self.model_fit.append(appended.to_numpy(), refit=False)
+        logger.info(f"{self.__class__.__name__} updated with {len(appended)} observations")
 
     def evaluate(self) -> None:
         summary = self.model_fit.summary()
@@ -48,12 +72,12 @@ class ArimaModel(Model):
             except Exception as e:
                 logger.error("Error loading model")
                 raise e
-        self.train, self.test = train_test_split(self.df, test_size=0.2, shuffle=False)
+        self.split()
         forecast = self.model_fit.forecast(steps=len(self.test))
         logger.info("Forecast: {}".format(forecast))
 
     def save_visualization(self, path: str, name_id: str, interval_type: str) -> None:
-        self.train, self.test = train_test_split(self.df, test_size=0.2, shuffle=False)
+        self.split()
         plt.plot(self.train[self.kpi], color="blue")
         plt.plot(self.test[self.kpi], color="orange")
         forecast = self.model_fit.forecast(steps=len(self.test))
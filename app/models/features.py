@@ -0,0 +1,126 @@
+from enum import Enum
+from typing import Any, Callable, List, Optional
+
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+
+class StrategyConstants(Enum):
+    # One model for the next period, fed back its own forecasts
+    RECURSIVE = "recursive"
+    # One model per horizon, all reading the same observed history
+    DIRECT = "direct"
+
+
+class SeasonalPeriodConstants(Enum):
+    # Calendar positions in a year of the time column, by interval_type
+    WEEKS = 52
+    MONTHS = 12
+
+
+def seasonal_period(interval_type: Optional[str]) -> int:
+    """Period of the week or month numbers in the time column, weeks when the interval type is not given"""
+    return SeasonalPeriodConstants[(interval_type or "weeks").upper()].value
+
+
+class FeatureBuilder:
+    """Lag, rolling-window and seasonal Fourier features of a series, built as strided NumPy views.
+
+    The row for period t only reads values before t: y[t - lag] for every lag, the mean and standard
+    deviation of the `window` values before t for every window, and sin/cos pairs of the calendar
+    position (week or month number) for `fourier_order` harmonics of `period`. The lags default to
+    the last four periods and the same period a year before."""
+
+    def __init__(
+        self,
+        lags: Optional[List[int]] = None,
+        windows: List[int] = [4, 12],
+        period: int = SeasonalPeriodConstants.WEEKS.value,
+        fourier_order: int = 2,
+    ):
+        self.lags: List[int] = sorted(lags if lags is not None else [1, 2, 3, 4, period])
+        self.windows: List[int] = sorted(windows)
+        self.period: int = period
+        self.fourier_order: int = fourier_order
+        # Periods of history needed before the first row
+        self.history: int = max(self.lags + self.windows)
+
+    def matrix(self, y: np.ndarray, times: np.ndarray) -> np.ndarray:
+        """Features of every period from `history` on, one row per period"""
+        start = self.history
+        past = y[:-1]
+        # Row j of the view holds y[j : j + width], the values right before period j + width
+        lags = sliding_window_view(past, start)[:, [start - lag for lag in self.lags]]
+        columns = [lags]
+        for window in self.windows:
+            view = sliding_window_view(past, window)[start - window :]
+            columns += [view.mean(axis=1, keepdims=True), view.std(axis=1, keepdims=True)]
+        columns.append(self.seasonal(times[start:]))
+        return np.hstack(columns)
+
+    def row(self, history: np.ndarray, time: float) -> np.ndarray:
+        """Features of the period following `history`, identical to the matrix row it would get"""
+        values = [history[-lag] for lag in self.lags]
+        for window in self.windows:
+            values += [history[-window:].mean(), history[-window:].std()]
+        return np.concatenate([values, self.seasonal(np.array([time]))[0]])
+
+    def seasonal(self, times: np.ndarray) -> np.ndarray:
+        harmonics = np.arange(1, self.fourier_order + 1)
+        angles = 2 * np.pi * np.outer(np.asarray(times, dtype=np.float64), harmonics) / self.period
+        return np.hstack([np.sin(angles), np.cos(angles)])
+
+    def next_time(self, time: float) -> float:
+        """Calendar position of the following period, week or month numbers starting at 1"""
+        return time % self.period + 1
+
+
+class LagForecaster:
+    """Forecaster over the features of FeatureBuilder with any scikit-learn regressor.
+
+    It keeps the tail of the series it was fitted or filtered on, so it can forecast from there
+    and be moved to a new sample (filter) without refitting the regressors."""
+
+    def __init__(
+        self,
+        builder: FeatureBuilder,
+        create_regressor: Callable[[], Any],
+        strategy: str = StrategyConstants.RECURSIVE.value,
+        horizon: int = 12,
+    ):
+        self.builder: FeatureBuilder = builder
+        self.strategy: StrategyConstants = StrategyConstants(strategy)
+        self.horizon: int = horizon if self.strategy == StrategyConstants.DIRECT else 1
+        self.regressors: List[Any] = [create_regressor() for _ in range(self.horizon)]
+        self.y: Optional[np.ndarray] = None
+        self.time: Optional[float] = None
+
+    def fit(self, y: np.ndarray, times: np.ndarray) -> "LagForecaster":
+        y = np.asarray(y, dtype=np.float64)
+        rows = len(y) - self.builder.history
+        if rows < self.horizon:
+            raise ValueError(f"{len(y)} observations, at least {self.builder.history + self.horizon} are needed")
+        features = self.builder.matrix(y, times)
+        for h, regressor in enumerate(self.regressors):
+            # Regressor h forecasts h + 1 periods ahead of the features' origin
+            regressor.fit(features[: rows - h], y[self.builder.history + h :])
+        self.filter(y, times)
+        return self
+
+    def filter(self, y: np.ndarray, times: np.ndarray) -> None:
+        self.y = np.asarray(y, dtype=np.float64)[-self.builder.history :].copy()
+        self.time = float(np.asarray(times)[-1])
+
+    def forecast(self, steps: int) -> np.ndarray:
+        """Forecast the periods after the filtered sample, in blocks of `horizon` periods"""
+        history, time = self.y.copy(), self.time
+        forecasts = []
+        while len(forecasts) < steps:
+            time = self.builder.next_time(time)
+            row = self.builder.row(history, time).reshape(1, -1)
+            block = [regressor.predict(row)[0] for regressor in self.regressors[: steps - len(forecasts)]]
+            for _ in block[1:]:
+                time = self.builder.next_time(time)
+            history = np.concatenate([history[len(block) :], block])
+            forecasts += block
+        return np.array(forecasts)
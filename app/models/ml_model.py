@@ -1,26 +1,92 @@
+import inspect
 import logging
+from abc import ABC, abstractmethod
 
-from typing import Any
+from typing import Any, Optional, Tuple
 
 import joblib
-from dotenv import load_dotenv
-from pandas import DataFrame
-from utils import set_logging
+import numpy as np
+from pandas import DataFrame, concat
+from sklearn.model_selection import train_test_split
+from utils import load_environment, set_logging
+from utils.instrumentation import instrumented_method
 
-load_dotenv()
+load_environment()
 set_logging()
 logger = logging.getLogger(__name__)
 
 
-class Model:
+# Methods recorded as <class>.<method> stages in the run report, also when a subclass overrides them
+INSTRUMENTED_METHODS = [
+    "split",
+    "train_model",
+    "fit",
+    "filter",
+    "forecast",
+    "update",
+    "predict",
+    "evaluate",
+    "save_visualization",
+    "save_model",
+    "load_model",
+]
+
+
+class Model(ABC):
+    # Set by init_models, identifies the AOI the model is trained for
+    name_id: Optional[str] = None
+    # First index label and length of the sample the fitted state ends on, set by fit and filter
+    sample: Optional[Tuple[Any, int]] = None
+    # Set by init_models, whether the time column holds week or month numbers
+    interval_type: str = "weeks"
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        for name in INSTRUMENTED_METHODS:
+            method = cls.__dict__.get(name)
+            if inspect.isfunction(method) and not getattr(method, "__instrumented__", False):
+                setattr(cls, name, instrumented_method(method))
 
     def __init__(self, df: DataFrame, kpi: slice):
         self.df: DataFrame = df
         self.kpi: slice = kpi
         self.model_fit = None
 
+    def split(self, test_size: float = 0.2) -> None:
+        self.train, self.test = train_test_split(self.df, test_size=test_size, shuffle=False)
+
     def train_model(self) -> None: ...
 
+    @abstractmethod
+    def fit(self, train: DataFrame) -> None:
+        """Estimate the model on `train` and keep the fitted state in model_fit"""
+
+    def filter(self, train: DataFrame) -> None:
+        """Move the fitted model onto another sample of the same series, ending where forecasts start.
+        Models whose state can be filtered with the estimated parameters override this, others refit"""
+        self.fit(train)
+
+    @staticmethod
+    def sample_of(train: DataFrame) -> Optional[Tuple[Any, int]]:
+        return (train.index[0], len(train)) if len(train) else None
+
+    def extension(self, train: DataFrame) -> Optional[DataFrame]:
+        """Rows of `train` after the sample the state ends on when `train` extends that sample, as the next
+        fold of an expanding backtest does, None otherwise. `train` becomes the sample the state ends on"""
+        previous, self.sample = self.sample, self.sample_of(train)
+        if previous is None or self.sample is None or previous[0] != self.sample[0] or previous[1] > self.sample[1]:
+            return None
+        return train.iloc[previous[1] :]
+
+    @abstractmethod
+    def forecast(self, steps: int) -> np.ndarray:
+        """Forecast the `steps` periods following the sample the model was fitted or filtered on"""
+
+    def update(self, new_df: DataFrame) -> None:
+        """Add new observations to a fitted model. Models without a cheaper update are refitted"""
+        self.df = concat([self.df, new_df], ignore_index=True)
+        self.train_model()
+
     def predict(self, model_name: str) -> None: ...
 
     def evaluate(self) -> None: ...
@@ -48,3 +114,7 @@ class Model:
 
         logger.info(f"Loading model {model_name}")
         return joblib.load(model_name)
+
+
+for _name in INSTRUMENTED_METHODS:
+    setattr(Model, _name, instrumented_method(getattr(Model, _name)))
@@ -1,43 +1,100 @@
+import copy
 import logging
-from typing import Dict, List
+from typing import Dict
 
-from dotenv import load_dotenv
+import numpy as np
 from matplotlib import pyplot as plt
+from models.features import FeatureBuilder, LagForecaster, StrategyConstants, seasonal_period
 from models.ml_model import Model
-from pandas import DataFrame
+from pandas import DataFrame, concat
 from sklearn.ensemble import RandomForestRegressor
-from sklearn.metrics import mean_squared_error
-from sklearn.model_selection import train_test_split
-from utils import set_logging
+from sklearn.metrics import mean_squared_error, r2_score
+from utils import load_environment, set_logging
+from utils.parallel import model_jobs
 
-load_dotenv()
+load_environment()
 set_logging()
 logger = logging.getLogger(__name__)
 
 
 class RandomForestModel(Model):
+    # Fits stored before the feature pipeline are plain regressors and must not be reused
+    store_version: int = 2
+
     def __init__(self, df: DataFrame, kpi: slice, model_params: Dict = {}):
         super().__init__(df, kpi)
         self.model_params: Dict = model_params
 
     def train_model(self) -> None:
         logger.info("Training {}...".format(self.__class__.__name__))
-        self.train, self.test = train_test_split(self.df, test_size=0.2, shuffle=False)
-        self.train: List = self.train
-        self.test: List = self.test
+        self.split()
+        self.fit(self.train)
+
+        logger.info("Training complete.")
+
+    def fit(self, train: DataFrame) -> None:
+        """Fit on lag, rolling and seasonal features of the kpi, the target never being one of its own features"""
+        builder = self.feature_builder(len(train))
+        forecaster = LagForecaster(
+            builder,
+            self.create_regressor,
+            strategy=self.model_params.get("strategy", StrategyConstants.RECURSIVE.value),
+            horizon=self.model_params.get("horizon", 12),
+        )
+        self.model_fit: LagForecaster = forecaster.fit(train[self.kpi].to_numpy(), train["time"].to_numpy())
+
+    def feature_builder(self, observations: int) -> FeatureBuilder:
+        """Features for the week or month numbers of the series. Unless lags are configured, the lag of
+        one year is left out of series that would keep less than a year of training rows with it,
+        the Fourier terms still carry the seasonality"""
+        period = self.model_params.get("period", seasonal_period(self.interval_type))
+        windows = self.model_params.get("windows", [4, 12])
+        lags = self.model_params.get("lags")
+        if lags is None:
+            lags = [1, 2, 3, 4, period]
+            if observations - max(lags + windows) < period:
+                lags = [1, 2, 3, 4]
+                logger.warning(f"{observations} observations, the lag of {period} periods is not used")
+        builder = FeatureBuilder(
+            lags=lags, windows=windows, period=period, fourier_order=self.model_params.get("fourier_order", 2)
+        )
+        if observations <= builder.history:
+            raise ValueError(
+                f"{observations} observations are not enough for lags {builder.lags} and windows {builder.windows}"
+            )
+        return builder
+
+    def filter(self, train: DataFrame) -> None:
+        # The trees do not depend on the origin, only the history they are fed does
+        self.model_fit.filter(train[self.kpi].to_numpy(), train["time"].to_numpy())
+
+    def forecast(self, steps: int) -> np.ndarray:
+        return self.model_fit.forecast(steps)
+
+    def forecast_from(self, sample: DataFrame, steps: int) -> np.ndarray:
+        """Forecast after another sample of the series, leaving the fitted state untouched"""
+        forecaster = copy.copy(self.model_fit)
+        forecaster.filter(sample[self.kpi].to_numpy(), sample["time"].to_numpy())
+        return forecaster.forecast(steps)
+
+    def create_regressor(self) -> RandomForestRegressor:
         n_estimators = self.model_params.get("n_estimators", 100)
         max_depth = self.model_params.get("max_depth", None)
-        model = RandomForestRegressor(n_estimators=n_estimators, max_depth=max_depth)
-        self.model_fit: RandomForestRegressor = model.fit(
-            self.train, self.train[self.kpi]
-        )
+        n_jobs = model_jobs(self.model_params.get("n_jobs"))
+        return RandomForestRegressor(n_estimators=n_estimators, max_depth=max_depth, n_jobs=n_jobs)
 
-        logger.info("Training complete.")
+    def update(self, new_df: DataFrame) -> None:
+        """Refit on the most recent `window` training rows only, so the cost does not grow with the history"""
+        self.df = concat([self.df, new_df], ignore_index=True)
+        self.split()
+        train = self.train.tail(self.model_params.get("window", 104))
+        self.fit(train)
+        logger.info(f"{self.__class__.__name__} refitted on the last {len(train)} observations")
 
     def evaluate(self) -> None:
-        predictions = self.model_fit.predict(self.test)
+        predictions = self.forecast_from(self.train, len(self.test))
         errors = mean_squared_error(self.test[self.kpi], predictions)
-        score = self.model_fit.score(self.test, predictions)
+        score = r2_score(self.test[self.kpi], predictions)
 
         logger.info("Score: {}".format(score))
         logger.info("Mean Squared Error: {}".format(errors))
@@ -52,21 +109,21 @@ class RandomForestModel(Model):
             except Exception as e:
                 logger.error("Error loading model")
                 raise e
-        self.train, self.test = train_test_split(self.df, test_size=0.2, shuffle=False)
-        predictions = self.model_fit.predict(self.test)
+        self.split()
+        predictions = self.forecast_from(self.train, len(self.test))
         logger.info("Predictions: {}".format(predictions))
 
     def save_visualization(self, path: str, name_id: str, interval_type: str) -> None:
-        self.train, self.test = train_test_split(self.df, test_size=0.2, shuffle=False)
+        self.split()
         plt.plot(self.train[self.kpi], color="blue")
         plt.plot(self.test[self.kpi], color="orange")
-        prediction = self.model_fit.predict(self.test)
+        prediction = self.forecast_from(self.train, len(self.test))
         plt.plot(
             range(len(self.train), len(self.train) + len(self.test)),
             prediction,
             color="green",
         )
-        future = self.model_fit.predict(self.df)
+        future = self.forecast_from(self.df, len(self.df))
         plt.plot(
             range(len(self.df), len(self.df) + len(future)), future, color="purple"
         )
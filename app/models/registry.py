@@ -0,0 +1,42 @@
+import threading
+from importlib import import_module
+from typing import Dict
+
+# Model name in the configuration -> "module:Class", imported the first time the model is used
+MODELS: Dict[str, str] = {
+    "arima": "models.arima:ArimaModel",
+    "sarima": "models.sarima:SarimaModel",
+    "random_forest": "models.random_forest:RandomForestModel",
+}
+
+_classes: Dict[str, type] = {}
+_lock = threading.RLock()
+
+
+def register_model(name: str, target: str) -> None:
+    """Make a model available to configurations under `name`, `target` being "module:Class" """
+    if ":" not in target:
+        raise ValueError(f"Model target {target} must be given as module:Class")
+    with _lock:
+        MODELS[name] = target
+        _classes.pop(name, None)
+
+
+def model_target(name: str) -> str:
+    """Registered target of a model name. Names given as "module:Class" are plugins loaded as they are,
+    unregistered names follow the models.<name>.<Name>Model convention"""
+    if name in MODELS:
+        return MODELS[name]
+    if ":" in name:
+        return name
+    return f"models.{name}:{''.join(word.capitalize() for word in name.split('_'))}Model"
+
+
+def get_model_class(name: str) -> type:
+    """Import the module of a model only when a configuration asks for it, raising ImportError or
+    AttributeError when it cannot be found"""
+    with _lock:
+        if name not in _classes:
+            module_name, class_name = model_target(name).split(":", 1)
+            _classes[name] = getattr(import_module(module_name), class_name)
+        return _classes[name]
@@ -1,19 +1,159 @@
+import hashlib
+import itertools
+import json
 import logging
-from typing import Dict, List
+import os
+import tempfile
+import time
+import warnings
+from enum import Enum
+from typing import Any, Dict, List, Optional, Tuple
 
+import numpy as np
 import pmdarima as pm
-from dotenv import load_dotenv
+from configuration.configuration import Configuration
+from joblib import Parallel, delayed
 from matplotlib import pyplot as plt
 from models.ml_model import Model
-from pandas import DataFrame
-from sklearn.model_selection import train_test_split
-from utils import set_logging
+from pandas import DataFrame, concat
+from utils import load_environment, set_logging
+from utils.parallel import model_jobs
 
-load_dotenv()
+load_environment()
 set_logging()
 logger = logging.getLogger(__name__)
 
 
+class SearchConstants(Enum):
+    # pmdarima's serial stepwise auto_arima
+    STEPWISE = "stepwise"
+    # Candidate orders fitted in parallel, warm-started and memoised
+    PARALLEL = "parallel"
+
+
+Order = Tuple[int, int, int]
+SeasonalOrder = Tuple[int, int, int, int]
+
+
+def fit_candidate(
+    series: np.ndarray, order: Order, seasonal_order: SeasonalOrder, start_params: Optional[List[float]] = None
+) -> Dict[str, Any]:
+    """Fit one candidate order and return its AIC, parameters and fit time, never raising"""
+    start = time.perf_counter()
+    d, D = order[1], seasonal_order[1]
+    try:
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            model = pm.ARIMA(
+                order=order,
+                seasonal_order=seasonal_order,
+                start_params=np.array(start_params) if start_params is not None else None,
+                with_intercept=(d + D) in (0, 1),
+                suppress_warnings=True,
+            )
+            model.fit(series)
+        aic, params = float(model.aic()), [float(param) for param in model.params()]
+        if not np.isfinite(aic):
+            aic, params = None, None
+    except Exception as e:
+        logger.debug(f"Order {order}{seasonal_order} failed: {e}")
+        aic, params = None, None
+    return {"aic": aic, "params": params, "seconds": time.perf_counter() - start}
+
+
+class OrderSearchCache:
+    """Memo of the candidate fits of a series, keyed by the series content, and of the orders chosen per name_id.
+
+    Every backtest block and every new observation gives a new series, so the fits memo keeps the
+    `max_fits` most recently used series, none unused for longer than `max_age_days`"""
+
+    MAX_FITS = 200
+    MAX_AGE_DAYS = 30
+
+    def __init__(
+        self, cache_path: Optional[str] = None, max_fits: int = MAX_FITS, max_age_days: float = MAX_AGE_DAYS
+    ):
+        if cache_path is None:
+            cache_path = os.path.join(str(Configuration()["cache_path"]), "sarima")
+        self.max_fits: int = max_fits
+        self.max_age_days: float = max_age_days
+        self.fits_path: str = os.path.join(cache_path, "fits")
+        self.orders_path: str = os.path.join(cache_path, "orders")
+        os.makedirs(self.fits_path, exist_ok=True)
+        os.makedirs(self.orders_path, exist_ok=True)
+
+    @staticmethod
+    def series_key(series: np.ndarray) -> str:
+        return hashlib.sha256(np.ascontiguousarray(series, dtype=np.float64).tobytes()).hexdigest()
+
+    @staticmethod
+    def candidate_key(order: Order, seasonal_order: SeasonalOrder) -> str:
+        return f"{order}{seasonal_order}"
+
+    def load_fits(self, series_key: str) -> Dict[str, Dict[str, Any]]:
+        path = os.path.join(self.fits_path, f"{series_key}.json")
+        fits = self._load(path, {})
+        if fits:
+            # The modification time records the last use, for pruning
+            try:
+                os.utime(path)
+            except OSError:
+                pass
+        return fits
+
+    def save_fits(self, series_key: str, fits: Dict[str, Dict[str, Any]]) -> None:
+        self._save(os.path.join(self.fits_path, f"{series_key}.json"), fits)
+        self.prune()
+
+    def prune(self) -> List[str]:
+        """Remove the memoised fits unused for longer than max_age_days, then the least recently used
+        ones over max_fits"""
+        entries = []
+        for name in os.listdir(self.fits_path):
+            path = os.path.join(self.fits_path, name)
+            try:
+                if name.endswith(".json"):
+                    entries.append((os.path.getmtime(path), path))
+            except OSError:
+                # Removed by a concurrent prune
+                continue
+        entries.sort(reverse=True)
+        limit = time.time() - self.max_age_days * 24 * 3600
+        evicted = [path for i, (mtime, path) in enumerate(entries) if i >= self.max_fits or mtime < limit]
+        for path in evicted:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+        if evicted:
+            logger.info(f"{len(evicted)} memoised SARIMA searches evicted")
+        return evicted
+
+    def load_choice(self, name_id: str) -> Optional[Dict[str, Any]]:
+        return self._load(os.path.join(self.orders_path, f"{name_id}.json"), None)
+
+    def save_choice(self, name_id: str, order: Order, seasonal_order: SeasonalOrder, params: List[float]) -> None:
+        choice = {"order": list(order), "seasonal_order": list(seasonal_order), "params": params}
+        self._save(os.path.join(self.orders_path, f"{name_id}.json"), choice)
+
+    def _load(self, path: str, default: Any) -> Any:
+        if not os.path.exists(path):
+            return default
+        with open(path, "r") as f:
+            return json.load(f)
+
+    def _save(self, path: str, data: Any) -> None:
+        # A temporary file per writer, configurations sharing a series may save the same key at once
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w") as f:
+                json.dump(data, f)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+
+
 class SarimaModel(Model):
 
     def __init__(self, df: DataFrame, kpi: slice, model_params: Dict = {}):
@@ -23,18 +163,150 @@ class SarimaModel(Model):
     def train_model(self) -> None:
         logger.info("Training {}...".format(self.__class__.__name__))
 
-        self.train, self.test = train_test_split(self.df, test_size=0.2, shuffle=False)
-        self.train: List = self.train
-        self.test: List = self.test
+        self.split()
+        self.fit(self.train)
+        search = SearchConstants(self.model_params.get("search", SearchConstants.STEPWISE.value))
+        if search == SearchConstants.PARALLEL and self.name_id:
+            # Later searches for this name_id start from the order chosen now
+            OrderSearchCache().save_choice(
+                self.name_id,
+                self.model_fit.order,
+                self.model_fit.seasonal_order,
+                [float(param) for param in self.model_fit.params()],
+            )
+
+        logger.info("Training complete.")
+
+    def fit(self, train: DataFrame) -> None:
         m = self.model_params.get("m", 12)
         seasonal = self.model_params.get("seasonal", True)
         stationary = self.model_params.get("stationary", False)
         logger.info(f"Params: m={m}, seasonal={seasonal}")
-        self.model_fit: pm.AutoARIMA = pm.auto_arima(
-            self.train[self.kpi], seasonal=seasonal, m=m, stationary=stationary
+        search = SearchConstants(self.model_params.get("search", SearchConstants.STEPWISE.value))
+        series = train[self.kpi].to_numpy(dtype=np.float64)
+        if search == SearchConstants.PARALLEL:
+            self.model_fit: pm.ARIMA = self.search_order(series, m, seasonal, stationary)
+        else:
+            self.model_fit: pm.AutoARIMA = pm.auto_arima(series, seasonal=seasonal, m=m, stationary=stationary)
+        self.sample = self.sample_of(train)
+        # statsmodels results of the state moved by filter, model_fit keeps the fit itself
+        self.filtered = None
+
+    def filter(self, train: DataFrame) -> None:
+        new = self.extension(train)
+        if new is None:
+            # Another sample: filtered from its start with the same order and parameters
+            self.filtered = self.model_fit.arima_res_.apply(train[self.kpi].to_numpy(dtype=np.float64))
+        elif len(new):
+            # The sample grew: the state carries on through the added rows only
+            state = self.filtered if self.filtered is not None else self.model_fit.arima_res_
+            self.filtered = state.extend(new[self.kpi].to_numpy(dtype=np.float64))
+
+    def forecast(self, steps: int) -> np.ndarray:
+        if getattr(self, "filtered", None) is not None:
+            return np.asarray(self.filtered.forecast(steps))
+        return np.asarray(self.model_fit.predict(n_periods=steps))
+
+    def search_order(self, series: np.ndarray, m: int, seasonal: bool, stationary: bool) -> pm.ARIMA:
+        """Grid search of (p,d,q)(P,D,Q,m) orders fitted in parallel with joblib.
+
+        d and D are estimated with the same unit root tests auto_arima uses. When an order was chosen
+        before for this name_id (or one of `warm_start_from`), only its neighbourhood is searched and
+        the candidate with that order starts from the previous parameters. Every candidate fit is
+        memoised by series content, so re-runs on unchanged data fit nothing but the final model."""
+        m = m if seasonal and m > 1 else 0
+        d = self.model_params.get("d", 0 if stationary else pm.arima.ndiffs(series))
+        D = self.model_params.get("D", 0 if stationary or not m else pm.arima.nsdiffs(series, m))
+        max_p, max_q = self.model_params.get("max_p", 2), self.model_params.get("max_q", 2)
+        max_P, max_Q = (self.model_params.get("max_P", 1), self.model_params.get("max_Q", 1)) if m else (0, 0)
+        n_jobs = model_jobs(self.model_params.get("n_jobs"))
+
+        cache = OrderSearchCache(
+            max_fits=self.model_params.get("fit_cache_max_fits", OrderSearchCache.MAX_FITS),
+            max_age_days=self.model_params.get("fit_cache_max_age_days", OrderSearchCache.MAX_AGE_DAYS),
         )
+        previous = None
+        for name_id in [self.name_id] + self.model_params.get("warm_start_from", []):
+            previous = cache.load_choice(name_id) if name_id else None
+            if previous is not None:
+                break
+        if previous is not None:
+            (p0, _, q0), (P0, _, Q0, _) = previous["order"], previous["seasonal_order"]
+            # Neighbourhood of the previous order, within the grid
+            ranges = [
+                range(max(0, value - 1), min(value + 1, maximum) + 1)
+                for value, maximum in zip((p0, q0, P0, Q0), (max_p, max_q, max_P, max_Q))
+            ]
+            logger.info(f"Warm start from order {previous['order']}{previous['seasonal_order']}")
+        else:
+            ranges = [range(max_p + 1), range(max_q + 1), range(max_P + 1), range(max_Q + 1)]
+        candidates = [((p, d, q), (P, D, Q, m)) for p, q, P, Q in itertools.product(*ranges)]
 
-        logger.info("Training complete.")
+        series_key = OrderSearchCache.series_key(series)
+        fits = cache.load_fits(series_key)
+        pending = [c for c in candidates if OrderSearchCache.candidate_key(*c) not in fits]
+
+        def start_params(order: Order, seasonal_order: SeasonalOrder) -> Optional[List[float]]:
+            if previous is not None and [list(order), list(seasonal_order)] == [
+                previous["order"],
+                previous["seasonal_order"],
+            ]:
+                return previous["params"]
+            return None
+
+        start = time.perf_counter()
+        results = Parallel(n_jobs=n_jobs)(
+            delayed(fit_candidate)(series, order, seasonal_order, start_params(order, seasonal_order))
+            for order, seasonal_order in pending
+        )
+        for candidate, result in zip(pending, results):
+            fits[OrderSearchCache.candidate_key(*candidate)] = result
+        if pending:
+            cache.save_fits(series_key, fits)
+        logger.info(
+            f"Order search: {len(candidates)} candidates, {len(candidates) - len(pending)} memoised, "
+            f"{len(pending)} fitted in {time.perf_counter() - start:.1f}s"
+        )
+
+        timings = []
+        for order, seasonal_order in candidates:
+            fit = fits[OrderSearchCache.candidate_key(order, seasonal_order)]
+            timings.append({"order": order, "seasonal_order": seasonal_order, **fit})
+        # Slowest candidates first, that is where the search spends its time
+        self.search_timings: List[Dict[str, Any]] = sorted(timings, key=lambda candidate: -candidate["seconds"])
+        for candidate in self.search_timings:
+            logger.info(
+                f"Candidate {candidate['order']}{candidate['seasonal_order']}: "
+                f"AIC {candidate['aic']}, {candidate['seconds']:.2f}s"
+            )
+        valid = [candidate for candidate in self.search_timings if candidate["aic"] is not None]
+        if not valid:
+            raise RuntimeError("No SARIMA candidate order could be fitted")
+        best = min(valid, key=lambda candidate: candidate["aic"])
+        logger.info(f"Best order {best['order']}{best['seasonal_order']} with AIC {best['aic']}")
+
+        # The memoised parameters make the final fit start at the optimum
+        model = pm.ARIMA(
+            order=best["order"],
+            seasonal_order=best["seasonal_order"],
+            start_params=np.array(best["params"]),
+            with_intercept=(d + D) in (0, 1),
+            suppress_warnings=True,
+        )
+        model.fit(series)
+        return model
+
+    def update(self, new_df: DataFrame) -> None:
+        self.split()
+        fitted = len(self.train)
+        self.df = concat([self.df, new_df], ignore_index=True)
+        self.split()
+        appended = self.train[self.kpi].iloc[fitted:]
+        if len(appended):
+            # A few optimizer iterations from the current parameters, the order is not searched again
+            maxiter = self.model_params.get("update_maxiter", 10)
+            self.model_fit.update(appended.to_numpy(dtype=np.float64), maxiter=maxiter)
+        logger.info(f"{self.__class__.__name__} updated with {len(appended)} observations")
 
     def evaluate(self) -> None:
         predict = self.model_fit.predict_in_sample(self.train[self.kpi])
@@ -51,12 +323,12 @@ class SarimaModel(Model):
             except Exception as e:
                 logger.error("Error loading model")
                 raise e
-        self.train, self.test = train_test_split(self.df, test_size=0.3, shuffle=False)
+        self.split()
         predict = self.model_fit.predict_in_sample(self.train[self.kpi])
         logger.info("Predict: \n{}".format(predict))
 
     def save_visualization(self, path: str, name_id: str, interval_type: str) -> None:
-        self.train, self.test = train_test_split(self.df, test_size=0.3, shuffle=False)
+        self.split()
         plt.plot(self.train[self.kpi], color="blue")
         plt.plot(self.test[self.kpi], color="orange")
         logger.info(f"Test: \n{self.test}")
@@ -0,0 +1,170 @@
+import logging
+import time
+from concurrent.futures import ProcessPoolExecutor
+from enum import Enum
+from functools import partial
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+from models.ml_model import Model
+from pandas import DataFrame, concat
+from utils import load_environment, set_logging
+from utils.parallel import limit_worker, pool_workers
+
+load_environment()
+set_logging()
+logger = logging.getLogger(__name__)
+
+
+class BacktestConstants(Enum):
+    # Every fold trains on all the history before its origin
+    EXPANDING = "expanding"
+    # Every fold trains on the `window` periods before its origin
+    SLIDING = "sliding"
+
+
+# Dataframe of the worker process, received once when the worker starts
+_df: Dict[str, DataFrame] = {}
+
+
+def _init_worker(df: DataFrame) -> None:
+    _df["df"] = df
+    limit_worker()
+
+
+def fold_origins(rows: int, initial: float, step: int) -> List[int]:
+    """Positions of the first forecast period of every fold. `initial` is a row count or a fraction of the rows"""
+    first = int(initial * rows) if initial < 1 else int(initial)
+    return list(range(max(first, 1), rows, max(1, step)))
+
+
+def run_folds(
+    origins: List[int],
+    model_class: type,
+    kpi: Any,
+    model_params: Dict,
+    name_id: Optional[str],
+    mode: BacktestConstants,
+    window: int,
+    horizon: int,
+    df: Optional[DataFrame] = None,
+    interval_type: str = "weeks",
+) -> List[Tuple[int, np.ndarray]]:
+    """Forecast `horizon` periods from each origin, fitting at the first one and filtering the fitted
+    state forward for the rest, so a block of folds costs one estimation"""
+    df = df if df is not None else _df["df"]
+    model = model_class(df, kpi, model_params)
+    model.name_id = name_id
+    model.interval_type = interval_type
+    forecasts = []
+    for i, origin in enumerate(origins):
+        start = max(0, origin - window) if mode == BacktestConstants.SLIDING else 0
+        train = df.iloc[start:origin]
+        if i == 0:
+            model.fit(train)
+        else:
+            model.filter(train)
+        forecasts.append((origin, model.forecast(horizon)))
+    return forecasts
+
+
+def forecast_errors(
+    df: DataFrame, kpi: Any, forecasts: List[Tuple[int, np.ndarray]], horizons: List[int]
+) -> DataFrame:
+    """MAE, RMSE and MAPE of the forecasts for every horizon, over the folds whose target is observed"""
+    actual = df[kpi].to_numpy(dtype=np.float64)
+    rows = []
+    for horizon in horizons:
+        errors, targets = [], []
+        for origin, forecast in forecasts:
+            target = origin + horizon - 1
+            if target < len(actual):
+                errors.append(forecast[horizon - 1] - actual[target])
+                targets.append(actual[target])
+        errors, targets = np.array(errors), np.array(targets)
+        observed = targets != 0
+        rows.append(
+            {
+                "horizon": horizon,
+                "folds": len(errors),
+                "mae": float(np.mean(np.abs(errors))) if len(errors) else np.nan,
+                "rmse": float(np.sqrt(np.mean(np.square(errors)))) if len(errors) else np.nan,
+                "mape": (
+                    float(np.mean(np.abs(errors[observed] / targets[observed])) * 100) if observed.any() else np.nan
+                ),
+            }
+        )
+    return DataFrame(rows)
+
+
+def backtest(
+    model: Model,
+    horizons: List[int],
+    mode: str = BacktestConstants.EXPANDING.value,
+    initial: float = 0.5,
+    window: Optional[int] = None,
+    step: int = 1,
+    refit_every: int = 10,
+    workers: int = 1,
+) -> DataFrame:
+    """Rolling-origin evaluation of a model over its dataframe.
+
+    Folds are grouped in blocks of `refit_every` consecutive origins: each block estimates the model
+    once and filters the state to the next origins (models that cannot filter refit). Blocks are
+    independent, so they run in parallel with the dataframe sent once to every worker."""
+    df = model.df
+    mode = BacktestConstants(mode)
+    origins = fold_origins(len(df), initial, step)
+    if not origins:
+        raise ValueError(f"Not enough rows ({len(df)}) to backtest from initial {initial}")
+    window = window or origins[0]
+    horizon = max(horizons)
+    blocks = [origins[i : i + max(1, refit_every)] for i in range(0, len(origins), max(1, refit_every))]
+    folds = partial(
+        run_folds,
+        model_class=model.__class__,
+        kpi=model.kpi,
+        model_params=model.model_params,
+        name_id=model.name_id,
+        mode=mode,
+        window=window,
+        horizon=horizon,
+        interval_type=model.interval_type,
+    )
+    start = time.perf_counter()
+    if workers > 1 and len(blocks) > 1:
+        with pool_workers(min(workers, len(blocks))) as workers, ProcessPoolExecutor(
+            max_workers=workers, initializer=_init_worker, initargs=(df,)
+        ) as pool:
+            results = list(pool.map(folds, blocks))
+    else:
+        results = [folds(block, df=df) for block in blocks]
+    forecasts = [forecast for result in results for forecast in result]
+    metrics = forecast_errors(df, model.kpi, forecasts, horizons)
+    metrics.insert(0, "model", model.__class__.__name__)
+    logger.info(
+        f"{model.__class__.__name__} backtested on {len(origins)} {mode.value} folds "
+        f"({len(blocks)} fits) in {time.perf_counter() - start:.1f}s"
+    )
+    return metrics
+
+
+def backtest_models(models: List[Model], backtest_config: Dict) -> DataFrame:
+    """Backtest every model and return their metrics in one frame"""
+    results = []
+    for model in models:
+        results.append(
+            backtest(
+                model,
+                horizons=backtest_config.get("horizons", [1]),
+                mode=backtest_config.get("mode", BacktestConstants.EXPANDING.value),
+                initial=backtest_config.get("initial", 0.5),
+                window=backtest_config.get("window"),
+                step=backtest_config.get("step", 1),
+                refit_every=backtest_config.get("refit_every", 10),
+                workers=backtest_config.get("workers", 1),
+            )
+        )
+    if not results:
+        return DataFrame(columns=["model", "horizon", "folds", "mae", "rmse", "mape"])
+    return concat(results, ignore_index=True)
@@ -1,19 +1,46 @@
+import json
 import logging
 import os
+import shutil
 from datetime import datetime
-from typing import List, Optional
+from typing import Any, Dict, List, Optional, Tuple
 
 from configuration.configuration import Configuration
 from dateutil.relativedelta import relativedelta
-from dotenv import load_dotenv
-from utils import set_logging
-from utils.downloader import DataFilterConstants, DataTypeConstants, Downloader, ImageFormatConstants, UrlConstants
+from utils import load_environment, set_logging
+from utils.downloader import (
+    DataFilterConstants,
+    DataTypeConstants,
+    Downloader,
+    ImageFormatConstants,
+    UrlConstants,
+    payload_fingerprint,
+)
+from utils.catalog import Catalog, filter_windows
+from utils.instrumentation import instrumented
+from utils.manifest import DownloadManifest, WindowStatusConstants
+from utils.scheduler import RequestScheduler
+from utils.tiling import MAX_TILE_SIZE, TileGrid
 
-load_dotenv()
+load_environment()
 set_logging()
 logger = logging.getLogger(__name__)
 
+# Multi-temporal evalscripts declare their windows with this placeholder
+WINDOWS_PLACEHOLDER = "__WINDOWS__"
+PACKED_FOLDER = "packed"
 
+
+def remove_previous_download(name_id: str) -> None:
+    configuration = Configuration()
+    geotiffs_path = os.path.join(str(configuration["geotiffs_path"]), name_id)
+    if os.path.exists(geotiffs_path):
+        shutil.rmtree(geotiffs_path)
+    DownloadManifest(name_id).clear()
+    logger.info("Previous download removed")
+
+
+@instrumented()
 def download(
     bbox: List[float],
     evalscript: str,
@@ -28,7 +55,16 @@ def download(
     data_filter: Optional[dict] = None,
     client_id_env: Optional[str] = "COPERINICUS_CLIENT_ID",
     client_secret_env: Optional[str] = "COPERNICUS_CLIENT_SECRET",
-):
+    workers: int = 1,
+    max_retries: int = 3,
+    backoff_factor: float = 1.0,
+    verify_checksums: bool = False,
+    rate_limit: Optional[dict] = None,
+    tiling: Optional[dict] = None,
+    timestamps_per_request: int = 1,
+    catalog: Optional[dict] = None,
+    session_owner: Optional[Downloader] = None,
+) -> Dict[str, Any]:
     if client_id_env and client_secret_env:
         logger.info(client_id_env)
         logger.info("Using '" + client_id_env + "' and '" + client_secret_env + "' from environment variables")
@@ -40,7 +76,26 @@ def download(
     configuration = Configuration()
     EVALSCRIPTS_PATH: str = str(configuration["evalscripts_path"])
 
-    downloader = Downloader(client_id, client_secret, token_url)
+    scheduler = None
+    if rate_limit:
+        scheduler = RequestScheduler(
+            max_concurrency=workers,
+            min_concurrency=rate_limit.get("min_workers", 1),
+            requests_per_minute=rate_limit.get("requests_per_minute"),
+            processing_units_per_minute=rate_limit.get("processing_units_per_minute"),
+            target_latency=rate_limit.get("target_latency"),
+        )
+
+    downloader = Downloader(
+        client_id,
+        client_secret,
+        token_url,
+        workers=workers,
+        max_retries=max_retries,
+        backoff_factor=backoff_factor,
+        scheduler=scheduler,
+        session_owner=session_owner,
+    )
 
     evalscript_path = os.path.join(EVALSCRIPTS_PATH, evalscript + ".js")
     logger.info("Using evalscript: " + evalscript_path)
@@ -49,15 +104,17 @@ def download(
 
     logger.info(f"Content:\n{evalscript}")
 
-    for single_date in downloader.daterange(start_date, end_date, step=date_interval):
-        date_start: datetime = single_date
-        date_end: datetime = single_date + date_interval
+    grid = None
+    if tiling:
+        grid = TileGrid(bbox, tiling.get("resolution", 10), tiling.get("max_tile_size", MAX_TILE_SIZE))
+
+    def create_payload(batch: List[Tuple[datetime, datetime, str]], evalscript: str) -> Dict[str, Any]:
         filters = {
             DataFilterConstants.MAX_CLOUD_COVERAGE.value: 30,
             DataFilterConstants.MIN_CLOUD_COVERAGE.value: 0,
             DataFilterConstants.TIME_RANGE.value: {
-                DataFilterConstants.FROM.value: date_start.isoformat() + "Z",
-                DataFilterConstants.TO.value: date_end.isoformat() + "Z",
+                DataFilterConstants.FROM.value: batch[0][0].isoformat() + "Z",
+                DataFilterConstants.TO.value: batch[-1][1].isoformat() + "Z",
             },
         }
 
@@ -65,6 +122,66 @@ def download(
             filters.update(data_filter)
 
         data = [{"type": satellite_type, "dataFilter": filters}]
-        payload = downloader.create_payload(bbox, data, format, evalscript)
+        return downloader.create_payload(bbox, data, format, evalscript)
+
+    # Windows done with other request settings than these are downloaded again
+    fingerprint = payload_fingerprint(create_payload([(start_date, end_date, "")], evalscript), tiling)
+    manifest = DownloadManifest(name_id, verify_checksums=verify_checksums, fingerprint=fingerprint)
+
+    windows = []
+    for single_date in downloader.daterange(start_date, end_date, step=date_interval):
+        date_start: datetime = single_date
+        date_end: datetime = single_date + date_interval
         name = date_start.strftime("%Y-%m-%d") + "_" + date_end.strftime("%Y-%m-%d")
-        downloader.download(url, payload, name_id, name)
+        windows.append((date_start, date_end, name))
+
+    if catalog:
+        max_cloud_coverage = (data_filter or {}).get(DataFilterConstants.MAX_CLOUD_COVERAGE.value, 30)
+        acquisitions = Catalog(
+            downloader.session(), catalog.get("url", UrlConstants.COPERNICUS_CATALOG.value)
+        ).search(bbox, start_date, end_date, satellite_type, max_cloud_coverage)
+        windows, empty_windows = filter_windows(windows, acquisitions)
+        logger.info(f"{len(empty_windows)} windows without acquisitions skipped")
+        for _, _, window_name in empty_windows:
+            if window_name not in manifest.windows:
+                manifest.record(window_name, WindowStatusConstants.EMPTY, None, 0)
+
+    logger.info(f"{len(windows)} date windows requested, using {downloader.workers} workers")
+    if timestamps_per_request <= 1:
+        jobs = [(create_payload([window], evalscript), window[2]) for window in windows]
+        return downloader.download_many(url, jobs, name_id, manifest, grid)
+
+    if format != ImageFormatConstants.TIFF.value:
+        raise ValueError("Multi-timestamp requests are only supported for image/tiff")
+    if WINDOWS_PLACEHOLDER not in evalscript:
+        raise ValueError(f"Evalscript must be a multi-temporal one declaring {WINDOWS_PLACEHOLDER}")
+
+    # Only multi-timestamp downloads unpack rasters, the raster stack is not imported otherwise
+    from utils.process_data import unpack_multitemporal, write_timestamps_sidecar
+
+    packed_folder = os.path.join(name_id, PACKED_FOLDER)
+    batches = {}
+    jobs = []
+    for i in range(0, len(windows), timestamps_per_request):
+        batch = windows[i : i + timestamps_per_request]
+        if all(manifest.is_done(window_name) for _, _, window_name in batch):
+            continue
+        name = batch[0][0].strftime("%Y-%m-%d") + "_" + batch[-1][1].strftime("%Y-%m-%d")
+        batch_windows = [
+            [date_start.isoformat() + "Z", date_end.isoformat() + "Z"] for date_start, date_end, _ in batch
+        ]
+        batch_evalscript = evalscript.replace(WINDOWS_PLACEHOLDER, json.dumps(batch_windows))
+        jobs.append((create_payload(batch, batch_evalscript), name))
+        batches[name] = batch
+    logger.info(f"Packing {timestamps_per_request} windows per request into {len(jobs)} requests")
+    summary = downloader.download_many(url, jobs, packed_folder, manifest, grid)
+
+    for name, batch in batches.items():
+        if not manifest.is_done(name):
+            continue
+        packed_path = downloader.get_image_path(format, packed_folder, name, False)
+        write_timestamps_sidecar(packed_path, batch)
+        output_dir = os.path.dirname(downloader.get_image_path(format, name_id, name, False))
+        for (_, _, window_name), image_path in zip(batch, unpack_multitemporal(packed_path, output_dir)):
+            manifest.record(window_name, WindowStatusConstants.DONE, image_path, 1)
+    return summary
@@ -0,0 +1,88 @@
+import ast
+import operator
+from enum import Enum
+from typing import Callable, Dict, List
+
+import numpy as np
+from numpy.core.multiarray import ndarray
+
+# Band order of the rasters downloaded with the raw_bands evalscript
+RAW_BANDS = ["B03", "B04", "B08", "B11", "dataMask"]
+MASK_BAND = "dataMask"
+
+
+class IndicesConstants(Enum):
+    NDVI = "ndvi"
+    NDSI = "ndsi"
+
+
+INDEX_EXPRESSIONS: Dict[IndicesConstants, str] = {
+    IndicesConstants.NDVI: "(B08 - B04) / (B08 + B04)",
+    IndicesConstants.NDSI: "(B03 - B11) / (B03 + B11)",
+}
+
+BINARY_OPERATORS: Dict[type, Callable] = {
+    ast.Add: operator.add,
+    ast.Sub: operator.sub,
+    ast.Mult: operator.mul,
+    ast.Div: operator.truediv,
+    ast.Pow: operator.pow,
+}
+UNARY_OPERATORS: Dict[type, Callable] = {ast.USub: operator.neg, ast.UAdd: operator.pos}
+FUNCTIONS: Dict[str, Callable] = {
+    "abs": np.abs,
+    "sqrt": np.sqrt,
+    "log": np.log,
+    "exp": np.exp,
+    "minimum": np.minimum,
+    "maximum": np.maximum,
+    "clip": np.clip,
+}
+
+
+class SpectralIndex:
+    """Band math expression evaluated as vectorized NumPy over a (..., band, height, width) cube"""
+
+    def __init__(self, expression: str, bands: List[str] = RAW_BANDS):
+        self.expression: str = expression
+        self.bands: List[str] = bands
+        self.tree: ast.Expression = ast.parse(expression, mode="eval")
+        for node in ast.walk(self.tree):
+            if isinstance(node, ast.Name) and node.id not in bands and node.id not in FUNCTIONS:
+                raise ValueError(f"Unknown band {node.id} in expression {expression}. Bands available: {bands}")
+
+    def compute(self, data: ndarray) -> ndarray:
+        """Return the index for every pixel, NaN where the data mask is 0"""
+        band_data = {name: data[..., i, :, :] for i, name in enumerate(self.bands)}
+        with np.errstate(divide="ignore", invalid="ignore"):
+            result = np.asarray(self._evaluate(self.tree.body, band_data), dtype=np.float32)
+        if np.shares_memory(result, data):
+            # A bare band expression returns a view, never mask the input in place
+            result = result.copy()
+        if MASK_BAND in band_data:
+            result[band_data[MASK_BAND] == 0] = np.nan
+        return result
+
+    def _evaluate(self, node: ast.AST, band_data: Dict[str, ndarray]):
+        if isinstance(node, ast.BinOp) and type(node.op) in BINARY_OPERATORS:
+            return BINARY_OPERATORS[type(node.op)](
+                self._evaluate(node.left, band_data), self._evaluate(node.right, band_data)
+            )
+        if isinstance(node, ast.UnaryOp) and type(node.op) in UNARY_OPERATORS:
+            return UNARY_OPERATORS[type(node.op)](self._evaluate(node.operand, band_data))
+        if isinstance(node, ast.Constant) and isinstance(node.value, (int, float)):
+            return node.value
+        if isinstance(node, ast.Name) and node.id in band_data:
+            return band_data[node.id]
+        if isinstance(node, ast.Call) and isinstance(node.func, ast.Name) and node.func.id in FUNCTIONS:
+            return FUNCTIONS[node.func.id](*[self._evaluate(arg, band_data) for arg in node.args])
+        raise ValueError(f"Unsupported expression {ast.dump(node)} in {self.expression}")
+
+
+def parse_to_spectral_index(index: str) -> SpectralIndex:
+    """Build a SpectralIndex from a known index name (ndvi, ndsi) or a custom band math expression"""
+    try:
+        constant = IndicesConstants(index.lower())
+    except ValueError:
+        return SpectralIndex(index)
+    return SpectralIndex(INDEX_EXPRESSIONS[constant])
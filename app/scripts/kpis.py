@@ -1,5 +1,7 @@
+import re
+import warnings
 from enum import Enum
-from typing import Optional, Tuple
+from typing import Dict, List, Optional, Tuple
 
 import numpy as np
 from numpy.core.multiarray import ndarray
@@ -10,6 +12,11 @@ class KPIsConstants(Enum):
     MAX = "max"
     MIN = "min"
     STD = "std"
+    VALID_FRACTION = "valid_fraction"
+
+
+# Percentiles are requested as p<q>, e.g. p10, p50 or p97.5
+PERCENTILE_PATTERN = re.compile(r"^p(\d{1,2}(\.\d+)?|100)$")
 
 
 def parse_to_constant_kpi(kpi: str) -> KPIsConstants:
@@ -19,30 +26,129 @@ def parse_to_constant_kpi(kpi: str) -> KPIsConstants:
         return KPIsConstants.MEAN
 
 
+def parse_kpis(kpi: Optional[str], kpis: Optional[List[str]] = None) -> List[str]:
+    """Validate the statistics requested, the target kpi (the mean when not given) always comes first"""
+    kpi = kpi or KPIsConstants.MEAN.value
+    names = [kpi] + [name for name in (kpis or []) if name != kpi]
+    for name in names:
+        if not PERCENTILE_PATTERN.match(name) and name not in [constant.value for constant in KPIsConstants]:
+            raise ValueError(f"KPI {name} not supported. KPIs supported: {[c.value for c in KPIsConstants]}, p<q>")
+    return names
+
+
+def percentile_of(kpi: str) -> Optional[float]:
+    match = PERCENTILE_PATTERN.match(kpi)
+    return float(match.group(1)) if match else None
+
+
 class KPIs:
-    def __init__(self, data: ndarray, axis: Tuple, kpi: KPIsConstants):
+    """Statistics of a cube over `axis`, ignoring NaNs and pixels outside the optional validity mask"""
+
+    def __init__(self, data: ndarray, axis: Tuple, kpi: KPIsConstants, mask: Optional[ndarray] = None):
         self.data: ndarray = data
         self.axis: Tuple = axis
         self.kpi: KPIsConstants = kpi
+        self.mask: Optional[ndarray] = mask
 
     def get_kpi(self) -> Optional[ndarray]:
-        if self.kpi == KPIsConstants.MEAN:
-            return self.get_mean()
-        elif self.kpi == KPIsConstants.MAX:
-            return self.get_max()
-        elif self.kpi == KPIsConstants.MIN:
-            return self.get_min()
-        elif self.kpi == KPIsConstants.STD:
-            return self.get_std()
+        return self.get_kpis([self.kpi.value])[self.kpi.value]
+
+    def get_kpis(self, kpis: List[str]) -> Dict[str, ndarray]:
+        """Compute every requested statistic in one vectorized pass over the data"""
+        valid = np.isfinite(self.data)
+        if self.mask is not None:
+            valid &= self.mask
+        data = np.where(valid, self.data, np.nan)
+        count = valid.sum(axis=self.axis)
+        total = np.prod([self.data.shape[axis] for axis in self.axis])
+        result = {}
+        with warnings.catch_warnings(), np.errstate(divide="ignore", invalid="ignore"):
+            # Images without any valid pixel yield NaN statistics
+            warnings.simplefilter("ignore", RuntimeWarning)
+            mean = np.nansum(data, axis=self.axis) / count
+            percentiles = [kpi for kpi in kpis if percentile_of(kpi) is not None]
+            if percentiles:
+                values = np.nanpercentile(data, [percentile_of(kpi) for kpi in percentiles], axis=self.axis)
+                result.update(dict(zip(percentiles, values)))
+            for kpi in kpis:
+                if kpi == KPIsConstants.MEAN.value:
+                    result[kpi] = mean
+                elif kpi == KPIsConstants.STD.value:
+                    deviations = np.square(data - np.expand_dims(mean, self.axis))
+                    result[kpi] = np.sqrt(np.nansum(deviations, axis=self.axis) / count)
+                elif kpi == KPIsConstants.MAX.value:
+                    result[kpi] = np.nanmax(data, axis=self.axis)
+                elif kpi == KPIsConstants.MIN.value:
+                    result[kpi] = np.nanmin(data, axis=self.axis)
+                elif kpi == KPIsConstants.VALID_FRACTION.value:
+                    result[kpi] = count / total
+        return result
 
     def get_mean(self) -> ndarray:
-        return np.mean(self.data, axis=self.axis)
+        return self.get_kpis([KPIsConstants.MEAN.value])[KPIsConstants.MEAN.value]
 
     def get_max(self) -> ndarray:
-        return np.max(self.data, axis=self.axis)
+        return self.get_kpis([KPIsConstants.MAX.value])[KPIsConstants.MAX.value]
 
     def get_min(self) -> ndarray:
-        return np.min(self.data, axis=self.axis)
+        return self.get_kpis([KPIsConstants.MIN.value])[KPIsConstants.MIN.value]
 
     def get_std(self) -> ndarray:
-        return np.std(self.data, axis=self.axis)
+        return self.get_kpis([KPIsConstants.STD.value])[KPIsConstants.STD.value]
+
+
+class KPIAccumulator:
+    """Streaming statistics of one image fed block by block. Mean and std are merged with the Welford/Chan
+    parallel update; only percentiles need the valid values of the image to be kept until the end."""
+
+    def __init__(self, kpis: Optional[List[str]] = None):
+        self.kpis: List[str] = kpis or [KPIsConstants.MEAN.value]
+        self.count: int = 0
+        self.total: int = 0
+        self.mean: float = 0.0
+        self.m2: float = 0.0
+        self.min: float = np.inf
+        self.max: float = -np.inf
+        self.keep_values: bool = any(percentile_of(kpi) is not None for kpi in self.kpis)
+        self.values: List[ndarray] = []
+
+    def update(self, block: ndarray, mask: Optional[ndarray] = None) -> None:
+        self.total += block.size
+        valid = np.isfinite(block)
+        if mask is not None:
+            valid &= mask
+        block = block[valid] if not valid.all() else block.ravel()
+        count = block.size
+        if count == 0:
+            return
+        mean = float(block.mean(dtype=np.float64))
+        m2 = float(np.square(block - mean, dtype=np.float64).sum())
+        delta = mean - self.mean
+        total = self.count + count
+        self.mean += delta * count / total
+        self.m2 += m2 + delta * delta * self.count * count / total
+        self.count = total
+        self.min = min(self.min, float(block.min()))
+        self.max = max(self.max, float(block.max()))
+        if self.keep_values:
+            self.values.append(block.copy())
+
+    def get_kpis(self) -> Dict[str, float]:
+        result = {}
+        values = np.concatenate(self.values) if self.values else np.empty(0)
+        for kpi in self.kpis:
+            if kpi == KPIsConstants.VALID_FRACTION.value:
+                result[kpi] = self.count / self.total if self.total else 0.0
+            elif self.count == 0:
+                result[kpi] = np.nan
+            elif kpi == KPIsConstants.MEAN.value:
+                result[kpi] = self.mean
+            elif kpi == KPIsConstants.STD.value:
+                result[kpi] = float(np.sqrt(self.m2 / self.count))
+            elif kpi == KPIsConstants.MAX.value:
+                result[kpi] = self.max
+            elif kpi == KPIsConstants.MIN.value:
+                result[kpi] = self.min
+            elif percentile_of(kpi) is not None:
+                result[kpi] = float(np.percentile(values, percentile_of(kpi)))
+        return result
@@ -0,0 +1,171 @@
+import logging
+import os
+import time
+from pathlib import Path
+from typing import Dict, List, Optional
+
+import numpy as np
+import rasterio
+from configuration.configuration import Configuration
+from models.features import FeatureBuilder, seasonal_period
+from numpy.core.multiarray import ndarray
+from rasterio.windows import Window
+from scripts.indices import SpectralIndex
+from utils import load_environment, set_logging
+from utils.process_data import tifs_to_datacube
+
+load_environment()
+set_logging()
+logger = logging.getLogger(__name__)
+
+
+class PixelForecaster:
+    """Seasonal autoregression fitted independently for every pixel, all pixels at once.
+
+    Each pixel follows y_t = b0 + b1 t + sum_k (a_k sin + c_k cos)(2 pi k time_t / period) + sum_l phi_l y_(t-l).
+    The deterministic columns are shared by every pixel, only the lagged values differ, so the normal
+    equations of the whole chunk are accumulated with einsum over time and solved as one batch of
+    small k x k systems. Missing observations get zero weight; pixels with fewer than
+    `min_observations` usable periods are not forecast."""
+
+    def __init__(
+        self,
+        lags: List[int] = [1],
+        period: int = 52,
+        fourier_order: int = 2,
+        trend: bool = True,
+        ridge: float = 1e-6,
+        min_observations: int = 20,
+    ):
+        self.builder: FeatureBuilder = FeatureBuilder(lags=lags, windows=[], period=period, fourier_order=fourier_order)
+        self.lags: List[int] = self.builder.lags
+        self.trend: bool = trend
+        self.ridge: float = ridge
+        self.min_observations: int = min_observations
+
+    def deterministic(self, positions: ndarray, times: ndarray, length: int) -> ndarray:
+        """(time, columns) intercept, trend and Fourier columns shared by every pixel"""
+        columns = [np.ones((len(positions), 1))]
+        if self.trend:
+            columns.append((positions / max(length, 1))[:, None])
+        columns.append(self.builder.seasonal(times))
+        return np.hstack(columns)
+
+    def fit_forecast(self, values: ndarray, times: ndarray, steps: int) -> ndarray:
+        """Forecast `steps` periods for a (time, pixels) block, returning (steps, pixels)"""
+        length, pixels = values.shape
+        history = max(self.lags)
+        positions = np.arange(length, dtype=np.float64)
+        shared = self.deterministic(positions, times, length)[history:]
+        target = values[history:]
+        lagged = np.stack([values[history - lag : length - lag] for lag in self.lags], axis=-1)
+        weights = (np.isfinite(target) & np.isfinite(lagged).all(axis=-1)).astype(np.float64)
+        target = np.where(weights > 0, target, 0)
+        lagged = np.where(weights[..., None] > 0, lagged, 0)
+
+        # Normal equations of every pixel, in blocks of shared and lagged columns
+        ss = np.einsum("tp,ti,tj->pij", weights, shared, shared, optimize=True)
+        sl = np.einsum("tp,ti,tpl->pil", weights, shared, lagged, optimize=True)
+        ll = np.einsum("tp,tpl,tpm->plm", weights, lagged, lagged, optimize=True)
+        xtx = np.concatenate(
+            [np.concatenate([ss, sl], axis=2), np.concatenate([sl.transpose(0, 2, 1), ll], axis=2)], axis=1
+        )
+        xty = np.concatenate(
+            [
+                np.einsum("tp,ti,tp->pi", weights, shared, target, optimize=True),
+                np.einsum("tp,tpl,tp->pl", weights, lagged, target, optimize=True),
+            ],
+            axis=1,
+        )
+        xtx += self.ridge * np.eye(xtx.shape[1])
+        coefficients = np.linalg.solve(xtx, xty[..., None])[..., 0]
+        fitted = weights.sum(axis=0) >= self.min_observations
+
+        # Recursive forecast, missing recent values are replaced by the pixel mean
+        observed = np.isfinite(values)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            mean = np.where(observed, values, 0).sum(axis=0) / observed.sum(axis=0)
+        recent = values[-history:].copy()
+        recent = np.where(np.isfinite(recent), recent, mean)
+        future_times = []
+        current = float(times[-1])
+        for _ in range(steps):
+            current = self.builder.next_time(current)
+            future_times.append(current)
+        future_shared = self.deterministic(
+            np.arange(length, length + steps, dtype=np.float64), np.array(future_times), length
+        )
+        forecasts = np.empty((steps, pixels))
+        columns = shared.shape[1]
+        for step in range(steps):
+            lag_values = np.stack([recent[-lag] for lag in self.lags], axis=-1)
+            forecast = coefficients[:, :columns] @ future_shared[step]
+            forecast += (coefficients[:, columns:] * lag_values).sum(axis=-1)
+            forecasts[step] = forecast
+            recent = np.concatenate([recent[1:], forecast[None]], axis=0)
+        forecasts[:, ~fitted] = np.nan
+        return forecasts
+
+
+def frames_to_values(block: ndarray, spectral_index: Optional[SpectralIndex] = None) -> ndarray:
+    """Turn a (time, band, rows, width) block into normalised (time, rows, width) values, NaN where nodata"""
+    block = block.astype(np.float32)
+    if spectral_index is not None:
+        return spectral_index.compute(block)
+    return block[:, 0] / 255
+
+
+def forecast_pixels(
+    name_id: str,
+    tifs: List[Path],
+    time_values: ndarray,
+    pixel_config: Dict,
+    spectral_index: Optional[SpectralIndex] = None,
+    interval_type: str = "weeks",
+) -> str:
+    """Forecast every pixel of the datacube of name_id and write one GeoTIFF band per forecast step.
+
+    The datacube is read in bands of rows of about `chunk_pixels` pixels, so memory depends on the
+    chunk and the number of periods, never on the scene size."""
+    forecaster = PixelForecaster(
+        lags=pixel_config.get("lags", [1]),
+        period=pixel_config.get("period", seasonal_period(interval_type)),
+        fourier_order=pixel_config.get("fourier_order", 2),
+        trend=pixel_config.get("trend", True),
+        ridge=pixel_config.get("ridge", 1e-6),
+        min_observations=pixel_config.get("min_observations", 20),
+    )
+    steps = pixel_config.get("steps", 4)
+    cube, mask = tifs_to_datacube(name_id, list(tifs), spectral_index)
+    frames, _, height, width = cube.shape
+    if frames <= max(forecaster.lags):
+        raise ValueError(f"{frames} rasters are not enough to forecast with lags {forecaster.lags}")
+    rows_per_chunk = max(1, pixel_config.get("chunk_pixels", 65536) // width)
+
+    forecasts_path = os.path.join(str(Configuration()["forecasts_path"]), name_id)
+    if not os.path.exists(forecasts_path):
+        os.makedirs(forecasts_path)
+        logger.info(f"Directory {forecasts_path} created")
+    output_path = os.path.join(forecasts_path, "pixel_forecast.tif")
+    with rasterio.open(tifs[-1]) as src:
+        profile = src.profile
+    profile.update(count=steps, dtype="float32", nodata=np.nan, tiled=True, compress="deflate")
+    profile.pop("blockxsize", None)
+    profile.pop("blockysize", None)
+
+    start = time.perf_counter()
+    times = np.asarray(time_values, dtype=np.float64)
+    with rasterio.open(output_path, "w", **profile) as dst:
+        for row in range(0, height, rows_per_chunk):
+            rows = min(rows_per_chunk, height - row)
+            values = frames_to_values(cube[:, :, row : row + rows, :], spectral_index)
+            values[~mask[:, row : row + rows, :]] = np.nan
+            forecast = forecaster.fit_forecast(values.reshape(frames, -1).astype(np.float64), times, steps)
+            dst.write(forecast.reshape(steps, rows, width).astype(np.float32), window=Window(0, row, width, rows))
+        for step in range(1, steps + 1):
+            dst.set_band_description(step, f"t+{step}")
+    logger.info(
+        f"Pixel forecast of {height}x{width} pixels, {steps} steps, written to {output_path} "
+        f"in {time.perf_counter() - start:.1f}s"
+    )
+    return output_path
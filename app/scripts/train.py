@@ -0,0 +1,158 @@
+import logging
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import Any, Dict, List, Optional, Tuple
+
+from models.ml_model import Model
+from pandas import DataFrame, concat
+from utils import load_environment, set_logging
+from utils.instrumentation import recorder
+from utils.model_store import ModelStore, model_key
+from utils.parallel import limit_worker, pool_workers
+from utils.series_cache import SeriesCache
+
+load_environment()
+set_logging()
+logger = logging.getLogger(__name__)
+
+# Dataframes of the worker process, received once when the worker starts instead of with every task
+_dataframes: Dict[int, DataFrame] = {}
+
+
+def _init_worker(dataframes: Dict[int, DataFrame]) -> None:
+    _dataframes.update(dataframes)
+    # A forked worker starts with a copy of the parent's records, only its own must go back
+    recorder.reset()
+    # Each worker is one unit of the budget, BLAS, OpenMP and joblib pools must not multiply it
+    limit_worker()
+
+
+def fit_model(model: Model, model_path: Optional[str] = None) -> float:
+    """Train, evaluate and optionally save one model, returning the seconds it took"""
+    start = time.perf_counter()
+    model.train_model()
+    model.evaluate()
+    if model_path:
+        model.save_model(model_path)
+    return time.perf_counter() - start
+
+
+def _fit_task(
+    task: Tuple[int, type, Any, Dict, Optional[str], str, Optional[str]]
+) -> Tuple[Any, float, Dict[str, Any]]:
+    df_key, model_class, kpi, model_params, name_id, interval_type, model_path = task
+    model = model_class(_dataframes[df_key], kpi, model_params)
+    model.name_id = name_id
+    model.interval_type = interval_type
+    seconds = fit_model(model, model_path)
+    # The stages measured in the worker go back with the fit, to be merged into the parent's run report
+    return model.model_fit, seconds, recorder.drain()
+
+
+def train_models(
+    models: List[Model],
+    model_paths: Optional[List[Optional[str]]] = None,
+    workers: int = 1,
+    store: Optional[ModelStore] = None,
+) -> None:
+    """Fit the models concurrently in a pool of at most `workers` processes.
+
+    Models may come from several configs: every distinct dataframe is shipped to each worker once,
+    tasks only carry the model class, kpi, params and save path. The fitted models come back to
+    the parent, so prediction and visualization run on them as if they had been trained in place.
+    With a store, models already fitted on the same data and params are loaded instead."""
+    model_paths = model_paths or [None] * len(models)
+    keys = [model_key(model) for model in models] if store is not None else [None] * len(models)
+    pending = []
+    for model, model_path, key in zip(models, model_paths, keys):
+        model_fit = store.get(key) if store is not None else None
+        if model_fit is None:
+            pending.append((model, model_path, key))
+            continue
+        model.model_fit = model_fit
+        model.split()
+        model.evaluate()
+        if model_path:
+            model.save_model(model_path)
+    if store is not None:
+        logger.info(f"{len(models) - len(pending)} of {len(models)} models loaded from the model store")
+
+    if workers <= 1 or len(pending) <= 1:
+        for model, model_path, key in pending:
+            seconds = fit_model(model, model_path)
+            logger.info(f"{model.__class__.__name__} trained in {seconds:.1f}s")
+            if store is not None:
+                store.put(key, model.model_fit, model.__class__.__name__, model.name_id)
+        return
+
+    dataframes = {id(model.df): model.df for model, _, _ in pending}
+    start = time.perf_counter()
+    with pool_workers(min(workers, len(pending))) as workers, ProcessPoolExecutor(
+        max_workers=workers, initializer=_init_worker, initargs=(dataframes,)
+    ) as pool:
+        logger.info(f"Training {len(pending)} models on {len(dataframes)} dataframes with {workers} workers")
+        futures = {
+            pool.submit(
+                _fit_task,
+                (
+                    id(model.df),
+                    model.__class__,
+                    model.kpi,
+                    model.model_params,
+                    model.name_id,
+                    model.interval_type,
+                    model_path,
+                ),
+            ): (
+                model,
+                model_path,
+                key,
+            )
+            for model, model_path, key in pending
+        }
+        for future in as_completed(futures):
+            model, model_path, key = futures[future]
+            model.model_fit, seconds, records = future.result()
+            recorder.merge(records)
+            if model_path:
+                model.model_name = model_path
+            logger.info(f"{model.__class__.__name__} trained in {seconds:.1f}s")
+            if store is not None:
+                store.put(key, model.model_fit, model.__class__.__name__, model.name_id)
+    logger.info(f"Training finished in {time.perf_counter() - start:.1f}s")
+
+
+def update_models(
+    models: List[Model],
+    new_df: DataFrame,
+    model_paths: List[Optional[str]],
+    series_cache: SeriesCache,
+    refit_every: int = 12,
+) -> List[int]:
+    """Update the saved fits of the models with the rows of new_df in place, at a cost that depends on the
+    new rows only. Returns the positions of the models that need a full refit instead: those never saved
+    and those that reached `refit_every` updates (a model_params value overrides the default)."""
+    refits = []
+    for i, (model, model_path) in enumerate(zip(models, model_paths)):
+        name = model.__class__.__name__
+        every = model.model_params.get("refit_every", refit_every)
+        if not model_path or not os.path.exists(model_path) or series_cache.updates(name) + 1 >= every:
+            model.df = concat([model.df, new_df], ignore_index=True)
+            refits.append(i)
+            continue
+        model.model_fit = model.load_model(model_path)
+        rows = len(model.df) + len(new_df)
+        if len(new_df) == 0 or series_cache.fitted(name) == rows:
+            # Nothing new, or a previous run failed after saving this fit with the new rows
+            model.df = concat([model.df, new_df], ignore_index=True)
+            model.split()
+            continue
+        start = time.perf_counter()
+        model.update(new_df)
+        model.evaluate()
+        model.save_model(model_path)
+        series_cache.record_update(name, refit=False, rows=rows)
+        seconds = time.perf_counter() - start
+        logger.info(f"{name} updated in {seconds:.1f}s, {series_cache.updates(name)} of {every} updates before a refit")
+    return refits
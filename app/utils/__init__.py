@@ -1 +1,2 @@
+from utils.environment import load_environment
 from utils.logging import set_logging
@@ -0,0 +1,97 @@
+import bisect
+import hashlib
+import json
+import logging
+import os
+from datetime import datetime, timedelta
+from typing import List, Optional, Tuple
+
+from configuration.configuration import Configuration
+from requests_oauthlib import OAuth2Session
+from utils.logging import set_logging
+from utils.tiling import normalize_bbox
+
+set_logging()
+logger = logging.getLogger(__name__)
+
+# Searches whose range reaches past the moment they were run may gain acquisitions later on
+RECENT_SEARCH_TTL = timedelta(days=1)
+PAGE_LIMIT = 100
+
+
+class Catalog:
+    """Query the STAC catalog for the acquisitions available over a bbox, caching every search locally"""
+
+    def __init__(self, session: OAuth2Session, url: str, cache_path: Optional[str] = None):
+        if cache_path is None:
+            cache_path = os.path.join(str(Configuration()["cache_path"]), "catalog")
+        if not os.path.exists(cache_path):
+            os.makedirs(cache_path)
+            logger.info(f"Directory {cache_path} created")
+        self.session: OAuth2Session = session
+        self.url: str = url
+        self.cache_path: str = cache_path
+
+    def search(
+        self, bbox: List[float], start_date: datetime, end_date: datetime, collection: str, max_cloud_coverage: float
+    ) -> List[datetime]:
+        body = {
+            "bbox": list(normalize_bbox(bbox)),
+            "datetime": f"{start_date.isoformat()}Z/{end_date.isoformat()}Z",
+            "collections": [collection],
+            "limit": PAGE_LIMIT,
+            "filter": f"eo:cloud_cover <= {max_cloud_coverage}",
+            "filter-lang": "cql2-text",
+            "fields": {"include": ["properties.datetime"], "exclude": ["geometry", "assets", "links", "bbox"]},
+        }
+        key = hashlib.sha256(json.dumps([self.url, body], sort_keys=True).encode()).hexdigest()
+        cache_file = os.path.join(self.cache_path, f"{key}.json")
+        if os.path.exists(cache_file):
+            with open(cache_file, "r") as f:
+                cached = json.load(f)
+            searched_at = datetime.fromisoformat(cached["searched_at"])
+            if end_date <= searched_at or datetime.now() - searched_at < RECENT_SEARCH_TTL:
+                logger.info(f"Using cached catalog search {cache_file}")
+                return [datetime.fromisoformat(date) for date in cached["acquisitions"]]
+
+        searched_at = datetime.now()
+        acquisitions = set()
+        pages = 0
+        while True:
+            resp = self.session.post(self.url, json=body)
+            resp.raise_for_status()
+            result = resp.json()
+            pages += 1
+            for feature in result.get("features", []):
+                acquisition = datetime.fromisoformat(feature["properties"]["datetime"].replace("Z", "+00:00"))
+                acquisitions.add(acquisition.replace(tzinfo=None))
+            next_page = result.get("context", {}).get("next")
+            if next_page is None:
+                break
+            body["next"] = next_page
+
+        acquisitions = sorted(acquisitions)
+        logger.info(f"Catalog returned {len(acquisitions)} acquisitions in {pages} pages")
+        with open(cache_file, "w") as f:
+            json.dump(
+                {
+                    "searched_at": searched_at.isoformat(),
+                    "acquisitions": [acquisition.isoformat() for acquisition in acquisitions],
+                },
+                f,
+            )
+        return acquisitions
+
+
+def filter_windows(
+    windows: List[Tuple[datetime, datetime, str]], acquisitions: List[datetime]
+) -> Tuple[List[Tuple[datetime, datetime, str]], List[Tuple[datetime, datetime, str]]]:
+    """Split the windows into those containing at least one acquisition and those that are empty"""
+    available, empty = [], []
+    for window in windows:
+        i = bisect.bisect_left(acquisitions, window[0])
+        if i < len(acquisitions) and acquisitions[i] < window[1]:
+            available.append(window)
+        else:
+            empty.append(window)
+    return available, empty
@@ -0,0 +1,128 @@
+import json
+import logging
+import os
+import shutil
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+import rasterio
+from configuration.configuration import Configuration
+from utils.instrumentation import ByteCounterConstants, add_bytes
+from utils.logging import set_logging
+
+set_logging()
+logger = logging.getLogger(__name__)
+
+
+class Datacube:
+    """Append-only, memory-mapped (time, band, height, width) cache of the rasters downloaded for a name_id.
+
+    Frames are appended to a raw binary file in the order they are first seen and described by an
+    index with the source file name, size and modification time, so later runs only decode new
+    rasters. A (time, height, width) validity mask is stored alongside."""
+
+    CUBE_FILE = "cube.dat"
+    MASK_FILE = "mask.dat"
+    INDEX_FILE = "index.json"
+
+    def __init__(self, name_id: str, cache_path: Optional[str] = None, mask_band: Optional[int] = None):
+        if cache_path is None:
+            cache_path = os.path.join(str(Configuration()["cache_path"]), "datacube")
+        self.path: str = os.path.join(cache_path, name_id)
+        self.mask_band: Optional[int] = mask_band
+        self.index: Dict[str, Any] = {"frames": []}
+        index_path = os.path.join(self.path, self.INDEX_FILE)
+        if os.path.exists(index_path):
+            with open(index_path, "r") as f:
+                self.index = json.load(f)
+
+    @property
+    def frames(self) -> List[Dict[str, Any]]:
+        return self.index["frames"]
+
+    def update(self, tifs: List[Path]) -> None:
+        """Append the rasters not cached yet, rebuilding only if a cached one changed on disk"""
+        positions = {frame["name"]: i for i, frame in enumerate(self.frames)}
+        stale = [
+            tif
+            for tif in tifs
+            if tif.name in positions and self._signature(tif) != self.frames[positions[tif.name]]["signature"]
+        ]
+        if stale or (self.frames and self.index.get("mask_band") != self.mask_band):
+            logger.info(f"Datacube {self.path} out of date, rebuilding")
+            self.clear()
+            positions = {}
+        new = [tif for tif in tifs if tif.name not in positions]
+        if not new:
+            logger.info(f"Datacube {self.path} up to date with {len(self.frames)} frames")
+            return
+
+        os.makedirs(self.path, exist_ok=True)
+        with open(os.path.join(self.path, self.CUBE_FILE), "ab") as cube_file, open(
+            os.path.join(self.path, self.MASK_FILE), "ab"
+        ) as mask_file:
+            # Drop whatever an interrupted run may have written past the last indexed frame
+            frames, bands, height, width = self.shape if self.frames else (0, 0, 0, 0)
+            itemsize = np.dtype(self.index["dtype"]).itemsize if self.frames else 0
+            cube_file.truncate(frames * bands * height * width * itemsize)
+            mask_file.truncate(frames * height * width)
+            for tif in new:
+                with rasterio.open(tif) as src:
+                    data = src.read()
+                add_bytes(ByteCounterConstants.DECODED, data.nbytes)
+                if not self.frames:
+                    self.index.update(
+                        {
+                            "dtype": str(data.dtype),
+                            "bands": data.shape[0],
+                            "height": data.shape[1],
+                            "width": data.shape[2],
+                            "mask_band": self.mask_band,
+                        }
+                    )
+                elif data.shape != self.shape[1:] or str(data.dtype) != self.index["dtype"]:
+                    raise ValueError(f"Raster {tif} does not match the datacube shape {self.shape[1:]}")
+                cube_file.write(data.tobytes())
+                mask_file.write(self.validity(data).tobytes())
+                self.frames.append({"name": tif.name, "signature": self._signature(tif)})
+        self._save_index()
+        logger.info(f"Datacube {self.path}: {len(new)} frames appended, {len(self.frames)} in total")
+
+    def validity(self, data: np.ndarray) -> np.ndarray:
+        """Pixels that are finite in every band and, if there is one, not masked by the mask band"""
+        valid = np.isfinite(data).all(axis=0) if data.dtype.kind == "f" else np.ones(data.shape[1:], dtype=bool)
+        if self.mask_band is not None:
+            valid &= data[self.mask_band] != 0
+        return valid
+
+    @property
+    def shape(self) -> Tuple[int, int, int, int]:
+        return (len(self.frames), self.index["bands"], self.index["height"], self.index["width"])
+
+    def load(self, tifs: List[Path]) -> Tuple[np.ndarray, np.ndarray]:
+        """Map the cube and mask from disk and return the frames of `tifs`, in that order.
+        Contiguous selections are views on the memory map and cost nothing to create."""
+        frames, _, height, width = self.shape
+        cube = np.memmap(os.path.join(self.path, self.CUBE_FILE), dtype=self.index["dtype"], mode="r", shape=self.shape)
+        mask = np.memmap(os.path.join(self.path, self.MASK_FILE), dtype=bool, mode="r", shape=(frames, height, width))
+        positions = {frame["name"]: i for i, frame in enumerate(self.frames)}
+        selection = np.array([positions[tif.name] for tif in tifs], dtype=np.int64)
+        if len(selection) and np.all(np.diff(selection) == 1):
+            selection = slice(int(selection[0]), int(selection[-1]) + 1)
+        return cube[selection], mask[selection]
+
+    def clear(self) -> None:
+        if os.path.exists(self.path):
+            shutil.rmtree(self.path)
+        self.index = {"frames": []}
+
+    def _signature(self, tif: Path) -> List[float]:
+        stat = tif.stat()
+        return [stat.st_size, stat.st_mtime]
+
+    def _save_index(self) -> None:
+        index_path = os.path.join(self.path, self.INDEX_FILE)
+        with open(index_path + ".tmp", "w") as f:
+            json.dump(self.index, f)
+        os.replace(index_path + ".tmp", index_path)
@@ -1,14 +1,29 @@
+import copy
+import hashlib
+import json
 import logging
 import os
+import random
+import shutil
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
 from datetime import datetime
 from enum import Enum
-from typing import Any, Dict, Generator, List, Optional
+from typing import Any, Dict, Generator, List, Optional, Tuple
 
 from configuration.configuration import Configuration
 from dateutil.relativedelta import relativedelta
 from oauthlib.oauth2 import BackendApplicationClient
+from requests import RequestException
+from requests.adapters import HTTPAdapter
 from requests_oauthlib import OAuth2Session
+from utils.instrumentation import ByteCounterConstants, add_bytes, recorder, stage
 from utils.logging import set_logging
+from utils.manifest import DownloadManifest, WindowStatusConstants
+from utils.parallel import pool_workers
+from utils.scheduler import RequestScheduler, estimate_processing_units, parse_retry_after
+from utils.tiling import Tile, TileGrid
 
 set_logging()
 logger = logging.getLogger(__name__)
@@ -33,7 +48,7 @@ class DataTypeConstants(Enum):
 class UrlConstants(Enum):
     SENTINEL_API_PROCESS = "https://sh.services.sentinel-hub.com/api/v1/process"
     COPERNICUS_API_PROCESS = "https://sh.dataspace.copernicus.eu/api/v1/process"
-    COPERNICUS_CATALOG = "https://scihub.copernicus.eu/apihub/search"
+    COPERNICUS_CATALOG = "https://sh.dataspace.copernicus.eu/api/v1/catalog/1.0.0/search"
     COPERNICUS_TOKEN = "https://identity.dataspace.copernicus.eu/auth/realms/CDSE/protocol/openid-connect/token"
 
 
@@ -51,14 +66,87 @@ class ImageFormatConstants(Enum):
     JPEG = "image/jpeg"
 
 
+class DownloadStats:
+    """Thread-safe aggregate counters for a download run"""
+
+    def __init__(self):
+        self.images: int = 0
+        self.errors: int = 0
+        self.skipped: int = 0
+        self.retries: int = 0
+        self.bytes: int = 0
+        self.started_at: float = time.perf_counter()
+        self._lock = threading.Lock()
+
+    def record(self, size: int, error: bool) -> None:
+        with self._lock:
+            self.images += 1
+            self.bytes += size
+            if error:
+                self.errors += 1
+
+    def record_retry(self) -> None:
+        with self._lock:
+            self.retries += 1
+
+    def elapsed(self) -> float:
+        return time.perf_counter() - self.started_at
+
+    def summary(self) -> Dict[str, float]:
+        elapsed = max(self.elapsed(), 1e-9)
+        return {
+            "images": self.images,
+            "errors": self.errors,
+            "skipped": self.skipped,
+            "retries": self.retries,
+            "bytes": self.bytes,
+            "seconds": round(elapsed, 3),
+            "images_per_second": round(self.images / elapsed, 3),
+            "megabytes_per_second": round(self.bytes / elapsed / 1e6, 3),
+        }
+
+
+def payload_fingerprint(payload: Dict[str, Any], tiling: Optional[Dict[str, Any]] = None) -> str:
+    """Hash of what a request downloads but its dates: the payload without its time range and the tiling"""
+    payload = copy.deepcopy(payload)
+    for data in payload["input"]["data"]:
+        data.get("dataFilter", {}).pop(DataFilterConstants.TIME_RANGE.value, None)
+    settings = json.dumps({"payload": payload, "tiling": tiling}, sort_keys=True, default=str)
+    return hashlib.sha256(settings.encode()).hexdigest()
+
+
 class Downloader:
+    # Refresh the cached token this many seconds before it actually expires
+    TOKEN_EXPIRY_MARGIN = 60
+    RETRYABLE_STATUS_CODES = (408, 429, 500, 502, 503, 504)
+    MAX_BACKOFF = 60.0
 
-    def __init__(self, client_id: str, client_secret: str, token_url: Optional[str]):
+    def __init__(
+        self,
+        client_id: str,
+        client_secret: str,
+        token_url: Optional[str],
+        workers: int = 1,
+        max_retries: int = 3,
+        backoff_factor: float = 1.0,
+        scheduler: Optional[RequestScheduler] = None,
+        session_owner: Optional["Downloader"] = None,
+    ):
         self.client_id: str = client_id
         self.client_secret: str = client_secret
         if token_url is None:
             token_url = UrlConstants.COPERNICUS_TOKEN.value
         self.token_url: str = token_url
+        self.workers: int = max(1, workers)
+        self.max_retries: int = max_retries
+        self.backoff_factor: float = backoff_factor
+        self.scheduler: Optional[RequestScheduler] = scheduler
+        self.stats: DownloadStats = DownloadStats()
+        self._session: Optional[OAuth2Session] = None
+        self._token_expires_at: float = 0.0
+        self._session_lock = threading.Lock()
+        # Downloaders of other areas with the same credentials reuse the owner's session and token
+        self.session_owner: Optional["Downloader"] = session_owner
 
     def get_token(self, oauth: OAuth2Session, token_url: str) -> Dict[str, Any]:
         token = oauth.fetch_token(
@@ -77,38 +165,264 @@ class Downloader:
             raise e
         return oauth
 
-    def create_payload(self, bbox: List, data: List, format: str, evalscript: str) -> Dict[str, Any]:
+    def session(self) -> OAuth2Session:
+        """Return the shared, pooled session, fetching a new token only when it is about to expire"""
+        if self.session_owner is not None:
+            return self.session_owner.session()
+        with self._session_lock:
+            if self._session is None:
+                self._session = self.oauth()
+                adapter = HTTPAdapter(pool_connections=self.workers, pool_maxsize=self.workers)
+                self._session.mount("https://", adapter)
+                self._session.mount("http://", adapter)
+                self._token_expires_at = self._expires_at(self._session.token)
+            elif time.time() >= self._token_expires_at - self.TOKEN_EXPIRY_MARGIN:
+                logger.info("Token about to expire, refreshing")
+                self._session.token = self.get_token(self._session, self.token_url)
+                self._token_expires_at = self._expires_at(self._session.token)
+            return self._session
+
+    def _expires_at(self, token: Dict[str, Any]) -> float:
+        if "expires_at" in token:
+            return float(token["expires_at"])
+        return time.time() + float(token.get("expires_in", 300))
+
+    def create_payload(
+        self, bbox: List, data: List, format: str, evalscript: str, width: int = 512, height: int = 512
+    ) -> Dict[str, Any]:
         payload = {
             "input": {
                 "bounds": {"bbox": bbox},
                 "data": data,
             },
             "output": {
-                "width": 512,
-                "height": 512,
+                "width": width,
+                "height": height,
                 "responses": [{"identifier": "default", "format": {"type": format}}],
             },
             "evalscript": evalscript,
         }
         return payload
 
-    def download(self, url: str, payload: Dict[str, Any], folder: str, image_name: str) -> None:
-        oauth = self.oauth()
-        resp = oauth.post(url, json=payload)
-        error = resp.status_code != 200
+    def backoff(self, attempt: int) -> float:
+        """Exponential backoff with full jitter for the given (zero based) retry attempt"""
+        return random.uniform(0, min(self.MAX_BACKOFF, self.backoff_factor * 2**attempt))
+
+    def post(self, url: str, payload: Dict[str, Any]) -> Tuple[Optional[int], bytes, Optional[float]]:
+        """Send one Process API request through the scheduler, if any.
+        Returns the status code (None on connection errors), the content and the Retry-After delay"""
+        if self.scheduler is not None:
+            self.scheduler.acquire(estimate_processing_units(payload))
+        status_code, retry_after = None, None
+        start = time.perf_counter()
+        try:
+            resp = self.session().post(url, json=payload)
+            status_code, content = resp.status_code, resp.content
+            retry_after = parse_retry_after(resp.headers.get("Retry-After"))
+        except RequestException as e:
+            content = str(e).encode()
+        finally:
+            if self.scheduler is not None:
+                self.scheduler.release(status_code, time.perf_counter() - start, retry_after)
+        return status_code, content, retry_after
+
+    def request(self, url: str, payload: Dict[str, Any], image_name: str) -> Tuple[bool, bytes, int]:
+        """Send a request, retrying retryable failures. Returns the error flag, the content and the attempts made"""
+        attempts = 0
+        while True:
+            attempts += 1
+            status_code, content, retry_after = self.post(url, payload)
+            error = status_code != 200
+            retryable = status_code is None or status_code in self.RETRYABLE_STATUS_CODES
+            if not error or not retryable or attempts > self.max_retries:
+                break
+            delay = retry_after if retry_after is not None else self.backoff(attempts - 1)
+            logger.warning(
+                f"Request for {image_name} failed with status {status_code}, "
+                f"retrying in {delay:.1f}s ({attempts}/{self.max_retries})"
+            )
+            self.stats.record_retry()
+            if self.scheduler is not None:
+                self.scheduler.record_retry()
+            time.sleep(delay)
 
         if error:
-            logger.error(f"Error downloading image from {url}")
-            logger.error(resp.content)
+            logger.error(f"Error downloading image {image_name} from {url}")
+            logger.error(content)
+        return error, content, attempts
+
+    def download(
+        self,
+        url: str,
+        payload: Dict[str, Any],
+        folder: str,
+        image_name: str,
+        manifest: Optional[DownloadManifest] = None,
+    ) -> bool:
+        with stage("download_window", item=image_name):
+            error, content, attempts = self.request(url, payload, image_name)
+            add_bytes(ByteCounterConstants.DOWNLOADED, len(content))
+            format = payload["output"]["responses"][0]["format"]["type"]
+            image_path = self.get_image_path(format, folder, image_name, error)
+
+            content = content if not error else b""
+            with open(image_path, "wb") as f:
+                f.write(content)
 
+            self.complete(format, folder, image_name, image_path, error, attempts, manifest)
+        return not error
+
+    def download_tile(
+        self, url: str, payload: Dict[str, Any], tiles_dir: str, image_name: str, tile: Tile, extension: str
+    ) -> Tuple[bool, int, str, int]:
+        """Download one tile of a window unless a complete one was left by a previous run.
+        Returns the error flag, the attempts made, the tile path and the bytes downloaded"""
+        tile_path = os.path.join(tiles_dir, tile.name + extension)
+        with stage("download_tile", item=f"{image_name} {tile.name}"):
+            if os.path.exists(tile_path) and TileGrid.is_complete(tile, tile_path):
+                return False, 0, tile_path, 0
+            tile_payload = copy.deepcopy(payload)
+            tile_payload["input"]["bounds"]["bbox"] = tile.bbox
+            tile_payload["output"]["width"] = tile.width
+            tile_payload["output"]["height"] = tile.height
+            error, content, attempts = self.request(url, tile_payload, f"{image_name} {tile.name}")
+            add_bytes(ByteCounterConstants.DOWNLOADED, len(content))
+            if not error:
+                # Written aside and moved in place, an interrupted run never leaves a truncated tile behind
+                with open(tile_path + ".tmp", "wb") as f:
+                    f.write(content)
+                os.replace(tile_path + ".tmp", tile_path)
+        return error, attempts, tile_path, len(content)
+
+    def download_tiled(
+        self,
+        executor: ThreadPoolExecutor,
+        url: str,
+        payload: Dict[str, Any],
+        folder: str,
+        image_name: str,
+        grid: TileGrid,
+        manifest: Optional[DownloadManifest] = None,
+    ) -> List[Future]:
+        """Submit every tile of the window to the shared pool, one job per tile, so at most `workers`
+        requests are in flight whatever the number of tiles. The job finishing the last tile stitches
+        them into one GeoTIFF for the window"""
         format = payload["output"]["responses"][0]["format"]["type"]
-        image_path = self.get_image_path(format, folder, image_name, error)
+        tiles_dir = os.path.join(TILES_PATH, folder, image_name)
+        if manifest is not None and not manifest.same_settings(image_name) and os.path.exists(tiles_dir):
+            # Tiles left by a failed run with other settings cannot be reused
+            shutil.rmtree(tiles_dir)
+        os.makedirs(tiles_dir, exist_ok=True)
+        extension = ".png" if format == ImageFormatConstants.PNG.value else ".tif"
+        results: List[Optional[Tuple[bool, int, str, int]]] = [None] * len(grid.tiles)
+        remaining = [len(grid.tiles)]
+        lock = threading.Lock()
+
+        def run_tile(i: int, tile: Tile) -> bool:
+            try:
+                results[i] = self.download_tile(url, payload, tiles_dir, image_name, tile, extension)
+            except Exception as e:
+                logger.error(f"Error downloading tile {tile.name} of {image_name}: {e}")
+                results[i] = (True, 1, os.path.join(tiles_dir, tile.name + extension), 0)
+            with lock:
+                remaining[0] -= 1
+                if remaining[0]:
+                    return True
+            return self.complete_tiled(folder, image_name, grid, tiles_dir, results, manifest)
 
-        with open(image_path, "wb") as f:
-            f.write(resp.content if not error else b"")
+        return [recorder.submit(executor, run_tile, i, tile) for i, tile in enumerate(grid.tiles)]
 
+    def complete_tiled(
+        self,
+        folder: str,
+        image_name: str,
+        grid: TileGrid,
+        tiles_dir: str,
+        results: List[Tuple[bool, int, str, int]],
+        manifest: Optional[DownloadManifest],
+    ) -> bool:
+        with stage("mosaic_window", item=image_name):
+            error = any(tile_error for tile_error, _, _, _ in results)
+            attempts = max(tile_attempts for _, tile_attempts, _, _ in results)
+
+            image_path = self.get_image_path(ImageFormatConstants.TIFF.value, folder, image_name, error)
+            if error:
+                # Tiles already fetched are kept so the next run only requests the missing ones
+                open(image_path, "wb").close()
+            else:
+                grid.mosaic([(tile, path) for tile, (_, _, path, _) in zip(grid.tiles, results)], image_path)
+                shutil.rmtree(tiles_dir)
+
+            self.complete(ImageFormatConstants.TIFF.value, folder, image_name, image_path, error, attempts, manifest)
+        return not error
+
+    def complete(
+        self,
+        format: str,
+        folder: str,
+        image_name: str,
+        image_path: str,
+        error: bool,
+        attempts: int,
+        manifest: Optional[DownloadManifest],
+    ) -> None:
+        if not error:
+            # A previous run may have left an error marker for this window
+            error_path = self.get_image_path(format, folder, image_name, True)
+            if os.path.exists(error_path):
+                os.remove(error_path)
+
+        self.stats.record(os.path.getsize(image_path), error)
+        if manifest is not None:
+            status = WindowStatusConstants.FAILED if error else WindowStatusConstants.DONE
+            manifest.record(image_name, status, image_path, attempts)
         logger.info(f"Image {image_path} downloaded")
 
+    def download_many(
+        self,
+        url: str,
+        jobs: List[Tuple[Dict[str, Any], str]],
+        folder: str,
+        manifest: Optional[DownloadManifest] = None,
+        grid: Optional[TileGrid] = None,
+    ) -> Dict[str, Any]:
+        """Download every (payload, image_name) job using a pool of `workers` threads sharing one session.
+        Windows already completed according to the manifest are skipped. With a tile grid every window is
+        fetched tile by tile and mosaicked."""
+        self.stats = DownloadStats()
+        if manifest is not None:
+            pending = [(payload, image_name) for payload, image_name in jobs if not manifest.is_done(image_name)]
+            self.stats.skipped = len(jobs) - len(pending)
+            logger.info(f"{self.stats.skipped} windows already downloaded, {len(pending)} pending")
+            jobs = pending
+        with pool_workers(self.workers) as workers, ThreadPoolExecutor(max_workers=workers) as executor:
+            if grid is None:
+                futures = {
+                    recorder.submit(executor, self.download, url, payload, folder, image_name, manifest): image_name
+                    for payload, image_name in jobs
+                }
+            else:
+                futures = {
+                    future: image_name
+                    for payload, image_name in jobs
+                    for future in self.download_tiled(executor, url, payload, folder, image_name, grid, manifest)
+                }
+            for future in as_completed(futures):
+                try:
+                    future.result()
+                except Exception as e:
+                    logger.error(f"Error downloading image {futures[future]}: {e}")
+                    self.stats.record(0, True)
+        summary = self.stats.summary()
+        logger.info(
+            "Downloaded {images} images ({errors} errors, {skipped} skipped, {retries} retries, {bytes} bytes) "
+            "in {seconds}s: {images_per_second} images/s, {megabytes_per_second} MB/s".format(**summary)
+        )
+        if self.scheduler is not None:
+            summary["scheduler"] = self.scheduler.counters()
+            logger.info(f"Scheduler counters: {summary['scheduler']}")
+        return summary
+
     def get_image_path(self, format: str, folder: str, image_name: str, error: bool) -> str:
         path = ""
         file_extension = ""
@@ -128,7 +442,8 @@ class Downloader:
         error_suffix = "-error" if error else ""
         path = path + folder
         if not os.path.exists(path):
-            os.makedirs(path)
+            # Several download workers may create the folder at once
+            os.makedirs(path, exist_ok=True)
             logger.info(f"Directory {path} created")
         path = path if path.endswith("/") else path + "/"
         return f"{path}{image_name}{file_extension}{error_suffix}"
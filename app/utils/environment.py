@@ -0,0 +1,9 @@
+from functools import lru_cache
+
+from dotenv import load_dotenv
+
+
+@lru_cache(maxsize=None)
+def load_environment() -> bool:
+    """Load the .env file into the environment, once per process"""
+    return load_dotenv()
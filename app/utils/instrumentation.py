@@ -0,0 +1,319 @@
+import cProfile
+import functools
+import json
+import logging
+import os
+import resource
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+from concurrent.futures import Executor, Future
+from contextvars import ContextVar, copy_context
+from datetime import datetime
+from enum import Enum
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+from utils.logging import set_logging
+
+set_logging()
+logger = logging.getLogger(__name__)
+
+METRIC_PREFIX = "image_pipeline"
+# Item records kept per run, stage totals are always complete
+MAX_ITEMS = 10000
+TRACEMALLOC_TOP = 10
+
+
+class ByteCounterConstants(Enum):
+    DOWNLOADED = "bytes_downloaded"
+    DECODED = "bytes_decoded"
+
+
+# Stages open in the current thread or task, innermost last, and the byte counters of the innermost one
+_stack: ContextVar[Tuple[str, ...]] = ContextVar("instrumentation_stack", default=())
+_counters: ContextVar[Optional[Dict[str, int]]] = ContextVar("instrumentation_counters", default=None)
+
+
+def _peak_rss() -> int:
+    """High-water mark of the resident set of this process and of its reaped children, in bytes"""
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    # ru_maxrss is given in kilobytes on Linux
+    return max(own, children) * 1024
+
+
+def _cpu_time() -> float:
+    """CPU time of this process and of its reaped children, so process pools are accounted for"""
+    times = os.times()
+    return times.user + times.system + times.children_user + times.children_system
+
+
+class RunRecorder:
+    """Wall time, CPU time, peak RSS and byte counters of the stages of one run.
+
+    Stages are opened with `stage`, or `instrumented` on a function, and may nest. Stages given an
+    item (a window, a model) also keep one record per item. CPU time and peak RSS are process-wide:
+    stages running concurrently see each other's work. Stages listed in `profile` run under cProfile
+    and those in `trace_memory` under tracemalloc, whose top allocations are kept in the report."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(
+        self,
+        run_id: Optional[str] = None,
+        profile: Optional[List[str]] = None,
+        trace_memory: Optional[List[str]] = None,
+    ) -> None:
+        with self._lock:
+            self.run_id: Optional[str] = run_id
+            self.started_at: str = datetime.now().isoformat()
+            self.start: float = time.perf_counter()
+            self.stages: Dict[str, Dict[str, float]] = {}
+            self.items: List[Dict[str, Any]] = []
+            self.profile: List[str] = profile or []
+            self.trace_memory: List[str] = trace_memory or []
+            self.profiles: Dict[str, cProfile.Profile] = {}
+            self.allocations: Dict[str, List[Dict[str, Any]]] = {}
+            self._profiling: bool = False
+
+    @contextmanager
+    def stage(self, name: str, item: Optional[str] = None) -> Iterator[Dict[str, float]]:
+        stack = _stack.get()
+        if item is None and stack and stack[-1] == name:
+            # A method calling its parent implementation, already measured
+            yield {}
+            return
+        counters = {counter.value: 0 for counter in ByteCounterConstants}
+        token = _stack.set(stack + (name,))
+        counters_token = _counters.set(counters)
+        profiler = self._start_profile(name)
+        snapshot = self._start_trace(name)
+        rss_before = _peak_rss()
+        cpu_before = _cpu_time()
+        start = time.perf_counter()
+        error = False
+        try:
+            yield counters
+        except BaseException:
+            error = True
+            raise
+        finally:
+            wall = time.perf_counter() - start
+            cpu = _cpu_time() - cpu_before
+            rss = _peak_rss()
+            self._stop_profile(name, profiler)
+            self._stop_trace(name, snapshot)
+            _stack.reset(token)
+            _counters.reset(counters_token)
+            parent_counters = _counters.get()
+            if parent_counters is not None:
+                with self._lock:
+                    for key, value in counters.items():
+                        parent_counters[key] = parent_counters.get(key, 0) + value
+            self._record(name, item, wall, cpu, rss, rss - rss_before, counters, error)
+
+    def add_bytes(self, counter: ByteCounterConstants, amount: int) -> None:
+        """Count bytes for the innermost open stage, which passes them on to its parents"""
+        counters = _counters.get()
+        if counters is not None:
+            with self._lock:
+                counters[counter.value] = counters.get(counter.value, 0) + int(amount)
+
+    def submit(self, executor: Executor, function: Callable, *args, **kwargs) -> Future:
+        """Submit to a thread pool inside the current stages, so what the task measures reaches them"""
+        return executor.submit(copy_context().run, function, *args, **kwargs)
+
+    def drain(self) -> Dict[str, Any]:
+        """Return and clear what was recorded, to be merged into the recorder of another process"""
+        with self._lock:
+            records = {"stages": self.stages, "items": self.items}
+            self.stages, self.items = {}, []
+        return records
+
+    def merge(self, records: Dict[str, Any]) -> None:
+        with self._lock:
+            for name, stage in records["stages"].items():
+                self._accumulate(name, stage)
+            self.items += records["items"][: max(0, MAX_ITEMS - len(self.items))]
+
+    def report(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "run_id": self.run_id,
+                "started_at": self.started_at,
+                "wall_seconds": round(time.perf_counter() - self.start, 6),
+                "cpu_seconds": round(_cpu_time(), 6),
+                "peak_rss_bytes": _peak_rss(),
+                "stages": {name: dict(stage) for name, stage in self.stages.items()},
+                "items": list(self.items),
+                "allocations": dict(self.allocations),
+            }
+
+    def write(self, reports_path: str) -> Tuple[str, str]:
+        """Write the JSON run report and the Prometheus textfile, plus the profiles of the profiled stages"""
+        os.makedirs(reports_path, exist_ok=True)
+        run_id = self.run_id or "run"
+        report = self.report()
+        json_path = os.path.join(reports_path, f"{run_id}_run.json")
+        with open(json_path + ".tmp", "w") as f:
+            json.dump(report, f, indent=2)
+        os.replace(json_path + ".tmp", json_path)
+        prometheus_path = os.path.join(reports_path, f"{run_id}.prom")
+        with open(prometheus_path + ".tmp", "w") as f:
+            f.write(prometheus_text(report))
+        os.replace(prometheus_path + ".tmp", prometheus_path)
+        for name, profiler in self.profiles.items():
+            profiler.dump_stats(os.path.join(reports_path, f"{run_id}_{name}.prof"))
+        logger.info(f"Run report written to {json_path} and {prometheus_path}")
+        return json_path, prometheus_path
+
+    def _record(
+        self,
+        name: str,
+        item: Optional[str],
+        wall: float,
+        cpu: float,
+        rss: int,
+        rss_growth: int,
+        counters: Dict[str, int],
+        error: bool,
+    ) -> None:
+        stage = {
+            "calls": 1,
+            "errors": int(error),
+            "wall_seconds": wall,
+            "cpu_seconds": cpu,
+            "peak_rss_bytes": rss,
+            "rss_growth_bytes": rss_growth,
+            **counters,
+        }
+        with self._lock:
+            self._accumulate(name, stage)
+            if item is not None and len(self.items) < MAX_ITEMS:
+                self.items.append(
+                    {"stage": name, "item": item, **{key: value for key, value in stage.items() if key != "calls"}}
+                )
+
+    def _accumulate(self, name: str, stage: Dict[str, float]) -> None:
+        total = self.stages.setdefault(name, {})
+        for key, value in stage.items():
+            if key in ("peak_rss_bytes", "rss_growth_bytes"):
+                total[key] = max(total.get(key, 0), value)
+            else:
+                total[key] = total.get(key, 0) + value
+
+    def _start_profile(self, name: str) -> Optional[cProfile.Profile]:
+        if name not in self.profile:
+            return None
+        with self._lock:
+            # One profiler can be active at a time, nested or concurrent stages are not profiled
+            if self._profiling:
+                return None
+            self._profiling = True
+            profiler = self.profiles.setdefault(name, cProfile.Profile())
+        profiler.enable()
+        return profiler
+
+    def _stop_profile(self, name: str, profiler: Optional[cProfile.Profile]) -> None:
+        if profiler is not None:
+            profiler.disable()
+            with self._lock:
+                self._profiling = False
+
+    def _start_trace(self, name: str) -> Optional[Tuple[tracemalloc.Snapshot, bool]]:
+        if name not in self.trace_memory:
+            return None
+        started = not tracemalloc.is_tracing()
+        if started:
+            tracemalloc.start()
+        return tracemalloc.take_snapshot(), started
+
+    def _stop_trace(self, name: str, snapshot: Optional[Tuple[tracemalloc.Snapshot, bool]]) -> None:
+        if snapshot is None:
+            return
+        before, started = snapshot
+        differences = tracemalloc.take_snapshot().compare_to(before, "lineno")[:TRACEMALLOC_TOP]
+        _, peak = tracemalloc.get_traced_memory()
+        if started:
+            tracemalloc.stop()
+        with self._lock:
+            self.allocations[name] = [
+                {"line": str(stat.traceback), "size_bytes": stat.size_diff, "count": stat.count_diff}
+                for stat in differences
+            ]
+            self.stages.setdefault(name, {})["traced_peak_bytes"] = peak
+
+
+def prometheus_text(report: Dict[str, Any]) -> str:
+    """Stage totals of a run report in the Prometheus text format, for the node exporter textfile collector"""
+    run_id = report["run_id"] or "run"
+    metrics = [
+        ("stage_calls_total", "calls", "counter", "Calls of the stage"),
+        ("stage_errors_total", "errors", "counter", "Calls of the stage that raised"),
+        ("stage_wall_seconds", "wall_seconds", "gauge", "Wall time spent in the stage"),
+        ("stage_cpu_seconds", "cpu_seconds", "gauge", "Process CPU time while in the stage"),
+        ("stage_peak_rss_bytes", "peak_rss_bytes", "gauge", "Peak resident set size when the stage ended"),
+        ("stage_rss_growth_bytes", "rss_growth_bytes", "gauge", "Growth of the peak resident set during the stage"),
+    ] + [
+        (f"stage_{counter.value}_total", counter.value, "counter", f"{counter.value.replace('_', ' ')} by the stage")
+        for counter in ByteCounterConstants
+    ]
+    lines = []
+    for metric, key, metric_type, description in metrics:
+        lines += [f"# HELP {METRIC_PREFIX}_{metric} {description}", f"# TYPE {METRIC_PREFIX}_{metric} {metric_type}"]
+        for name, stage in sorted(report["stages"].items()):
+            if key in stage:
+                lines.append(f'{METRIC_PREFIX}_{metric}{{run="{run_id}",stage="{name}"}} {stage[key]}')
+    for metric, key, description in [
+        ("run_wall_seconds", "wall_seconds", "Wall time of the run"),
+        ("run_cpu_seconds", "cpu_seconds", "CPU time of the run"),
+        ("run_peak_rss_bytes", "peak_rss_bytes", "Peak resident set size of the run"),
+    ]:
+        lines += [
+            f"# HELP {METRIC_PREFIX}_{metric} {description}",
+            f"# TYPE {METRIC_PREFIX}_{metric} gauge",
+            f'{METRIC_PREFIX}_{metric}{{run="{run_id}"}} {report[key]}',
+        ]
+    return "\n".join(lines) + "\n"
+
+
+recorder = RunRecorder()
+
+
+def stage(name: str, item: Optional[str] = None):
+    return recorder.stage(name, item)
+
+
+def add_bytes(counter: ByteCounterConstants, amount: int) -> None:
+    recorder.add_bytes(counter, amount)
+
+
+def instrumented(name: Optional[str] = None) -> Callable:
+    """Record every call of the decorated function as a stage, named after the function by default"""
+
+    def decorator(function: Callable) -> Callable:
+        stage_name = name or function.__name__
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with recorder.stage(stage_name):
+                return function(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def instrumented_method(function: Callable) -> Callable:
+    """Record every call of a method as the stage <class>.<method> of the instance it is called on"""
+
+    @functools.wraps(function)
+    def wrapper(self, *args, **kwargs):
+        with recorder.stage(f"{self.__class__.__name__}.{function.__name__}"):
+            return function(self, *args, **kwargs)
+
+    wrapper.__instrumented__ = True
+    return wrapper
@@ -1,8 +1,16 @@
 import logging
 from colorlog import ColoredFormatter
 
+# Handler installed by set_logging, the root logger is only configured once per process
+_handler = None
+
 
 def set_logging():
+    global _handler
+    logger = logging.getLogger()
+    if _handler is not None and _handler in logger.handlers:
+        return
+
     # Set color formatter
     log_format = "%(log_color)s%(asctime)s [%(name)s] %(levelname)s: %(message)s"
     formatter = ColoredFormatter(
@@ -11,19 +19,18 @@ def set_logging():
         reset=True,
         style="%",
     )
-    logger = logging.getLogger()
 
-    # Clear existing handlers to avoid duplicate logs if set_logging is called multiple times
+    # Clear existing handlers to avoid duplicate logs
     logger.handlers = []
 
     # Set console handler
-    ch = logging.StreamHandler()
+    _handler = logging.StreamHandler()
 
     # Set formatter to console handler
-    ch.setFormatter(formatter)
+    _handler.setFormatter(formatter)
 
     # Add console handler to root logger (which is the parent of all loggers)
-    logger.addHandler(ch)
+    logger.addHandler(_handler)
 
     # Set root logger level
     logger.setLevel(logging.INFO)
@@ -0,0 +1,108 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+from datetime import datetime
+from enum import Enum
+from typing import Any, Dict, Optional
+
+from configuration.configuration import Configuration
+from utils.logging import set_logging
+
+set_logging()
+logger = logging.getLogger(__name__)
+
+
+class WindowStatusConstants(Enum):
+    DONE = "done"
+    FAILED = "failed"
+    # The catalog has no acquisition for the window, nothing was requested
+    EMPTY = "empty"
+
+
+def file_checksum(path: str, chunk_size: int = 1 << 20) -> str:
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+class DownloadManifest:
+    """Per name_id record of every downloaded window, its status, size and checksum.
+
+    Entries also keep the fingerprint of the request settings they were downloaded with, windows done
+    with other settings (bbox, evalscript, resolution, tiling...) are downloaded again."""
+
+    def __init__(
+        self,
+        name_id: str,
+        manifests_path: Optional[str] = None,
+        verify_checksums: bool = False,
+        fingerprint: Optional[str] = None,
+    ):
+        if manifests_path is None:
+            manifests_path = str(Configuration()["manifests_path"])
+        if not os.path.exists(manifests_path):
+            os.makedirs(manifests_path)
+            logger.info(f"Directory {manifests_path} created")
+        self.name_id: str = name_id
+        self.verify_checksums: bool = verify_checksums
+        self.fingerprint: Optional[str] = fingerprint
+        self.path: str = os.path.join(manifests_path, f"{name_id}.json")
+        self.windows: Dict[str, Dict[str, Any]] = {}
+        self._lock = threading.Lock()
+        if os.path.exists(self.path):
+            with open(self.path, "r") as f:
+                self.windows = json.load(f).get("windows", {})
+            logger.info(f"Manifest {self.path} loaded with {len(self.windows)} windows")
+
+    def same_settings(self, image_name: str) -> bool:
+        """Whether the window, if recorded, was requested with the settings of this manifest"""
+        entry = self.windows.get(image_name)
+        return entry is None or entry.get("fingerprint") == self.fingerprint
+
+    def is_done(self, image_name: str) -> bool:
+        entry = self.windows.get(image_name)
+        if entry is None or entry["status"] != WindowStatusConstants.DONE.value:
+            return False
+        if not self.same_settings(image_name):
+            logger.info(f"Window {image_name} was downloaded with other settings")
+            return False
+        path = entry["path"]
+        if not os.path.exists(path) or os.path.getsize(path) != entry["size"]:
+            return False
+        if self.verify_checksums and file_checksum(path) != entry["sha256"]:
+            logger.warning(f"Checksum mismatch for {path}")
+            return False
+        return True
+
+    def record(self, image_name: str, status: WindowStatusConstants, path: Optional[str], attempts: int) -> None:
+        done = status == WindowStatusConstants.DONE
+        entry = {
+            "status": status.value,
+            "path": path,
+            "size": os.path.getsize(path) if done else 0,
+            "sha256": file_checksum(path) if done else None,
+            "attempts": attempts,
+            "fingerprint": self.fingerprint,
+            "updated_at": datetime.now().isoformat(),
+        }
+        with self._lock:
+            self.windows[image_name] = entry
+            self.save()
+
+    def clear(self) -> None:
+        with self._lock:
+            self.windows = {}
+            if os.path.exists(self.path):
+                os.remove(self.path)
+                logger.info(f"Manifest {self.path} removed")
+
+    def save(self) -> None:
+        # Write to a temporary file first so an interrupted run never leaves a truncated manifest
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"name_id": self.name_id, "windows": self.windows}, f, indent=2)
+        os.replace(tmp_path, self.path)
@@ -0,0 +1,163 @@
+import argparse
+import hashlib
+import json
+import logging
+import os
+import platform
+import threading
+from datetime import datetime, timedelta
+from importlib.metadata import PackageNotFoundError, version
+from typing import Any, Dict, List, Optional
+
+import joblib
+import pandas as pd
+from configuration.configuration import Configuration
+from utils.logging import set_logging
+
+set_logging()
+logger = logging.getLogger(__name__)
+
+# A fitted model is only reused with the library versions it was fitted and pickled with
+LIBRARIES = ["numpy", "pandas", "scikit-learn", "statsmodels", "pmdarima", "joblib"]
+
+
+def library_versions() -> Dict[str, str]:
+    versions = {"python": platform.python_version()}
+    for library in LIBRARIES:
+        try:
+            versions[library] = version(library)
+        except PackageNotFoundError:
+            versions[library] = None
+    return versions
+
+
+def model_key(model: Any) -> str:
+    """Content address of a model: its training data, class, kpi, hyperparameters and library versions"""
+    sha256 = hashlib.sha256()
+    sha256.update(pd.util.hash_pandas_object(model.df, index=True).values.tobytes())
+    description = {
+        "columns": [str(column) for column in model.df.columns],
+        "dtypes": [str(dtype) for dtype in model.df.dtypes],
+        "class": f"{model.__class__.__module__}.{model.__class__.__qualname__}",
+        "store_version": getattr(model, "store_version", 1),
+        "kpi": model.kpi,
+        "params": model.model_params,
+        "versions": library_versions(),
+    }
+    sha256.update(json.dumps(description, sort_keys=True, default=str).encode())
+    return sha256.hexdigest()
+
+
+class ModelStore:
+    """Fitted models stored under the content address of what they were fitted on.
+
+    A JSON index records the class, size, creation and last use of every entry so the store can
+    be listed and pruned without unpickling anything. Entries unused for `max_age_days` are evicted
+    first, then the least recently used ones until the store fits in `max_size_mb`."""
+
+    INDEX_FILE = "index.json"
+
+    def __init__(
+        self,
+        store_path: Optional[str] = None,
+        max_size_mb: Optional[float] = None,
+        max_age_days: Optional[float] = None,
+    ):
+        if store_path is None:
+            store_path = str(Configuration()["model_store_path"])
+        if not os.path.exists(store_path):
+            os.makedirs(store_path)
+            logger.info(f"Directory {store_path} created")
+        self.path: str = store_path
+        self.max_size_mb: Optional[float] = max_size_mb
+        self.max_age_days: Optional[float] = max_age_days
+        self.entries: Dict[str, Dict[str, Any]] = {}
+        self._lock = threading.Lock()
+        index_path = os.path.join(self.path, self.INDEX_FILE)
+        if os.path.exists(index_path):
+            with open(index_path, "r") as f:
+                self.entries = json.load(f)["entries"]
+
+    def get(self, key: str) -> Optional[Any]:
+        entry = self.entries.get(key)
+        path = os.path.join(self.path, f"{key}.sav")
+        if entry is None or not os.path.exists(path):
+            return None
+        model_fit = joblib.load(path)
+        with self._lock:
+            entry["last_used"] = datetime.now().isoformat()
+            self._save_index()
+        logger.info(f"Model store hit {key[:12]} ({entry['class']})")
+        return model_fit
+
+    def put(self, key: str, model_fit: Any, model_class: str, name_id: Optional[str] = None) -> None:
+        path = os.path.join(self.path, f"{key}.sav")
+        joblib.dump(model_fit, path + ".tmp")
+        os.replace(path + ".tmp", path)
+        now = datetime.now().isoformat()
+        with self._lock:
+            self.entries[key] = {
+                "class": model_class,
+                "name_id": name_id,
+                "size": os.path.getsize(path),
+                "created_at": now,
+                "last_used": now,
+            }
+            self._save_index()
+        logger.info(f"Model {model_class} stored as {key[:12]}")
+        self.prune()
+
+    def list(self) -> List[Dict[str, Any]]:
+        return [
+            {"key": key, **entry} for key, entry in sorted(self.entries.items(), key=lambda e: e[1]["last_used"])
+        ]
+
+    def prune(self, max_size_mb: Optional[float] = None, max_age_days: Optional[float] = None) -> List[str]:
+        """Evict expired entries, then the least recently used ones over the size budget"""
+        max_size_mb = max_size_mb if max_size_mb is not None else self.max_size_mb
+        max_age_days = max_age_days if max_age_days is not None else self.max_age_days
+        evicted = []
+        with self._lock:
+            by_use = sorted(self.entries.items(), key=lambda e: e[1]["last_used"])
+            if max_age_days is not None:
+                limit = datetime.now() - timedelta(days=max_age_days)
+                evicted += [key for key, entry in by_use if datetime.fromisoformat(entry["last_used"]) < limit]
+            if max_size_mb is not None:
+                size = sum(entry["size"] for key, entry in by_use if key not in evicted)
+                for key, entry in by_use:
+                    if size <= max_size_mb * 1024 * 1024:
+                        break
+                    if key not in evicted:
+                        evicted.append(key)
+                        size -= entry["size"]
+            for key in evicted:
+                path = os.path.join(self.path, f"{key}.sav")
+                if os.path.exists(path):
+                    os.remove(path)
+                del self.entries[key]
+            if evicted:
+                self._save_index()
+                logger.info(f"{len(evicted)} models evicted from the model store")
+        return evicted
+
+    def _save_index(self) -> None:
+        index_path = os.path.join(self.path, self.INDEX_FILE)
+        with open(index_path + ".tmp", "w") as f:
+            json.dump({"entries": self.entries}, f, indent=2)
+        os.replace(index_path + ".tmp", index_path)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="List or prune the model store")
+    parser.add_argument("command", choices=["list", "prune"])
+    parser.add_argument("--max_size_mb", type=float, help="Size budget of the store when pruning")
+    parser.add_argument("--max_age_days", type=float, help="Evict entries unused for longer when pruning")
+    args = parser.parse_args()
+    store = ModelStore()
+    if args.command == "prune":
+        store.prune(args.max_size_mb, args.max_age_days)
+    for entry in store.list():
+        print(
+            f"{entry['key'][:12]}  {entry['class']:<20} {entry['name_id'] or '-':<30} "
+            f"{entry['size'] / 1024:>10.1f} KiB  last used {entry['last_used']}"
+        )
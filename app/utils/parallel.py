@@ -0,0 +1,101 @@
+import logging
+import threading
+from contextlib import contextmanager
+from typing import Iterator, Optional
+
+from threadpoolctl import threadpool_limits
+from utils.logging import set_logging
+
+set_logging()
+logger = logging.getLogger(__name__)
+
+# Jobs a model may use for its own joblib pool, None outside pool workers (no limit)
+_worker_jobs = {"jobs": None}
+
+
+class WorkerBudget:
+    """Workers shared by the tasks of a batch. Every running task holds one of them and the pools it
+    starts borrow the idle ones, so tasks and their pools never run more than `workers` at once"""
+
+    def __init__(self, workers: int):
+        self.workers: int = max(1, workers)
+        self.idle: int = self.workers
+        self._idle_changed = threading.Condition()
+
+    @contextmanager
+    def task(self) -> Iterator[None]:
+        # Waits while the pools of other tasks borrow every idle worker
+        with self._idle_changed:
+            self._idle_changed.wait_for(lambda: self.idle > 0)
+            self.idle -= 1
+        try:
+            yield
+        finally:
+            self._release(1)
+
+    @contextmanager
+    def pool(self, requested: int) -> Iterator[int]:
+        with self._idle_changed:
+            borrowed = max(0, min(requested - 1, self.idle))
+            self.idle -= borrowed
+        try:
+            yield 1 + borrowed
+        finally:
+            self._release(borrowed)
+
+    def _release(self, workers: int) -> None:
+        with self._idle_changed:
+            self.idle += workers
+            self._idle_changed.notify_all()
+
+
+_budget: Optional[WorkerBudget] = None
+
+
+def set_budget(workers: Optional[int]) -> None:
+    """Share `workers` between the tasks of a batch and their pools, None lifts the limit"""
+    global _budget
+    _budget = WorkerBudget(workers) if workers else None
+
+
+@contextmanager
+def budget_task() -> Iterator[None]:
+    """Hold one worker of the batch budget, if any, while a task runs"""
+    if _budget is None:
+        yield
+        return
+    with _budget.task():
+        yield
+
+
+@contextmanager
+def pool_workers(requested: int) -> Iterator[int]:
+    """Workers of a pool started by a task: the requested ones outside a batch, else the task's own
+    worker plus those of the budget idle at the start, returned when the pool is done"""
+    if _budget is None or requested <= 1:
+        yield max(1, requested)
+        return
+    with _budget.pool(requested) as workers:
+        if workers < requested:
+            logger.debug(f"Pool of {requested} workers reduced to {workers} by the batch budget")
+        yield workers
+
+
+def limit_worker(jobs: int = 1) -> None:
+    """Make the current process one unit of the worker budget: BLAS and OpenMP pools and the joblib
+    pools models start get `jobs` workers, so a pool of N processes never runs N x cpus workers"""
+    threadpool_limits(jobs)
+    _worker_jobs["jobs"] = jobs
+
+
+def model_jobs(requested: Optional[int] = None) -> int:
+    """n_jobs of a model's joblib pool: the requested value (all CPUs by default), capped inside pool workers
+    and inside a batch, where a model fitted by a task only has the task's worker"""
+    jobs = _worker_jobs["jobs"]
+    if jobs is None and _budget is not None:
+        jobs = 1
+    if jobs is None:
+        return requested if requested is not None else -1
+    if requested is not None and requested != jobs:
+        logger.debug(f"n_jobs={requested} capped to {jobs} inside a pool worker")
+    return jobs
@@ -1,61 +1,247 @@
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from datetime import datetime
+from enum import Enum
+from functools import partial
+import json
 import logging
 import os
 from pathlib import Path
-from typing import Tuple
+from typing import Dict, List, Optional, Tuple
 
 import numpy as np
 from numpy.core.multiarray import ndarray
 import pandas as pd
-from dotenv import load_dotenv
+import rasterio
 
-from configuration.configuration import Configuration
-from scripts.kpis import KPIs, parse_to_constant_kpi
-from utils import set_logging
+from scripts.indices import MASK_BAND, SpectralIndex
+from scripts.kpis import KPIAccumulator, KPIs, parse_kpis, parse_to_constant_kpi
+from utils import load_environment, set_logging
+from utils.datacube import Datacube
+from utils.instrumentation import ByteCounterConstants, add_bytes, instrumented
+from utils.parallel import pool_workers
+from utils.raster_index import GapPolicyConstants, RasterIndex
 
-load_dotenv()
+load_environment()
 set_logging()
 logger = logging.getLogger(__name__)
 
 
-def create_dataframe(data: ndarray, time: ndarray, kpi_name: str) -> pd.DataFrame:
+def kpis_to_dataframe(values: Dict[str, ndarray], time: ndarray, kpis: List[str]) -> pd.DataFrame:
+    """Build the multi-column frame shared by every model, dropping dates without any valid pixel"""
+    df = pd.DataFrame({**{kpi: np.asarray(values[kpi], dtype=np.float64) for kpi in kpis}, "time": time})
+    empty = df[kpis[0]].isna()
+    if empty.any():
+        logger.warning(f"{int(empty.sum())} images without valid pixels dropped")
+        df = df[~empty].reset_index(drop=True)
+    return df
+
+
+@instrumented()
+def create_dataframe(
+    data: ndarray,
+    time: ndarray,
+    kpi_name: str,
+    kpis: Optional[List[str]] = None,
+    mask: Optional[ndarray] = None,
+) -> pd.DataFrame:
     """Create a dataframe from the data"""
-    kpi_constant = parse_to_constant_kpi(kpi_name)
-    kpi = KPIs(data, axis=(1, 2), kpi=kpi_constant)
-    return pd.DataFrame({kpi_constant.value: kpi.get_kpi(), "time": time})
+    kpis = parse_kpis(kpi_name, kpis)
+    kpi = KPIs(data, axis=(1, 2), kpi=parse_to_constant_kpi(kpi_name), mask=mask)
+    return kpis_to_dataframe(kpi.get_kpis(kpis), time, kpis)
+
+
+def prepare_image(block: ndarray, spectral_index: Optional[SpectralIndex] = None) -> ndarray:
+    """Turn a float32 (band, height, width) block into the normalised (height, width) image KPIs are computed on.
+    Nodata stays NaN so that statistics can leave it out."""
+    if spectral_index is not None:
+        return spectral_index.compute(block)
+    image = block[0]
+    image /= 255
+    return image
+
+
+class DecodeExecutorConstants(Enum):
+    PROCESS = "process"
+    THREAD = "thread"
+
+
+def raster_kpis(
+    tif: Path,
+    kpis: List[str],
+    spectral_index: Optional[SpectralIndex] = None,
+    read_by_blocks: bool = False,
+) -> Dict[str, float]:
+    """Decode one raster (or one block of it at a time) and reduce it to its KPIs"""
+    return _decode_kpis(tif, kpis, spectral_index, read_by_blocks)[0]
+
+
+def _decode_kpis(
+    tif: Path,
+    kpis: List[str],
+    spectral_index: Optional[SpectralIndex] = None,
+    read_by_blocks: bool = False,
+) -> Tuple[Dict[str, float], int]:
+    """KPIs of one raster and the bytes decoded for them, counted by the caller when decoding in a pool"""
+    accumulator = KPIAccumulator(kpis)
+    decoded = 0
+    with rasterio.open(tif) as src:
+        windows = [window for _, window in src.block_windows(1)] if read_by_blocks else [None]
+        for window in windows:
+            block = src.read(window=window, out_dtype=np.float32)
+            decoded += block.nbytes
+            accumulator.update(prepare_image(block, spectral_index))
+    return accumulator.get_kpis(), decoded
+
+
+@instrumented()
+def stream_dataframe(
+    tifs: List[Path],
+    time: ndarray,
+    kpi_name: str,
+    kpis: Optional[List[str]] = None,
+    spectral_index: Optional[SpectralIndex] = None,
+    read_by_blocks: bool = False,
+    workers: int = 1,
+    executor: str = DecodeExecutorConstants.PROCESS.value,
+) -> pd.DataFrame:
+    """Create the same dataframe as create_dataframe reading one raster (or one block of it) at a time,
+    so memory stays flat whatever the number of images. With several workers the rasters are decoded
+    in a process or thread pool that only sends the KPIs back, in time order."""
+    kpis = parse_kpis(kpi_name, kpis)
+    decode = partial(_decode_kpis, kpis=kpis, spectral_index=spectral_index, read_by_blocks=read_by_blocks)
+    if workers > 1 and len(tifs) > 1:
+        pool_class = ProcessPoolExecutor
+        if DecodeExecutorConstants(executor) == DecodeExecutorConstants.THREAD:
+            pool_class = ThreadPoolExecutor
+        with pool_workers(workers) as workers, pool_class(max_workers=workers) as pool:
+            chunksize = max(1, len(tifs) // (workers * 4))
+            logger.info(f"Decoding {len(tifs)} rasters with {workers} {executor} workers")
+            results = list(pool.map(decode, tifs, chunksize=chunksize))
+    else:
+        results = [decode(tif) for tif in tifs]
+    add_bytes(ByteCounterConstants.DECODED, sum(decoded for _, decoded in results))
+    values = {kpi: [result[kpi] for result, _ in results] for kpi in kpis}
+    return kpis_to_dataframe(values, time, kpis)
+
+
+@instrumented()
+def tifs_to_datacube(
+    name_id: str, tifs: List[Path], spectral_index: Optional[SpectralIndex] = None
+) -> Tuple[ndarray, ndarray]:
+    """Update the cached datacube of name_id with any new raster and map the frames of `tifs` from disk"""
+    mask_band = spectral_index.bands.index(MASK_BAND) if spectral_index and MASK_BAND in spectral_index.bands else None
+    datacube = Datacube(name_id, mask_band=mask_band)
+    datacube.update(tifs)
+    return datacube.load(tifs)
 
 
+@instrumented()
+def datacube_dataframe(
+    cube: ndarray,
+    mask: ndarray,
+    time: ndarray,
+    kpi_name: str,
+    kpis: Optional[List[str]] = None,
+    spectral_index: Optional[SpectralIndex] = None,
+) -> pd.DataFrame:
+    """Create the dataframe from a mapped datacube and its validity mask, paging in one frame at a time"""
+    kpis = parse_kpis(kpi_name, kpis)
+    results = []
+    for i in range(len(cube)):
+        accumulator = KPIAccumulator(kpis)
+        accumulator.update(prepare_image(cube[i].astype(np.float32), spectral_index), mask[i])
+        results.append(accumulator.get_kpis())
+    values = {kpi: [result[kpi] for result in results] for kpi in kpis}
+    return kpis_to_dataframe(values, time, kpis)
+
+
+@instrumented()
+def tifs_to_index_cube(tifs: List[Path], spectral_index: SpectralIndex) -> ndarray:
+    """Read raw band rasters into a (time, band, height, width) cube and compute the index over all of it at once"""
+    with rasterio.open(tifs[0]) as src:
+        cube = np.empty((len(tifs), src.count, src.height, src.width), dtype=np.float32)
+    for i, tif in enumerate(tifs):
+        with rasterio.open(tif) as src:
+            src.read(out=cube[i])
+    add_bytes(ByteCounterConstants.DECODED, cube.nbytes)
+    return spectral_index.compute(cube)
+
+
+def get_sidecar_path(packed_path: str) -> str:
+    return os.path.splitext(packed_path)[0] + ".json"
+
+
+def write_timestamps_sidecar(packed_path: str, windows: List[Tuple[datetime, datetime, str]]) -> None:
+    """Write the timestamps of every band of a packed multi-temporal GeoTIFF next to it"""
+    sidecar = {
+        "windows": [
+            {"name": name, "from": date_start.isoformat(), "to": date_end.isoformat()}
+            for date_start, date_end, name in windows
+        ]
+    }
+    with open(get_sidecar_path(packed_path), "w") as f:
+        json.dump(sidecar, f, indent=2)
+
+
+def load_multitemporal(packed_path: str) -> Tuple[ndarray, List[dict]]:
+    """Load a packed multi-temporal GeoTIFF as a (time, height, width) cube with the windows of its sidecar"""
+    with open(get_sidecar_path(packed_path), "r") as f:
+        windows = json.load(f)["windows"]
+    with rasterio.open(packed_path) as src:
+        cube = src.read()
+    return cube, windows
+
+
+def unpack_multitemporal(packed_path: str, output_dir: str) -> List[str]:
+    """Split a packed multi-temporal GeoTIFF into one single band GeoTIFF per window, one band in memory at a time"""
+    with open(get_sidecar_path(packed_path), "r") as f:
+        windows = json.load(f)["windows"]
+    paths = []
+    with rasterio.open(packed_path) as src:
+        profile = src.profile
+        profile.update(count=1)
+        for band, window in enumerate(windows, start=1):
+            path = os.path.join(output_dir, window["name"] + ".tif")
+            with rasterio.open(path, "w", **profile) as dst:
+                dst.write(src.read(band), 1)
+            paths.append(path)
+    logger.info(f"Unpacked {len(paths)} windows from {packed_path}")
+    return paths
+
+
+@instrumented()
 def tifs_to_array(
-    name_id: str, start_date: datetime, date_interval, interval_type: str
+    name_id: str,
+    start_date: datetime,
+    date_interval,
+    interval_type: str,
+    end_date: Optional[datetime] = None,
+    gaps: str = GapPolicyConstants.DROP.value,
 ) -> Tuple[np.ndarray, np.ndarray]:
     """
-    Convert the tifs to a numpy array and return the array and the time values
+    Return the tifs whose window starts in [start_date, end_date) and their time values,
+    looked up in the raster index instead of listing and counting every file on disk
     """
+    raster_index = RasterIndex(name_id)
+    raster_index.refresh()
+    windows = raster_index.query(start_date, end_date)
+
+    missing = RasterIndex.gaps(windows, start_date, end_date, tolerance=date_interval)
+    if missing:
+        ranges = ", ".join(f"{gap_start.date()} - {gap_end.date()}" for gap_start, gap_end in missing)
+        if GapPolicyConstants(gaps) == GapPolicyConstants.FAIL:
+            raise ValueError(f"{len(missing)} gaps without rasters for {name_id}: {ranges}")
+        logger.warning(f"{len(missing)} gaps without rasters for {name_id}, dropped: {ranges}")
+
     tifs = []
     time_values = []
-    current_date = start_date
-
-    config = Configuration()
-    geotiffs_path = str(config["geotiffs_path"])
-    # path to geotiffs folder union the name_id
-    tifs_dir: Path = Path(geotiffs_path)
-    dir: Path = tifs_dir.joinpath(name_id)
-    if not dir.exists():
-        os.makedirs(dir)
-
-    for tif in sorted(dir.iterdir()):
-        if not tif.name.endswith(".xml"):
-            # Calculate the current date
-            current_date += date_interval
-
-            if not tif.name.endswith("-error"):
-                tifs.append(tif)
-
-                # Add the month number or week number to the time_values list depending on the date_interval
-                if interval_type == "months":
-                    time_values.append(current_date.month)
-                else:  # Assume weeks if not months
-                    time_values.append(current_date.isocalendar()[1])
+    for _, window_end, tif in windows:
+        tifs.append(tif)
+        # Add the month number or week number to the time_values list depending on the date_interval
+        if interval_type == "months":
+            time_values.append(window_end.month)
+        else:  # Assume weeks if not months
+            time_values.append(window_end.isocalendar()[1])
 
     tifs = np.array(tifs)
     logger.info("TIFs shape: {}".format(tifs.shape))
@@ -0,0 +1,121 @@
+import bisect
+import json
+import logging
+import os
+from datetime import datetime
+from enum import Enum
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+from configuration.configuration import Configuration
+from dateutil.relativedelta import relativedelta
+from utils.logging import set_logging
+
+set_logging()
+logger = logging.getLogger(__name__)
+
+
+class GapPolicyConstants(Enum):
+    # Train on the windows available, the gaps are only reported
+    DROP = "drop"
+    # Refuse to train on a series with gaps
+    FAIL = "fail"
+
+
+def parse_window_dates(file_name: str) -> Optional[Tuple[datetime, datetime]]:
+    """Parse the YYYY-MM-DD_YYYY-MM-DD window a downloaded image is named after"""
+    try:
+        date_start, date_end = file_name.split(".")[0].split("_")
+        return datetime.strptime(date_start, "%Y-%m-%d"), datetime.strptime(date_end, "%Y-%m-%d")
+    except ValueError:
+        return None
+
+
+class RasterIndex:
+    """Persisted catalogue of the rasters downloaded for a name_id, sorted by the window in their file name.
+
+    Only names are parsed, never rasters, and only those not indexed yet, so refreshing is a directory
+    listing. Range queries bisect the sorted window starts."""
+
+    def __init__(self, name_id: str, geotiffs_path: Optional[str] = None, cache_path: Optional[str] = None):
+        configuration = Configuration()
+        if geotiffs_path is None:
+            geotiffs_path = str(configuration["geotiffs_path"])
+        if cache_path is None:
+            cache_path = os.path.join(str(configuration["cache_path"]), "raster_index")
+        self.directory: Path = Path(geotiffs_path).joinpath(name_id)
+        self.path: str = os.path.join(cache_path, f"{name_id}.json")
+        self.entries: List[Dict[str, str]] = []
+        if os.path.exists(self.path):
+            with open(self.path, "r") as f:
+                self.entries = json.load(f)["rasters"]
+        self.starts: List[datetime] = [datetime.fromisoformat(entry["start"]) for entry in self.entries]
+
+    def refresh(self) -> None:
+        """Add the rasters downloaded since the last refresh and forget the ones removed"""
+        if not self.directory.exists():
+            os.makedirs(self.directory)
+        names = {
+            entry.name
+            for entry in os.scandir(self.directory)
+            # Skip metadata, sidecars, failed windows and the packed multi-temporal folder
+            if entry.is_file() and not entry.name.endswith((".xml", ".json", "-error"))
+        }
+        indexed = {entry["name"] for entry in self.entries}
+        removed = indexed - names
+        added = []
+        for name in sorted(names - indexed):
+            window = parse_window_dates(name)
+            if window is None:
+                logger.warning(f"Raster {name} is not named after its window, not indexed")
+                continue
+            added.append({"name": name, "start": window[0].isoformat(), "end": window[1].isoformat()})
+        if not added and not removed:
+            return
+
+        self.entries = sorted(
+            [entry for entry in self.entries if entry["name"] not in removed] + added, key=lambda e: e["start"]
+        )
+        self.starts = [datetime.fromisoformat(entry["start"]) for entry in self.entries]
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(self.path + ".tmp", "w") as f:
+            json.dump({"rasters": self.entries}, f)
+        os.replace(self.path + ".tmp", self.path)
+        logger.info(f"Raster index {self.path}: {len(added)} added, {len(removed)} removed, {len(self.entries)} total")
+
+    def query(
+        self, start_date: Optional[datetime] = None, end_date: Optional[datetime] = None
+    ) -> List[Tuple[datetime, datetime, Path]]:
+        """Rasters whose window starts in [start_date, end_date), in date order"""
+        low = bisect.bisect_left(self.starts, start_date) if start_date else 0
+        high = bisect.bisect_left(self.starts, end_date) if end_date else len(self.starts)
+        return [
+            (
+                datetime.fromisoformat(entry["start"]),
+                datetime.fromisoformat(entry["end"]),
+                self.directory.joinpath(entry["name"]),
+            )
+            for entry in self.entries[low:high]
+        ]
+
+    @staticmethod
+    def gaps(
+        windows: List[Tuple[datetime, datetime, Path]],
+        start_date: Optional[datetime] = None,
+        end_date: Optional[datetime] = None,
+        tolerance: Optional[relativedelta] = None,
+    ) -> List[Tuple[datetime, datetime]]:
+        """Date ranges of [start_date, end_date) not covered by any of the windows. Ranges of at least
+        `tolerance` are gaps, so a single missing window of one date_interval is reported, while a shorter
+        uncovered range, e.g. before a window not aligned to start_date, is not"""
+        gaps = []
+        covered = start_date or (windows[0][0] if windows else None)
+        for window_start, window_end, _ in windows:
+            if covered is not None and window_start > covered:
+                gaps.append((covered, window_start))
+            covered = max(covered, window_end) if covered is not None else window_end
+        if end_date is not None and covered is not None and covered < end_date:
+            gaps.append((covered, end_date))
+        if tolerance is not None:
+            gaps = [(gap_start, gap_end) for gap_start, gap_end in gaps if gap_start + tolerance <= gap_end]
+        return gaps
@@ -0,0 +1,164 @@
+import logging
+import re
+import threading
+import time
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from typing import Any, Dict, Optional
+
+from utils.logging import set_logging
+
+set_logging()
+logger = logging.getLogger(__name__)
+
+# Sentinel Hub bills 1 processing unit for a 512x512 output of 3 bands from one acquisition
+PU_REFERENCE_PIXELS = 512 * 512
+PU_REFERENCE_BANDS = 3
+PU_MINIMUM = 0.005
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """Parse a Retry-After header given either in seconds or as an HTTP date"""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        retry_at = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if retry_at.tzinfo is None:
+        retry_at = retry_at.replace(tzinfo=timezone.utc)
+    return max(0.0, (retry_at - datetime.now(timezone.utc)).total_seconds())
+
+
+def estimate_processing_units(payload: Dict[str, Any]) -> float:
+    """Approximate the processing units a Process API request will be billed"""
+    output = payload["output"]
+    pixels = output.get("width", 512) * output.get("height", 512)
+    evalscript = payload.get("evalscript", "")
+    match = re.search(r"input\s*:\s*\[([^\]]*)\]", evalscript)
+    bands = [band for band in re.findall(r"\"(\w+)\"", match.group(1)) if band != "dataMask"] if match else []
+    processing_units = pixels / PU_REFERENCE_PIXELS * max(len(bands), 1) / PU_REFERENCE_BANDS
+    if "FLOAT32" in evalscript:
+        processing_units *= 2
+    return max(processing_units * len(payload["input"]["data"]), PU_MINIMUM)
+
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float):
+        self.rate: float = rate
+        self.capacity: float = capacity
+        self.tokens: float = capacity
+        self.updated_at: float = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, amount: float = 1.0) -> float:
+        """Block until `amount` tokens are available and return the time spent waiting"""
+        amount = min(amount, self.capacity)
+        waited = 0.0
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+                self.updated_at = now
+                if self.tokens >= amount:
+                    self.tokens -= amount
+                    return waited
+                delay = (amount - self.tokens) / self.rate
+            time.sleep(delay)
+            waited += delay
+
+
+class RequestScheduler:
+    """Gate Process API requests behind request and processing unit budgets and an adaptive concurrency limit.
+
+    Concurrency grows additively while requests succeed under the target latency and is cut
+    multiplicatively on throttling, server errors or slow responses. A 429 pauses every worker
+    until its Retry-After has elapsed."""
+
+    DEFAULT_THROTTLE_PAUSE = 5.0
+
+    def __init__(
+        self,
+        max_concurrency: int,
+        min_concurrency: int = 1,
+        requests_per_minute: Optional[float] = None,
+        processing_units_per_minute: Optional[float] = None,
+        target_latency: Optional[float] = None,
+    ):
+        self.max_concurrency: int = max(1, max_concurrency)
+        self.min_concurrency: int = max(1, min(min_concurrency, self.max_concurrency))
+        self.target_latency: Optional[float] = target_latency
+        self.request_bucket: Optional[TokenBucket] = None
+        self.processing_unit_bucket: Optional[TokenBucket] = None
+        if requests_per_minute:
+            self.request_bucket = TokenBucket(requests_per_minute / 60, max(1.0, requests_per_minute / 60))
+        if processing_units_per_minute:
+            self.processing_unit_bucket = TokenBucket(
+                processing_units_per_minute / 60, max(1.0, processing_units_per_minute / 60)
+            )
+        self.limit: float = float(self.min_concurrency)
+        self.latency: Optional[float] = None
+        self.in_flight: int = 0
+        self.throttled: int = 0
+        self.retried: int = 0
+        self.completed: int = 0
+        self.failed: int = 0
+        self.paused_until: float = 0.0
+        self._cond = threading.Condition()
+
+    def acquire(self, processing_units: float = 1.0) -> None:
+        with self._cond:
+            while True:
+                pause = self.paused_until - time.monotonic()
+                if pause <= 0 and self.in_flight < int(self.limit):
+                    break
+                self._cond.wait(timeout=pause if pause > 0 else None)
+            self.in_flight += 1
+        if self.request_bucket is not None:
+            self.request_bucket.acquire()
+        if self.processing_unit_bucket is not None:
+            self.processing_unit_bucket.acquire(processing_units)
+
+    def release(self, status_code: Optional[int], latency: float, retry_after: Optional[float] = None) -> None:
+        with self._cond:
+            self.in_flight -= 1
+            if status_code == 429:
+                self.throttled += 1
+                pause = retry_after if retry_after is not None else self.DEFAULT_THROTTLE_PAUSE
+                self.paused_until = max(self.paused_until, time.monotonic() + pause)
+                self._decrease(0.5)
+                logger.warning(f"Throttled by the API, pausing {pause:.1f}s, concurrency limit {int(self.limit)}")
+            elif status_code is None or status_code >= 500:
+                self.failed += 1
+                self._decrease(0.75)
+            else:
+                self.completed += 1
+                self.latency = latency if self.latency is None else 0.8 * self.latency + 0.2 * latency
+                if self.target_latency is not None and self.latency > self.target_latency:
+                    self._decrease(0.9)
+                else:
+                    self.limit = min(float(self.max_concurrency), self.limit + 1 / self.limit)
+            self._cond.notify_all()
+
+    def record_retry(self) -> None:
+        with self._cond:
+            self.retried += 1
+
+    def _decrease(self, factor: float) -> None:
+        self.limit = max(float(self.min_concurrency), self.limit * factor)
+
+    def counters(self) -> Dict[str, float]:
+        with self._cond:
+            return {
+                "in_flight": self.in_flight,
+                "throttled": self.throttled,
+                "retried": self.retried,
+                "completed": self.completed,
+                "failed": self.failed,
+                "concurrency_limit": int(self.limit),
+                "latency": round(self.latency, 3) if self.latency is not None else None,
+            }
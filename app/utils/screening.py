@@ -0,0 +1,122 @@
+import json
+import logging
+import os
+from enum import Enum
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+import rasterio
+from configuration.configuration import Configuration
+from rasterio.enums import Resampling
+from utils.logging import set_logging
+
+set_logging()
+logger = logging.getLogger(__name__)
+
+
+class ScreeningConstants(Enum):
+    FILE_SIZE = "file_size"
+    OVERVIEW = "overview"
+    DECIMATED = "decimated"
+
+
+class SceneScreener:
+    """Score every scene with cheap signals before it is decoded at full resolution.
+
+    Scenes smaller than `min_file_size` bytes are rejected from their size alone (nodata compresses to
+    almost nothing). The others are read once at a reduced resolution, from the TIFF overviews when
+    there are any or by decimated nearest-neighbour reads otherwise, and only the band telling valid
+    pixels apart: the dataMask band of raw band rasters, or the first band compared to `nodata`.
+    Decisions are kept in a sidecar per name_id and reused while the file and the thresholds are unchanged."""
+
+    def __init__(
+        self,
+        name_id: str,
+        min_valid_fraction: float = 0.5,
+        min_file_size: int = 0,
+        decimation: int = 8,
+        mask_band: Optional[int] = None,
+        nodata: Optional[float] = None,
+        cache_path: Optional[str] = None,
+    ):
+        if cache_path is None:
+            cache_path = os.path.join(str(Configuration()["cache_path"]), "screening")
+        self.min_valid_fraction: float = min_valid_fraction
+        self.min_file_size: int = min_file_size
+        self.decimation: int = max(1, decimation)
+        self.mask_band: Optional[int] = mask_band
+        self.nodata: Optional[float] = nodata
+        self.sidecar_path: str = os.path.join(cache_path, f"{name_id}.json")
+        self.settings: Dict[str, Any] = {
+            "min_valid_fraction": min_valid_fraction,
+            "min_file_size": min_file_size,
+            "decimation": self.decimation,
+            "mask_band": mask_band,
+            "nodata": nodata,
+        }
+        self.decisions: Dict[str, Dict[str, Any]] = {}
+        if os.path.exists(self.sidecar_path):
+            with open(self.sidecar_path, "r") as f:
+                sidecar = json.load(f)
+            if sidecar.get("settings") == self.settings:
+                self.decisions = sidecar["scenes"]
+
+    def score(self, tif: Path) -> Dict[str, Any]:
+        """Screen one scene and return the decision recorded for it"""
+        stat = tif.stat()
+        signature = [stat.st_size, stat.st_mtime]
+        decision = self.decisions.get(tif.name)
+        if decision is not None and decision["signature"] == signature:
+            return decision
+
+        if stat.st_size < self.min_file_size:
+            decision = {"method": ScreeningConstants.FILE_SIZE.value, "valid_fraction": None, "accepted": False}
+        else:
+            with rasterio.open(tif) as src:
+                band = self.mask_band + 1 if self.mask_band is not None else 1
+                method = ScreeningConstants.OVERVIEW if src.overviews(band) else ScreeningConstants.DECIMATED
+                out_shape = (
+                    max(1, src.height // self.decimation),
+                    max(1, src.width // self.decimation),
+                )
+                # A reduced out_shape makes GDAL read the closest overview level when the file has them
+                data = src.read(band, out_shape=out_shape, resampling=Resampling.nearest)
+                nodata = self.nodata if self.nodata is not None else src.nodata
+            if self.mask_band is not None:
+                valid = data != 0
+            else:
+                valid = np.isfinite(data) if data.dtype.kind == "f" else np.ones(data.shape, dtype=bool)
+                if nodata is not None:
+                    valid &= data != nodata
+            valid_fraction = float(valid.mean())
+            decision = {
+                "method": method.value,
+                "valid_fraction": valid_fraction,
+                "accepted": valid_fraction >= self.min_valid_fraction,
+            }
+        decision["signature"] = signature
+        self.decisions[tif.name] = decision
+        return decision
+
+    def screen(self, tifs: List[Path]) -> Tuple[np.ndarray, List[Path]]:
+        """Return the boolean selection of the accepted scenes, in order, and the rejected ones"""
+        accepted = np.array([self.score(tif)["accepted"] for tif in tifs], dtype=bool)
+        rejected = [tif for tif, keep in zip(tifs, accepted) if not keep]
+        self.save()
+        logger.info(
+            f"Screening kept {int(accepted.sum())} of {len(tifs)} scenes "
+            f"(min valid fraction {self.min_valid_fraction}), decisions in {self.sidecar_path}"
+        )
+        for tif in rejected:
+            decision = self.decisions[tif.name]
+            logger.info(
+                f"Scene {tif.name} rejected by {decision['method']}, valid fraction {decision['valid_fraction']}"
+            )
+        return accepted, rejected
+
+    def save(self) -> None:
+        os.makedirs(os.path.dirname(self.sidecar_path), exist_ok=True)
+        with open(self.sidecar_path + ".tmp", "w") as f:
+            json.dump({"settings": self.settings, "scenes": self.decisions}, f, indent=2)
+        os.replace(self.sidecar_path + ".tmp", self.sidecar_path)
@@ -0,0 +1,80 @@
+import json
+import logging
+import os
+from typing import Any, Dict, List, Optional
+
+import pandas as pd
+from configuration.configuration import Configuration
+from utils.logging import set_logging
+
+set_logging()
+logger = logging.getLogger(__name__)
+
+
+class SeriesCache:
+    """KPI dataframe of a name_id together with the rasters it was computed from.
+
+    Incremental runs only compute the rows of rasters appended after the cached ones. The cache is
+    dropped whenever the settings it was computed with change or a raster is added before or removed
+    from the cached range. It also counts the in-place model updates since the last full refit and the rows
+    each saved fit has seen, so a run that fails halfway never appends the same rows to a fit twice."""
+
+    SERIES_FILE = "series.pkl"
+    STATE_FILE = "state.json"
+
+    def __init__(self, name_id: str, settings: Dict[str, Any], cache_path: Optional[str] = None):
+        if cache_path is None:
+            cache_path = os.path.join(str(Configuration()["cache_path"]), "series")
+        self.path: str = os.path.join(cache_path, name_id)
+        self.settings: Dict[str, Any] = json.loads(json.dumps(settings, default=str))
+        self.state: Dict[str, Any] = {"settings": self.settings, "rasters": [], "updates": {}, "fitted": {}}
+        self.df: Optional[pd.DataFrame] = None
+        state_path = os.path.join(self.path, self.STATE_FILE)
+        if os.path.exists(state_path) and os.path.exists(os.path.join(self.path, self.SERIES_FILE)):
+            with open(state_path, "r") as f:
+                state = json.load(f)
+            if state["settings"] == self.settings:
+                self.state = state
+                self.df = pd.read_pickle(os.path.join(self.path, self.SERIES_FILE))
+            else:
+                logger.info(f"Series cache {self.path} computed with other settings, ignored")
+
+    def new_rasters(self, names: List[str]) -> Optional[List[bool]]:
+        """Which of `names` are not in the cached series yet, or None if the cache cannot be appended to"""
+        if self.df is None:
+            return None
+        cached = set(self.state["rasters"])
+        new = [name not in cached for name in names]
+        last = max(cached) if cached else ""
+        # Window names sort by date, new rasters must all come after the cached ones
+        if not cached.issubset(names) or any(name <= last for name, is_new in zip(names, new) if is_new):
+            logger.info(f"Rasters changed inside the cached range of {self.path}, rebuilding the series")
+            return None
+        return new
+
+    def save(self, df: pd.DataFrame, names: List[str]) -> None:
+        os.makedirs(self.path, exist_ok=True)
+        self.df = df
+        self.state["rasters"] = list(names)
+        df.to_pickle(os.path.join(self.path, self.SERIES_FILE))
+        self._save_state()
+
+    def updates(self, model_name: str) -> int:
+        return self.state["updates"].get(model_name, 0)
+
+    def fitted(self, model_name: str) -> Optional[int]:
+        """Rows the saved fit of the model has seen, None if unknown"""
+        return self.state.get("fitted", {}).get(model_name)
+
+    def record_update(self, model_name: str, refit: bool, rows: int) -> None:
+        self.state["updates"][model_name] = 0 if refit else self.updates(model_name) + 1
+        self.state.setdefault("fitted", {})[model_name] = rows
+        self._save_state()
+
+    def _save_state(self) -> None:
+        os.makedirs(self.path, exist_ok=True)
+        state_path = os.path.join(self.path, self.STATE_FILE)
+        with open(state_path + ".tmp", "w") as f:
+            json.dump(self.state, f)
+        os.replace(state_path + ".tmp", state_path)
+
@@ -0,0 +1,88 @@
+import logging
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from enum import Enum
+from typing import Any, Callable, Dict, List, Optional
+
+from utils.logging import set_logging
+
+set_logging()
+logger = logging.getLogger(__name__)
+
+
+class TaskStatusConstants(Enum):
+    PENDING = "pending"
+    DONE = "done"
+    FAILED = "failed"
+    # A dependency failed, the task never ran
+    SKIPPED = "skipped"
+
+
+class Task:
+    def __init__(self, key: str, function: Callable[..., Any], dependencies: List[str]):
+        self.key: str = key
+        self.function: Callable[..., Any] = function
+        self.dependencies: List[str] = dependencies
+        self.status: TaskStatusConstants = TaskStatusConstants.PENDING
+        self.result: Any = None
+        self.error: Optional[str] = None
+        self.seconds: float = 0.0
+        # Number of times the task was requested, more than one when work was shared
+        self.requests: int = 1
+
+
+class TaskGraph:
+    """Tasks keyed by the work they do, run on one thread pool as soon as their dependencies are done.
+
+    Adding a task whose key is already in the graph returns the existing one, so identical work
+    requested by several callers runs once. Dependencies must be added first, which keeps the graph
+    acyclic. A failed task skips everything that depends on it and nothing else."""
+
+    def __init__(self):
+        self.tasks: Dict[str, Task] = {}
+
+    def add(self, key: str, function: Callable[..., Any], dependencies: Optional[List[str]] = None) -> Task:
+        """Add a task called with the results of its dependencies, in order"""
+        if key in self.tasks:
+            self.tasks[key].requests += 1
+            return self.tasks[key]
+        dependencies = dependencies or []
+        missing = [dependency for dependency in dependencies if dependency not in self.tasks]
+        if missing:
+            raise ValueError(f"Task {key} depends on unknown tasks {missing}")
+        self.tasks[key] = Task(key, function, dependencies)
+        return self.tasks[key]
+
+    def run(self, workers: int = 1) -> Dict[str, Task]:
+        pending = dict(self.tasks)
+        running: Dict[Future, Task] = {}
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+            while pending or running:
+                for key, task in list(pending.items()):
+                    statuses = [self.tasks[dependency].status for dependency in task.dependencies]
+                    if any(status in (TaskStatusConstants.FAILED, TaskStatusConstants.SKIPPED) for status in statuses):
+                        task.status = TaskStatusConstants.SKIPPED
+                        del pending[key]
+                        logger.warning(f"Task {key} skipped, a dependency failed")
+                    elif all(status == TaskStatusConstants.DONE for status in statuses):
+                        results = [self.tasks[dependency].result for dependency in task.dependencies]
+                        running[pool.submit(self._execute, task, results)] = task
+                        del pending[key]
+                if not running:
+                    break
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    running.pop(future)
+        return self.tasks
+
+    def _execute(self, task: Task, results: List[Any]) -> None:
+        start = time.perf_counter()
+        try:
+            task.result = task.function(*results)
+            task.status = TaskStatusConstants.DONE
+        except Exception as e:
+            task.error = f"{e.__class__.__name__}: {e}"
+            task.status = TaskStatusConstants.FAILED
+            logger.exception(f"Task {task.key} failed")
+        task.seconds = time.perf_counter() - start
+        logger.info(f"Task {task.key} {task.status.value} in {task.seconds:.1f}s")
@@ -0,0 +1,119 @@
+import logging
+import math
+import warnings
+from typing import List, Tuple
+
+from utils.logging import set_logging
+
+set_logging()
+logger = logging.getLogger(__name__)
+
+METERS_PER_DEGREE = 111320.0
+# Largest output the Process API accepts for a single request
+MAX_TILE_SIZE = 2500
+
+
+def normalize_bbox(bbox: List[float]) -> Tuple[float, float, float, float]:
+    """Return the bbox as (min_x, min_y, max_x, max_y) whatever corner order it was written in"""
+    x0, y0, x1, y1 = bbox
+    return min(x0, x1), min(y0, y1), max(x0, x1), max(y0, y1)
+
+
+class Tile:
+    def __init__(self, row: int, col: int, bbox: List[float], col_off: int, row_off: int, width: int, height: int):
+        self.row: int = row
+        self.col: int = col
+        self.bbox: List[float] = bbox
+        self.col_off: int = col_off
+        self.row_off: int = row_off
+        self.width: int = width
+        self.height: int = height
+
+    @property
+    def name(self) -> str:
+        return f"r{self.row}_c{self.col}"
+
+
+class TileGrid:
+    """Split a WGS84 bbox into tiles small enough for one request each at a target ground resolution"""
+
+    def __init__(self, bbox: List[float], resolution: float, max_tile_size: int = MAX_TILE_SIZE):
+        self.bbox: Tuple[float, float, float, float] = normalize_bbox(bbox)
+        min_x, min_y, max_x, max_y = self.bbox
+        center_lat = math.radians((min_y + max_y) / 2)
+        degrees_x = resolution / (METERS_PER_DEGREE * math.cos(center_lat))
+        degrees_y = resolution / METERS_PER_DEGREE
+        self.width: int = max(1, math.ceil((max_x - min_x) / degrees_x))
+        self.height: int = max(1, math.ceil((max_y - min_y) / degrees_y))
+        max_tile_size = min(max_tile_size, MAX_TILE_SIZE)
+        self.cols: int = math.ceil(self.width / max_tile_size)
+        self.rows: int = math.ceil(self.height / max_tile_size)
+
+        # Pixel size is adjusted so that the grid covers the bbox exactly
+        pixel_x = (max_x - min_x) / self.width
+        pixel_y = (max_y - min_y) / self.height
+        col_edges = [round(i * self.width / self.cols) for i in range(self.cols + 1)]
+        row_edges = [round(i * self.height / self.rows) for i in range(self.rows + 1)]
+        self.tiles: List[Tile] = []
+        for row in range(self.rows):
+            for col in range(self.cols):
+                col_off, row_off = col_edges[col], row_edges[row]
+                width, height = col_edges[col + 1] - col_off, row_edges[row + 1] - row_off
+                tile_bbox = [
+                    min_x + col_off * pixel_x,
+                    max_y - (row_off + height) * pixel_y,
+                    min_x + (col_off + width) * pixel_x,
+                    max_y - row_off * pixel_y,
+                ]
+                self.tiles.append(Tile(row, col, tile_bbox, col_off, row_off, width, height))
+        logger.info(
+            f"Tiling {self.width}x{self.height} px at {resolution}m into {self.rows}x{self.cols} tiles"
+        )
+
+    @staticmethod
+    def is_complete(tile: Tile, path: str) -> bool:
+        """Whether a tile left by a previous run has the tile's size and can be read to its last row"""
+        import rasterio
+        from rasterio.errors import NotGeoreferencedWarning, RasterioError
+        from rasterio.windows import Window
+
+        try:
+            with warnings.catch_warnings():
+                warnings.simplefilter("ignore", NotGeoreferencedWarning)
+                with rasterio.open(path) as src:
+                    if (src.width, src.height) != (tile.width, tile.height):
+                        return False
+                    src.read(window=Window(0, tile.height - 1, tile.width, 1))
+        except RasterioError:
+            return False
+        return True
+
+    def mosaic(self, tile_paths: List[Tuple[Tile, str]], output_path: str) -> None:
+        """Stitch the downloaded tiles (GeoTIFF or PNG) into one georeferenced GeoTIFF, one tile in memory at a time"""
+        import rasterio
+        from rasterio.errors import NotGeoreferencedWarning
+        from rasterio.transform import from_bounds
+        from rasterio.windows import Window
+
+        with warnings.catch_warnings():
+            # PNG tiles carry no georeferencing; their placement comes from the grid
+            warnings.simplefilter("ignore", NotGeoreferencedWarning)
+            with rasterio.open(tile_paths[0][1]) as src:
+                count, dtype = src.count, src.dtypes[0]
+            profile = {
+                "driver": "GTiff",
+                "width": self.width,
+                "height": self.height,
+                "count": count,
+                "dtype": dtype,
+                "crs": "EPSG:4326",
+                "transform": from_bounds(*self.bbox, self.width, self.height),
+                "tiled": True,
+                "compress": "deflate",
+            }
+            with rasterio.open(output_path, "w", **profile) as dst:
+                for tile, path in tile_paths:
+                    with rasterio.open(path) as src:
+                        data = src.read(out_shape=(count, tile.height, tile.width))
+                    dst.write(data, window=Window(tile.col_off, tile.row_off, tile.width, tile.height))
+        logger.info(f"Mosaic {output_path} written from {len(tile_paths)} tiles")
@@ -0,0 +1,170 @@
+import hashlib
+import json
+import logging
+import os
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+import rasterio
+from configuration.configuration import Configuration
+from numpy.core.multiarray import ndarray
+from rasterio.features import rasterize
+from scripts.indices import SpectralIndex
+from scripts.kpis import KPIsConstants, parse_kpis, percentile_of
+from utils.logging import set_logging
+from utils.process_data import prepare_image
+
+set_logging()
+logger = logging.getLogger(__name__)
+
+# Label of the pixels outside every zone
+BACKGROUND = 0
+
+
+class ZoneMap:
+    """Polygons of a GeoJSON file burnt into a label raster aligned to the grid of the downloaded GeoTIFFs.
+
+    Zone i (1-based, in file order) is identified by the `id_property` of its feature, or by its index.
+    The label map is rasterized once per grid and cached next to the other derived data, keyed by the
+    file content and the grid, so later runs and every date of a run reuse it."""
+
+    def __init__(
+        self,
+        zones_file: str,
+        id_property: Optional[str] = None,
+        all_touched: bool = False,
+        cache_path: Optional[str] = None,
+    ):
+        if cache_path is None:
+            cache_path = os.path.join(str(Configuration()["cache_path"]), "zones")
+        with open(zones_file, "rb") as f:
+            content = f.read()
+        features = json.loads(content)["features"]
+        if not features:
+            raise ValueError(f"No polygons found in {zones_file}")
+        self.zones: List[str] = [
+            str(feature["properties"][id_property]) if id_property else str(i)
+            for i, feature in enumerate(features)
+        ]
+        if len(set(self.zones)) != len(self.zones):
+            raise ValueError(f"Property {id_property} does not identify every zone of {zones_file}")
+        self.geometries: List[Dict[str, Any]] = [feature["geometry"] for feature in features]
+        self.all_touched: bool = all_touched
+        self.cache_path: str = cache_path
+        self.digest: str = hashlib.sha256(content + f"{id_property}{all_touched}".encode()).hexdigest()
+        self.labels: Dict[Tuple, ndarray] = {}
+
+    def get_labels(self, src: rasterio.DatasetReader) -> ndarray:
+        """Label map for the grid of an open raster, rasterized only the first time the grid is seen"""
+        if src.crs is None:
+            raise ValueError(f"Raster {src.name} is not georeferenced, zonal statistics need GeoTIFFs")
+        grid = (tuple(src.transform), src.height, src.width, src.crs.to_string())
+        if grid in self.labels:
+            return self.labels[grid]
+
+        key = hashlib.sha256((self.digest + json.dumps(grid)).encode()).hexdigest()
+        cache_file = os.path.join(self.cache_path, f"{key}.npy")
+        if os.path.exists(cache_file):
+            labels = np.load(cache_file)
+            logger.info(f"Using cached label map {cache_file}")
+        else:
+            if src.crs.to_epsg() != 4326:
+                raise ValueError(f"Raster {src.name} is in {src.crs}, zones are expected in EPSG:4326 like GeoJSON")
+            dtype = np.uint16 if len(self.zones) < np.iinfo(np.uint16).max else np.int32
+            labels = rasterize(
+                zip(self.geometries, range(1, len(self.zones) + 1)),
+                out_shape=(src.height, src.width),
+                transform=src.transform,
+                fill=BACKGROUND,
+                all_touched=self.all_touched,
+                dtype=dtype,
+            )
+            os.makedirs(self.cache_path, exist_ok=True)
+            np.save(cache_file + ".tmp.npy", labels)
+            os.replace(cache_file + ".tmp.npy", cache_file)
+            empty = len(self.zones) - (len(np.unique(labels)) - (labels == BACKGROUND).any())
+            logger.info(f"Label map of {len(self.zones)} zones cached in {cache_file}, {empty} zones without pixels")
+        self.labels[grid] = labels
+        return labels
+
+
+def zonal_kpis(image: ndarray, labels: ndarray, zones: int, kpis: List[str]) -> Dict[str, ndarray]:
+    """Statistics of every zone of one (height, width) image as grouped reductions over the label map.
+
+    Sums come from bincount; min, max and percentiles from a single sort of the valid pixels by
+    (zone, value), reading each zone's order statistics at its offset in the sorted run."""
+    labels = labels.ravel()
+    values = image.ravel()
+    valid = np.isfinite(values) & (labels != BACKGROUND)
+    values = values[valid].astype(np.float64)
+    groups = labels[valid].astype(np.int64)
+    size = np.bincount(labels.astype(np.int64), minlength=zones + 1)[1:]
+    count = np.bincount(groups, minlength=zones + 1)[1:]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        mean = np.bincount(groups, weights=values, minlength=zones + 1)[1:] / count
+        result = {}
+        order_statistics = [kpi for kpi in kpis if kpi in (KPIsConstants.MIN.value, KPIsConstants.MAX.value)]
+        order_statistics += [kpi for kpi in kpis if percentile_of(kpi) is not None]
+        if order_statistics:
+            ordered = values[np.lexsort((values, groups))]
+            starts = np.concatenate(([0], np.cumsum(count)[:-1]))
+            last = np.maximum(count - 1, 0)
+        for kpi in kpis:
+            if kpi == KPIsConstants.MEAN.value:
+                result[kpi] = mean
+            elif kpi == KPIsConstants.STD.value:
+                deviations = np.square(values - mean[groups - 1])
+                result[kpi] = np.sqrt(np.bincount(groups, weights=deviations, minlength=zones + 1)[1:] / count)
+            elif kpi == KPIsConstants.VALID_FRACTION.value:
+                result[kpi] = np.where(size > 0, count / size, 0.0)
+            elif kpi in order_statistics:
+                if kpi == KPIsConstants.MIN.value:
+                    position = np.zeros(zones)
+                elif kpi == KPIsConstants.MAX.value:
+                    position = last.astype(np.float64)
+                else:
+                    # Linear interpolation between closest ranks, as np.percentile does
+                    position = percentile_of(kpi) / 100 * last
+                lower = np.floor(position).astype(np.int64)
+                upper = np.minimum(lower + 1, last)
+                fraction = position - lower
+                if len(ordered):
+                    low = ordered[np.minimum(starts + lower, len(ordered) - 1)]
+                    high = ordered[np.minimum(starts + upper, len(ordered) - 1)]
+                    value = low + (high - low) * fraction
+                else:
+                    value = np.zeros(zones)
+                result[kpi] = np.where(count > 0, value, np.nan)
+    return result
+
+
+def zonal_dataframe(
+    tifs: List[Path],
+    time: ndarray,
+    zone_map: ZoneMap,
+    kpi_name: str,
+    kpis: Optional[List[str]] = None,
+    spectral_index: Optional[SpectralIndex] = None,
+) -> pd.DataFrame:
+    """Long (zone, time, kpi, value) frame with the statistics of every zone for every raster,
+    reading each raster once whatever the number of zones"""
+    kpis = parse_kpis(kpi_name, kpis)
+    zones = len(zone_map.zones)
+    frames = []
+    for tif, time_value in zip(tifs, time):
+        with rasterio.open(tif) as src:
+            labels = zone_map.get_labels(src)
+            image = prepare_image(src.read(out_dtype=np.float32), spectral_index)
+        for kpi, values in zonal_kpis(image, labels, zones, kpis).items():
+            frames.append(
+                pd.DataFrame(
+                    {"zone": zone_map.zones, "time": [time_value] * zones, "kpi": [kpi] * zones, "value": values}
+                )
+            )
+    if not frames:
+        return pd.DataFrame(columns=["zone", "time", "kpi", "value"])
+    df = pd.concat(frames, ignore_index=True)
+    logger.info(f"Zonal statistics of {zones} zones over {len(tifs)} rasters")
+    return df
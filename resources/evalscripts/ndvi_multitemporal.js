@@ -0,0 +1,28 @@
+//VERSION=3
+// __WINDOWS__ is replaced by the downloader with the [from, to] ISO dates of every packed window
+const WINDOWS = __WINDOWS__.map((window) => [Date.parse(window[0]), Date.parse(window[1])]);
+
+function setup() {
+  return {
+    input: ["B04", "B08", "dataMask"],
+    output: { bands: WINDOWS.length },
+    mosaicking: "ORBIT"
+  };
+}
+
+function evaluatePixel(samples, scenes) {
+  // Samples come most recent first, keep the first valid one of every window
+  let values = new Array(WINDOWS.length).fill(0);
+  let found = new Array(WINDOWS.length).fill(false);
+  for (let i = 0; i < samples.length; i++) {
+    if (samples[i].dataMask == 0) continue;
+    let time = scenes.orbits[i].dateFrom ? Date.parse(scenes.orbits[i].dateFrom) : 0;
+    for (let w = 0; w < WINDOWS.length; w++) {
+      if (!found[w] && time >= WINDOWS[w][0] && time < WINDOWS[w][1]) {
+        values[w] = index(samples[i].B08, samples[i].B04);
+        found[w] = true;
+      }
+    }
+  }
+  return values;
+}
@@ -0,0 +1,12 @@
+//VERSION=3
+// Raw reflectances for the local index engine, band order must match RAW_BANDS in scripts/indices.py
+function setup() {
+  return {
+    input: ["B03", "B04", "B08", "B11", "dataMask"],
+    output: { bands: 5, sampleType: "FLOAT32" }
+  };
+}
+
+function evaluatePixel(samples) {
+  return [samples.B03, samples.B04, samples.B08, samples.B11, samples.dataMask];
+}